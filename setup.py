@@ -39,6 +39,7 @@ setuptools.setup(name='straxen',
                      'bin/bootstrax',
                      'bin/straxer',
                      'bin/fake_daq',
+                     'bin/daq_benchmark',
                      'bin/microstrax',
                      'bin/ajax',
                      'bin/refresh_raw_records',
@@ -4,6 +4,7 @@ from utilix import uconfig
 from .common import *
 # contexts.py below
 from .corrections_services import *
+from .corrections_snapshot import *
 from .get_corrections import *
 from .hitfinder_thresholds import *
 from .itp_map import *
@@ -11,11 +12,13 @@ from .matplotlib_utils import *
 from .mini_analysis import *
 from .misc import *
 from .mongo_storage import *
+from .numpy_model import *
 from .online_monitor import *
 from .rundb import *
 from .scada import *
 from .bokeh_utils import *
 from .rucio import *
+from .synthetic_daq import *
 
 from . import plugins
 from .plugins import *
@@ -12,10 +12,12 @@ import dill
 import socket
 import sys
 import tarfile
+import threading
 import urllib.request
 import tqdm
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
 from re import match
 import numba
 from warnings import warn
@@ -77,8 +79,160 @@ def pmt_positions(xenon1t=False):
             fmt='csv')
 
 
-# In-memory resource cache
-_resource_cache = dict()
+@export
+class ResourceCache:
+    """
+    In-memory least-recently-used cache of opened resources, holding at
+    most max_bytes (as estimated by resource_nbytes). Memory mapped
+    arrays do not count towards the budget, their pages are managed by
+    the operating system.
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        :param max_bytes: budget of the cache in bytes, None for no limit
+        """
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'too_large': 0}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Get key from the cache, and mark it as most recently used"""
+        with self._lock:
+            if key not in self._items:
+                self.stats['misses'] += 1
+                return default
+            self.stats['hits'] += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used
+        resources if the cache goes over its budget"""
+        nbytes = resource_nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                self.stats['too_large'] += 1
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, (_, nbytes) = self._items.popitem(last=False)
+            self.nbytes -= nbytes
+            self.stats['evictions'] += 1
+
+    def resize(self, max_bytes):
+        """Change the budget of the cache to max_bytes"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def info(self):
+        return dict(self.stats, size=len(self._items),
+                    nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+
+@export
+def resource_nbytes(resource):
+    """
+    Estimate the memory used by an opened resource
+    :param resource: result of open_resource
+    :return: size in bytes
+    """
+    if isinstance(resource, np.memmap):
+        return 0
+    if isinstance(resource, np.ndarray):
+        if resource.dtype.hasobject:
+            return resource.nbytes + sum(resource_nbytes(x) for x in resource.flat)
+        return resource.nbytes
+    if isinstance(resource, (pd.DataFrame, pd.Series)):
+        return int(resource.memory_usage(deep=True).sum())
+    if isinstance(resource, dict):
+        return sys.getsizeof(resource) + sum(
+            resource_nbytes(k) + resource_nbytes(v) for k, v in resource.items())
+    if isinstance(resource, (list, tuple)):
+        return sys.getsizeof(resource) + sum(resource_nbytes(x) for x in resource)
+    return sys.getsizeof(resource)
+
+
+def _apply_umask(mode):
+    """
+    :param mode: permissions, e.g. 0o666 for files and 0o777 for
+        directories
+    :return: the permissions without those removed by the umask of
+        the process, as open and os.makedirs give. Use this for files
+        and directories from tempfile, which are only accessible to
+        the user, before moving them to a shared place.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return mode & ~umask
+
+
+def _env_megabytes(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(float(value) * 1024 ** 2)
+
+
+# In-memory resource cache, by (file name, format). The budget (in MB)
+# can be set with the STRAXEN_RESOURCE_CACHE_MB environment variable
+_resource_cache = ResourceCache(
+    max_bytes=_env_megabytes('STRAXEN_RESOURCE_CACHE_MB', 4 * 1024 ** 3))
+# npy files of at least this size are opened as read-only memory maps,
+# None to always load them. Set with STRAXEN_RESOURCE_MMAP_MB
+_mmap_npy_min_bytes = _env_megabytes('STRAXEN_RESOURCE_MMAP_MB', None)
+
+
+@export
+def configure_resource_cache(max_bytes='unchanged', mmap_npy_min_bytes='unchanged'):
+    """
+    Configure the in-memory cache of get_resource and open_resource
+    :param max_bytes: budget of the cache in bytes, None for no limit
+    :param mmap_npy_min_bytes: open npy files of at least this many
+        bytes as read-only memory maps, None to always load them
+    """
+    global _mmap_npy_min_bytes
+    if max_bytes != 'unchanged':
+        _resource_cache.resize(max_bytes)
+    if mmap_npy_min_bytes != 'unchanged':
+        _mmap_npy_min_bytes = mmap_npy_min_bytes
+
+
+@export
+def resource_cache_info():
+    """Statistics of the in-memory resource cache"""
+    return dict(_resource_cache.info(), mmap_npy_min_bytes=_mmap_npy_min_bytes)
+
+
+@export
+def clear_resource_cache():
+    """Remove all resources from the in-memory cache"""
+    _resource_cache.clear()
+
+# Marker for resources not in the in-memory cache
+_not_cached = object()
 
 # Formats for which the original file is text, not binary
 _text_formats = ['text', 'csv', 'json']
@@ -87,17 +241,24 @@ _text_formats = ['text', 'csv', 'json']
 @export
 def open_resource(file_name: str, fmt='text'):
     """
-    Open file
+    Open file, npy files larger than the limit set with
+    configure_resource_cache are opened as read-only memory maps
     :param file_name: str, file to open
     :param fmt: format of the file
     :return: opened file
     """
-    if file_name in _resource_cache:
+    cached = _resource_cache.get((file_name, fmt), _not_cached)
+    if cached is not _not_cached:
         # Retrieve from in-memory cache
-        return _resource_cache[file_name]
+        return cached
     # File resource
     if fmt in ['npy', 'npy_pickle']:
-        result = np.load(file_name, allow_pickle=fmt == 'npy_pickle')
+        mmap_mode = None
+        if (fmt == 'npy' and _mmap_npy_min_bytes is not None
+                and os.path.getsize(file_name) >= _mmap_npy_min_bytes):
+            # Ignored by np.load for npz files
+            mmap_mode = 'r'
+        result = np.load(file_name, allow_pickle=fmt == 'npy_pickle', mmap_mode=mmap_mode)
         if isinstance(result, np.lib.npyio.NpzFile):
             # Slurp the arrays in the file, so the result can be copied,
             # then close the file so its descriptors does not leak.
@@ -134,7 +295,7 @@ def open_resource(file_name: str, fmt='text'):
         raise ValueError(f"Unsupported format {fmt}!")
 
     # Store in in-memory cache
-    _resource_cache[file_name] = result
+    _resource_cache.put((file_name, fmt), result)
 
     return result
 
@@ -159,15 +320,17 @@ def get_resource(x: str, fmt='text'):
         specified format
     """
     # 1. load from memory
-    if x in _resource_cache:
-        return _resource_cache[x]
+    if (x, fmt) in _resource_cache:
+        cached = _resource_cache.get((x, fmt), _not_cached)
+        if cached is not _not_cached:
+            return cached
     # 2. load from file
-    elif os.path.exists(x):
+    if os.path.exists(x):
         return open_resource(x, fmt=fmt)
     # 3. load from database
     elif straxen.uconfig is not None:
-        downloader = straxen.MongoDownloader()
-        if x in downloader.list_files():
+        downloader = straxen.get_shared_downloader()
+        if x in downloader.file_index():
             path = downloader.download_single(x)
             return open_resource(path, fmt=fmt)
     # 4. load from URL
@@ -309,7 +472,13 @@ def download_test_data():
 def get_livetime_sec(context, run_id, things=None):
     """Get the livetime of a run in seconds. If it is not in the run metadata,
     estimate it from the data-level metadata of the data things.
+    Runs whose livetime is in the run times index of the CMT (see
+    straxen.RunTimesIndex) are not looked up again.
     """
+    run_times = straxen.corrections_services.cached_run_times(run_id)
+    if run_times is not None and run_times['livetime'] is not None:
+        # Unlike a missing livetime, a known livetime is final
+        return run_times['livetime']
     try:
         md = context.run_metadata(run_id,
                                   projection=('start', 'end', 'livetime'))
@@ -324,6 +493,11 @@ def get_livetime_sec(context, run_id, things=None):
             return (md['end'] - md['start']).total_seconds()
 
 
+# Functions loaded by pre_apply_function, by name. These are code
+# rather than resources, so they are kept apart from the resource cache
+_pre_apply_functions = {}
+
+
 @export
 def pre_apply_function(data, run_id, target, function_name='pre_apply_function'):
     """
@@ -337,16 +511,17 @@ def pre_apply_function(data, run_id, target, function_name='pre_apply_function')
         function_name.py should be stored in the database.
     :return: Data where the function is applied.
     """
-    if function_name not in _resource_cache:
-        # only load the function once and put it in the resource cache
+    if function_name not in _pre_apply_functions:
+        # only load the function once
         function_file = f'{function_name}.py'
         function_file = _overwrite_testing_function_file(function_file)
         function = get_resource(function_file, fmt='txt')
+        namespace = {}
         # pylint: disable=exec-used
-        exec(function)
+        exec(function, namespace)
         # Cache the function to reduce reloading & eval operations
-        _resource_cache[function_name] = locals().get(function_name)
-    data = _resource_cache[function_name](data, run_id, strax.to_str_tuple(target))
+        _pre_apply_functions[function_name] = namespace[function_name]
+    data = _pre_apply_functions[function_name](data, run_id, strax.to_str_tuple(target))
     return data
 
 
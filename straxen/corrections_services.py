@@ -1,10 +1,14 @@
 """Return corrections from corrections DB
 """
 import warnings
+import tempfile
+import threading
+import time
 
+import bson
 import pytz
 import numpy as np
-from functools import lru_cache
+import pandas as pd
 import strax
 import utilix
 import straxen
@@ -25,6 +29,14 @@ single_value_corrections = ['elife_xenon1t', 'elife', 'baseline_samples_nv',
 arrays_corrections = ['hit_thresholds_tpc', 'hit_thresholds_he',
                       'hit_thresholds_nv', 'hit_thresholds_mv']
 
+# corrections that are stored as one table per PMT (the gains), and the
+# to_pe_model options that use them
+per_pmt_corrections = ('pmt', 'n_veto', 'mu_veto')
+# pmt == TPC, n_veto == n_veto's PMT, etc
+gain_detectors = {'to_pe_model': 'pmt',
+                  'to_pe_model_nv': 'n_veto',
+                  'to_pe_model_mv': 'mu_veto'}
+
 # needed because we pass these names as strax options which then get paired with the default reconstruction algorithm
 # important for apply_cmt_version
 posrec_corrections_basenames = ['s1_xyz_map', 'fdc_map']
@@ -34,6 +46,241 @@ class CMTVersionError(Exception):
     pass
 
 
+# Corrections and run start times read in this process, shared by all
+# CorrectionsManagementServices. Keys start with the cache_namespace of
+# the instance, so instances on different databases do not mix. Both
+# are least-recently-used caches. The budget of the corrections (in MB)
+# can be set with the STRAXEN_CMT_CACHE_MB environment variable.
+_corrections_cache = straxen.common.ResourceCache(
+    max_bytes=straxen.common._env_megabytes('STRAXEN_CMT_CACHE_MB', 256 * 1024 ** 2))
+_start_time_cache = straxen.common.ResourceCache(max_bytes=16 * 1024 ** 2)
+_cache_stats = {'hits': 0, 'misses': 0, 'start_time_hits': 0, 'start_time_misses': 0}
+# RunTimesIndex of the runs collection, by cache_namespace
+_run_times_indexes = {}
+# Shared CorrectionsManagementServices, by is_nt
+_shared_cmt = {}
+_shared_cmt_lock = threading.Lock()
+
+
+@export
+def get_shared_cmt(is_nt=True):
+    """
+    Get the CorrectionsManagementServices shared by everything in this
+    process (plugins, mini-analyses, ...), so only one Mongo client is
+    opened per process.
+
+    If the STRAXEN_CMT_SNAPSHOT environment variable is set, the
+    corrections are read from that snapshot (see make_cmt_snapshot)
+    instead of the corrections DB.
+
+    :param is_nt: bool if True we are looking at nT if False we are looking at 1T
+    :return: CorrectionsManagementServices
+    """
+    with _shared_cmt_lock:
+        if is_nt not in _shared_cmt:
+            snapshot = os.environ.get('STRAXEN_CMT_SNAPSHOT')
+            if snapshot:
+                cmt = straxen.CorrectionsSnapshot(snapshot)
+                if cmt.is_nt != is_nt:
+                    raise ValueError(f'{snapshot} is not a snapshot for is_nt={is_nt}')
+            else:
+                cmt = CorrectionsManagementServices(is_nt=is_nt)
+            _shared_cmt[is_nt] = cmt
+        return _shared_cmt[is_nt]
+
+
+@export
+class RunTimesIndex:
+    """
+    Start and end times (and livetime, if known) of runs, read from the
+    runs collection in bulk. For XENONnT the runs are read in blocks of
+    block_size run numbers with a single projected query, so looking up
+    many runs costs a handful of queries.
+
+    The index can be stored on disk (cache_file), in which case known
+    runs are not read again by other processes.
+    """
+    block_size = 1000
+
+    def __init__(self, collection, is_nt=True, cache_file=None):
+        """
+        :param collection: runs collection (pymongo)
+        :param is_nt: bool if True the runs are XENONnT runs (by
+            number), if False XENON1T runs (by name)
+        :param cache_file: npz file to load the index from and store it
+            in, None for no on-disk cache
+        """
+        self.collection = collection
+        self.is_nt = is_nt
+        self.cache_file = cache_file
+        # (start, end, livetime) by run_id
+        self.runs = {}
+        self.stats = {'hits': 0, 'misses': 0, 'queries': 0}
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load(cache_file)
+
+    def _run_key(self, run_id):
+        # xenonnt use int
+        return str(int(run_id)) if self.is_nt else str(run_id)
+
+    def fetch(self, run_ids=None, run_range=None):
+        """
+        Read the times of many runs with one query
+
+        :param run_ids: list of run ids to read
+        :param run_range: (first, last + 1) run numbers to read, only
+            for XENONnT. If neither run_ids nor run_range is given, all
+            runs are read.
+        """
+        field = 'number' if self.is_nt else 'name'
+        if run_range is not None:
+            if not self.is_nt:
+                raise ValueError('run_range is only supported for XENONnT')
+            query = {field: {'$gte': int(run_range[0]), '$lt': int(run_range[1])}}
+        elif run_ids is not None:
+            query = {field: {'$in': [int(r) if self.is_nt else r for r in run_ids]}}
+        else:
+            query = {}
+        self.stats['queries'] += 1
+        for doc in self.collection.find(
+                query, {'_id': 0, field: 1, 'start': 1, 'end': 1, 'livetime': 1}):
+            if doc.get('start') is None:
+                continue
+            end = doc.get('end')
+            self.runs[self._run_key(doc[field])] = (
+                doc['start'].replace(tzinfo=pytz.utc),
+                None if end is None else end.replace(tzinfo=pytz.utc),
+                doc.get('livetime'))
+        if self.cache_file is not None:
+            self.save(self.cache_file)
+
+    def get(self, run_id, fetch=True):
+        """
+        :param run_id: run id from runDB
+        :param fetch: if the run is not in the index, read it (and the
+            runs around it) from the runs collection
+        :return: dict with start, end and livetime of the run (end and
+            livetime are None if not known), or None if the run is not
+            found
+        """
+        key = self._run_key(run_id)
+        if key in self.runs:
+            self.stats['hits'] += 1
+        elif fetch:
+            self.stats['misses'] += 1
+            if self.is_nt:
+                first = int(key) // self.block_size * self.block_size
+                self.fetch(run_range=(first, first + self.block_size))
+            else:
+                self.fetch(run_ids=[run_id])
+        if key not in self.runs:
+            return None
+        return dict(zip(('start', 'end', 'livetime'), self.runs[key]))
+
+    def save(self, file_name):
+        """Store the index in an npz file, see load"""
+        run_ids = list(self.runs.keys())
+        times = list(self.runs.values())
+        arrays = dict(
+            run_id=np.array(run_ids, dtype=str),
+            start=np.array([start.replace(tzinfo=None) for start, _, _ in times],
+                           dtype='datetime64[ns]'),
+            end=np.array([np.datetime64('NaT') if end is None else end.replace(tzinfo=None)
+                          for _, end, _ in times], dtype='datetime64[ns]'),
+            livetime=np.array([np.nan if livetime is None else livetime
+                               for _, _, livetime in times], dtype=np.float64))
+        temp_name = None
+        try:
+            fd, temp_name = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(file_name)), suffix='.npz')
+            with os.fdopen(fd, mode='wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_name, file_name)
+        except OSError as e:
+            warnings.warn(f'Cannot store the run times in {file_name}: {e}')
+            if temp_name is not None and os.path.exists(temp_name):
+                os.remove(temp_name)
+
+    def load(self, file_name):
+        """Add the runs of an npz file written by save to the index"""
+        try:
+            with np.load(file_name, allow_pickle=False) as f:
+                arrays = {key: f[key] for key in ('run_id', 'start', 'end', 'livetime')}
+        except (OSError, ValueError, KeyError) as e:
+            warnings.warn(f'Cannot load the run times from {file_name}: {e}')
+            return
+
+        def to_datetime(t):
+            if np.isnat(t):
+                return None
+            return pd.Timestamp(t).to_pydatetime().replace(tzinfo=pytz.utc)
+
+        for run_id, start, end, livetime in zip(*arrays.values()):
+            self.runs[str(run_id)] = (to_datetime(start),
+                                      to_datetime(end),
+                                      None if np.isnan(livetime) else float(livetime))
+
+
+def cached_run_times(run_id):
+    """
+    Times of a run from the RunTimesIndex of the shared
+    CorrectionsManagementServices, without querying the runs DB
+
+    :param run_id: run id from runDB
+    :return: dict with start, end and livetime (see RunTimesIndex.get),
+        or None if the run is not in the index
+    """
+    is_nt = str(run_id).isdigit()
+    cmt = _shared_cmt.get(is_nt)
+    if cmt is None or cmt.cache_namespace not in _run_times_indexes:
+        return None
+    return _run_times_indexes[cmt.cache_namespace].get(run_id, fetch=False)
+
+
+def set_shared_cmt(cmt):
+    """
+    Replace the CorrectionsManagementServices returned by
+    get_shared_cmt(cmt.is_nt), e.g. by a CorrectionsSnapshot
+
+    :param cmt: CorrectionsManagementServices, or None to open new ones
+        on the next get_shared_cmt
+    """
+    with _shared_cmt_lock:
+        if cmt is None:
+            _shared_cmt.clear()
+        else:
+            _shared_cmt[cmt.is_nt] = cmt
+
+
+@export
+def cmt_cache_info():
+    """
+    Statistics of the corrections cache shared by all
+    CorrectionsManagementServices in this process
+
+    :return: dict with the number of hits and misses for the
+        corrections and the run start times, and the number of cached
+        corrections (size)
+    """
+    return dict(_cache_stats, size=len(_corrections_cache))
+
+
+@export
+def clear_cmt_cache():
+    """
+    Clear the corrections cache. Cached corrections are otherwise only
+    read again if they are evicted from the cache, or, for the ONLINE
+    version, if they are older than
+    CorrectionsManagementServices.online_ttl. Use this to read all
+    corrections again, e.g. after corrections were updated.
+    """
+    _corrections_cache.clear()
+    _start_time_cache.clear()
+    _run_times_indexes.clear()
+    for key in _cache_stats:
+        _cache_stats[key] = 0
+
+
 @export
 class CorrectionsManagementServices():
     """
@@ -73,6 +320,7 @@ class CorrectionsManagementServices():
             self.collection = self.client['xenonnt']['runs']
         else:
             self.collection = self.client['run']['runs_new']
+        self.cache_namespace = (mongo_url, is_nt)
 
     def __str__(self):
         return self.__repr__()
@@ -104,17 +352,53 @@ class CorrectionsManagementServices():
                              f"available {single_value_corrections}, {arrays_corrections} and "
                              f"{corrections_w_file} ")
 
-    # TODO add option to extract 'when'. Also, the start time might not be the best
-    # entry for e.g. for super runs
-    # cache results, this would help when looking at the same gains
-    @lru_cache(maxsize=None)
     def _get_correction(self, run_id, correction, version):
         """
-        Smart logic to get correction from DB
+        Smart logic to get correction from DB. The corrections are
+        cached for all instances in this process, see cmt_cache_info.
         :param run_id: run id from runDB
         :param correction: correction's name, key word (str type)
         :param version: local version (str type)
-        :return: correction value(s)
+        :return: correction value(s), a read-only array
+        """
+        key = (self.cache_namespace, run_id, correction, version)
+        corrections = self._cached_corrections(key)
+        if corrections is not None:
+            _cache_stats['hits'] += 1
+            return corrections
+        _cache_stats['misses'] += 1
+        corrections = self._read_correction(run_id, correction, version)
+        self._cache_corrections(key, corrections)
+        return corrections
+
+    # Seconds after which cached corrections of the ONLINE version are
+    # read again, as they can change. Other versions are fixed.
+    online_ttl = 3600
+
+    def _cached_corrections(self, key):
+        """
+        :param key: (cache_namespace, run_id, correction, version)
+        :return: the cached corrections, or None if they are not cached
+            or expired
+        """
+        cached = _corrections_cache.get(key)
+        if cached is None:
+            return None
+        corrections, cached_at = cached
+        if key[3] == 'ONLINE' and time.monotonic() - cached_at > self.online_ttl:
+            return None
+        return corrections
+
+    @staticmethod
+    def _cache_corrections(key, corrections):
+        corrections.setflags(write=False)
+        _corrections_cache.put(key, (corrections, time.monotonic()))
+
+    # TODO add option to extract 'when'. Also, the start time might not be the best
+    # entry for e.g. for super runs
+    def _read_correction(self, run_id, correction, version):
+        """
+        Read the correction from the DB, see _get_correction
         """
         when = self.get_start_time(run_id)
 
@@ -123,19 +407,11 @@ class CorrectionsManagementServices():
 
             # hack to workaround to group all pmts
             # because every pmt is its own dataframe...of course
-            if correction in {'pmt', 'n_veto', 'mu_veto'}:
-                # get lists of pmts 
-                df_global = self.interface.read('global_xenonnt' if self.is_nt else 'global_xenon1t')
-                gains = df_global['global_ONLINE'][0]  # global is where all pmts are grouped
-                pmts = list(gains.keys())
-                for it_correction in pmts: # loop over all PMTs
-                    if correction in it_correction:
-                        df = self.interface.read(it_correction)
-                        if version in 'ONLINE':
-                            df = self.interface.interpolate(df, when, how='fill')
-                        else:
-                            df = self.interface.interpolate(df, when)
-                        values.append(df.loc[df.index == when, version].values[0])
+            if correction in per_pmt_corrections:
+                times, gain_values = self._read_correction_table(correction, version)
+                values = interpolate_corrections(
+                    times, gain_values, when,
+                    how='fill' if version in 'ONLINE' else 'interpolate')
             else:
                 df = self.interface.read(correction)
                 if correction in corrections_w_file or correction in arrays_corrections or version in 'ONLINE':
@@ -152,6 +428,143 @@ class CorrectionsManagementServices():
         else:
             return corrections
 
+    def _read_correction_table(self, correction, version):
+        """
+        Read all entries of one version of a correction
+
+        :param correction: correction's name, or 'pmt', 'n_veto' or
+            'mu_veto' for the gains of all PMTs of that detector
+        :param version: local version (str type)
+        :return: (times, values). For the PMT gains as returned by
+            _read_corrections. Otherwise the times (datetime64[ns], UTC)
+            and the values (see _column_values) of the entries.
+        """
+        if correction in per_pmt_corrections:
+            # hack to workaround to group all pmts
+            # because every pmt is its own dataframe...of course
+            global_name = 'global_xenonnt' if self.is_nt else 'global_xenon1t'
+            df_global = self.interface.read(global_name)
+            gains = df_global['global_ONLINE'][0]  # global is where all pmts are grouped
+            pmts = [it_correction for it_correction in gains.keys()
+                    if correction in it_correction]
+            return self._read_corrections(pmts, version, global_name)
+        df = self.interface.read(correction)
+        if df is None:
+            raise KeyError(f'No entries for {correction}')
+        return (df.index.tz_convert(None).values.astype('datetime64[ns]'),
+                _column_values(df[version]))
+
+    def preload_corrections(self, run_ids, correction, version):
+        """
+        Read a correction once and evaluate it at the start of all runs,
+        and put the results in the corrections cache. The corrections
+        of these runs are then returned without any query.
+
+        :param run_ids: list of run ids from runDB
+        :param correction: correction's name, key word (str type)
+        :param version: local version (str type)
+        """
+        keys = [(self.cache_namespace, run_id, correction, version) for run_id in run_ids]
+        run_ids = [run_id for run_id, key in zip(run_ids, keys)
+                   if self._cached_corrections(key) is None]
+        if not len(run_ids):
+            return
+        whens = np.array([self.get_start_time(run_id).replace(tzinfo=None)
+                          for run_id in run_ids], dtype='datetime64[ns]')
+        try:
+            times, values = self._read_correction_table(correction, version)
+        except KeyError:
+            raise ValueError(f"Version {version} not found for correction {correction}, please check")
+
+        if correction in per_pmt_corrections:
+            how = 'fill' if version in 'ONLINE' else 'interpolate'
+            corrections = np.stack(
+                [_interpolate_at_times(pmt_times[~np.isnat(pmt_times)], pmt_values, whens, how)
+                 for pmt_times, pmt_values in zip(times, values)], axis=1)
+        elif (values.dtype.kind == 'f' and values.ndim == 1
+              and not (correction in corrections_w_file
+                       or correction in arrays_corrections
+                       or version in 'ONLINE')):
+            corrections = _interpolate_at_times(times, values, whens, 'interpolate')[:, None]
+        else:
+            corrections = _fill_at_times(times, values, whens)
+
+        for run_id, run_corrections in zip(run_ids, corrections):
+            self._cache_corrections((self.cache_namespace, run_id, correction, version),
+                                    run_corrections)
+
+    # Maximum size (bytes) of the document that _read_corrections joins
+    # per query with $lookup. The document holds every field of every
+    # entry of the joined corrections, and must stay below the 16 MB
+    # limit of MongoDB. A quarter of the limit leaves room for
+    # corrections with more entries than the first one.
+    _max_lookup_bytes = 4 * 1024 ** 2
+
+    def _read_corrections(self, corrections, version, driving_collection):
+        """
+        Read one version of many corrections (e.g. the gains of all
+        PMTs) with a few queries, rather than one query per correction.
+        The first correction is read by itself. The others are joined
+        to a single document of driving_collection with $lookup, as many
+        per query as fit in _max_lookup_bytes, going by the size of the
+        first correction.
+
+        :param corrections: list of names of the corrections
+        :param version: version to read (str type)
+        :param driving_collection: name of any non-empty collection in
+            the corrections database
+        :return: (times, values), two arrays of shape
+            (len(corrections), max number of entries) with the times
+            (datetime64[ns], UTC) and values of the entries of each
+            correction, sorted by time. Missing entries are padded with
+            NaT and NaN.
+        """
+        if not len(corrections):
+            raise KeyError('No corrections to read')
+        database = self.client[self.interface.database_name]
+        first = list(database[corrections[0]].find())
+        entries = {corrections[0]: first}
+        correction_bytes = len(bson.encode({corrections[0]: first}))
+        per_query = max(1, self._max_lookup_bytes // correction_bytes)
+        for i in range(1, len(corrections), per_query):
+            names = corrections[i:i + per_query]
+            pipeline = [{'$limit': 1}]
+            for name in names:
+                # localField and foreignField are in none of the
+                # documents, so every entry of the correction matches
+                pipeline.append({'$lookup': {'from': name,
+                                             'localField': '_join_all',
+                                             'foreignField': '_join_all',
+                                             'as': name}})
+            # Only reduces what is sent back, the joined document is
+            # built with all fields before the projection
+            projection = {'_id': 0}
+            for name in names:
+                projection[f'{name}.time'] = 1
+                projection[f'{name}.{version}'] = 1
+            pipeline.append({'$project': projection})
+            for doc in database[driving_collection].aggregate(pipeline):
+                entries.update(doc)
+
+        n_entries = max([len(entries.get(name, [])) for name in corrections], default=0)
+        times = np.full((len(corrections), n_entries), np.datetime64('NaT'), dtype='datetime64[ns]')
+        values = np.full((len(corrections), n_entries), np.nan)
+        for i, name in enumerate(corrections):
+            docs = entries.get(name, [])
+            if not len(docs):
+                raise KeyError(f'No entries for {name}')
+            if not any(version in doc for doc in docs):
+                raise KeyError(f'{version} not found for {name}')
+            times[i, :len(docs)] = [
+                doc['time'] if doc['time'].tzinfo is None
+                else doc['time'].astimezone(pytz.utc).replace(tzinfo=None)
+                for doc in docs]
+            values[i, :len(docs)] = [np.nan if doc.get(version) is None else doc[version]
+                                     for doc in docs]
+        # NaT is sorted last
+        order = np.argsort(times, axis=1, kind='stable')
+        return np.take_along_axis(times, order, axis=1), np.take_along_axis(values, order, axis=1)
+
     def get_pmt_gains(self, run_id, model_type, version,
                       cacheable_versions=('ONLINE',),
                       gain_dtype=np.float32):
@@ -172,10 +585,7 @@ class CorrectionsManagementServices():
             # Get the detector name based on the requested model_type
             # This also will be used to the cachable name convention
             # pmt == TPC, n_veto == n_veto's PMT, etc
-            detector_names = {'to_pe_model': 'pmt',
-                              'to_pe_model_nv': 'n_veto',
-                              'to_pe_model_mv': 'mu_veto'}
-            target_detector = detector_names[model_type]
+            target_detector = gain_detectors[model_type]
 
             if version in cacheable_versions:
                 # Try to load from cache, if it does not exist it will be created below
@@ -244,22 +654,45 @@ class CorrectionsManagementServices():
     # TODO change to st.estimate_start_time
     def get_start_time(self, run_id):
         """
-        Smart logic to return start time from runsDB
+        Smart logic to return start time from runsDB. The start times
+        are cached for all instances in this process.
         :param run_id: run id from runDB
         :return: run start time
         """
-
-        if self.is_nt:
-            # xenonnt use int
-            run_id = int(run_id)
-
-        rundoc = self.collection.find_one(
-            {'number' if self.is_nt else 'name': run_id},
-            {'start': 1})
-        if rundoc is None:
+        key = (self.cache_namespace, run_id)
+        start_time = _start_time_cache.get(key)
+        if start_time is not None:
+            _cache_stats['start_time_hits'] += 1
+            return start_time
+        _cache_stats['start_time_misses'] += 1
+        start_time = self._read_start_time(run_id)
+        _start_time_cache.put(key, start_time)
+        return start_time
+
+    def _read_start_time(self, run_id):
+        run = self.run_times.get(run_id)
+        if run is None:
             raise ValueError(f'run_id = {run_id} not found')
-        time = rundoc['start']
-        return time.replace(tzinfo=pytz.utc)
+        return run['start']
+
+    @property
+    def run_times(self):
+        """
+        RunTimesIndex of the runs collection, shared by all instances
+        on the same database. For the default database it is stored on
+        disk if the STRAXEN_RUN_TIMES_CACHE_DIR environment variable is
+        set.
+        """
+        if self.cache_namespace not in _run_times_indexes:
+            cache_file = None
+            cache_dir = os.environ.get('STRAXEN_RUN_TIMES_CACHE_DIR')
+            if cache_dir and self.cache_namespace[0] is None:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache_file = os.path.join(
+                    cache_dir, f'run_times_{"xenonnt" if self.is_nt else "xenon1t"}.npz')
+            _run_times_indexes[self.cache_namespace] = RunTimesIndex(
+                self.collection, self.is_nt, cache_file=cache_file)
+        return _run_times_indexes[self.cache_namespace]
 
     def get_local_versions(self, global_version):
         """Returns a dict of local versions for a given global version. Use 'latest' to get newest version"""
@@ -274,7 +707,7 @@ class CorrectionsManagementServices():
         # CMT generates a global version, global version is just a set of local versions
         # With this we can do pretty easy bookkeping for offline contexts
 
-        cmt_global = self.interface.read('global_xenonnt')
+        cmt_global = self._read_global_versions()
         if global_version not in cmt_global:
             avail_global_versions_string = '\n'.join([f'\t\t{v}' for v in self.global_versions])
             raise ValueError(f"Global version {global_version} not found! "
@@ -294,7 +727,12 @@ class CorrectionsManagementServices():
 
     @property
     def global_versions(self):
-        return self.interface.read('global_xenonnt').columns.tolist()
+        return self._read_global_versions().columns.tolist()
+
+    def _read_global_versions(self):
+        """DataFrame of the global versions, with a column of local
+        versions per global version"""
+        return self.interface.read('global_xenonnt')
 
 
 def cacheable_naming(*args, fmt='.npy', base='./resource_cache/'):
@@ -310,12 +748,137 @@ def cacheable_naming(*args, fmt='.npy', base='./resource_cache/'):
     return base + '_'.join(args) + fmt
 
 
+@export
+def interpolate_corrections(times, values, when, how='interpolate'):
+    """
+    Evaluate many corrections at once at the time 'when', like
+    strax.CorrectionsInterface.interpolate does for a single correction
+    (with linear interpolation between the positions of the entries,
+    as pandas does).
+
+    :param times: array (n_corrections, n_entries) of the times
+        (datetime64, UTC) of the entries of each correction, sorted by
+        time. Trailing NaT entries are ignored.
+    :param values: array (n_corrections, n_entries) of the values of the
+        entries, NaN if an entry has no value
+    :param when: date, e.g. datetime(2020, 8, 12, 21, 4, 32, 7, tzinfo=pytz.utc)
+    :param how: Interpolation method, can be either 'interpolate' or 'fill'
+    :return: array (n_corrections) of the corrections at 'when', NaN if
+        no value is known before 'when'
+    """
+    if how not in ('interpolate', 'fill'):
+        raise ValueError('Specify an interpolation method, e.g. interpolate or fill')
+    strax.CorrectionsInterface.check_timezone(when)
+    when = np.datetime64(when.replace(tzinfo=None), 'ns')
+    times = np.asarray(times, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=np.float64)
+    n_entries = values.shape[1]
+    valid = ~np.isnan(values)
+
+    # 'when' is inserted after the n_before entries up to 'when'
+    before = times <= when
+    n_before = before.sum(axis=1)
+
+    # Last entry with a value up to 'when'
+    valid_before = before & valid
+    has_previous = valid_before.any(axis=1)
+    previous = n_entries - 1 - np.argmax(valid_before[:, ::-1], axis=1)
+    previous_value = np.take_along_axis(values, previous[:, None], axis=1)[:, 0]
+    result = np.where(has_previous, previous_value, np.nan)
+    if how == 'fill':
+        return result
+
+    # First entry with a value after 'when'. Entries without a value
+    # before the first one, or after the last one, are not interpolated
+    valid_after = ~before & valid
+    has_next = valid_after.any(axis=1)
+    following = np.argmax(valid_after, axis=1)
+    next_value = np.take_along_axis(values, following[:, None], axis=1)[:, 0]
+    interpolate = has_previous & has_next
+    # Positions after inserting 'when', at n_before
+    slope = (next_value - previous_value) / (following + 1 - previous)
+    interpolated = slope * (n_before - previous) + previous_value
+    # An entry at exactly 'when' is used as is
+    exact = times[np.arange(len(times)), previous] == when
+    return np.where(interpolate & ~exact, interpolated, result)
+
+
+def _interpolate_at_times(times, values, whens, how):
+    """
+    Evaluate one correction at many times, like interpolate_corrections
+    does for many corrections at one time
+
+    :param times: array of the times (datetime64[ns]) of the entries,
+        sorted
+    :param values: float array of the values of the entries
+    :param whens: array of times (datetime64[ns]) to evaluate at
+    :param how: 'interpolate' or 'fill'
+    :return: array of the correction at whens
+    """
+    with_value = np.flatnonzero(~np.isnan(values))
+    n_before = np.searchsorted(times, whens, side='right')
+    # Number of entries with a value up to each 'when'
+    n_valid_before = np.searchsorted(with_value, n_before, side='left')
+    has_previous = n_valid_before > 0
+    if not len(with_value):
+        return np.full(len(whens), np.nan)
+    previous = with_value[np.clip(n_valid_before - 1, 0, None)]
+    previous_value = values[previous]
+    result = np.where(has_previous, previous_value, np.nan)
+    if how == 'fill':
+        return result
+
+    has_next = n_valid_before < len(with_value)
+    following = with_value[np.clip(n_valid_before, None, len(with_value) - 1)]
+    next_value = values[following]
+    slope = (next_value - previous_value) / (following + 1 - previous)
+    interpolated = slope * (n_before - previous) + previous_value
+    exact = times[previous] == whens
+    return np.where(has_previous & has_next & ~exact, interpolated, result)
+
+
+def _fill_at_times(times, values, whens):
+    """
+    Value of the last entry with a value up to each of whens, for any
+    kind of values (see _column_values)
+
+    :return: list of arrays with the value (or NaN if there is no
+        entry) at each of whens
+    """
+    if values.dtype.kind == 'U':
+        with_value = np.flatnonzero(values != '')
+    else:
+        with_value = np.flatnonzero(
+            ~np.isnan(values.reshape(len(values), -1)).all(axis=1))
+    n_before = np.searchsorted(times, whens, side='right')
+    n_valid_before = np.searchsorted(with_value, n_before, side='left')
+    return [np.asarray([values[with_value[n - 1]]]) if n > 0 else np.array([np.nan])
+            for n in n_valid_before]
+
+
+def _column_values(column):
+    """Numpy array of the values of a correction table. Entries without
+    a value are NaN (numbers and arrays) or '' (file names)."""
+    values = column.tolist()
+    has_value = [v is not None and not (isinstance(v, float) and np.isnan(v))
+                 for v in values]
+    example = next((v for v, ok in zip(values, has_value) if ok), None)
+    if isinstance(example, str):
+        return np.array([v if ok else '' for v, ok in zip(values, has_value)], dtype=str)
+    if isinstance(example, (list, tuple, np.ndarray)):
+        empty = np.full(np.shape(example), np.nan)
+        return np.array([v if ok else empty for v, ok in zip(values, has_value)],
+                        dtype=np.float64)
+    return np.array([v if ok else np.nan for v, ok in zip(values, has_value)],
+                    dtype=np.float64)
+
+
 class GainsNotFoundError(Exception):
     """Fatal error if a None value is returned by the corrections"""
 
 
 def get_cmt_local_versions(global_version):
-    cmt = CorrectionsManagementServices()
+    cmt = get_shared_cmt()
     return cmt.get_local_versions(global_version)
 
 
@@ -0,0 +1,206 @@
+"""Snapshots of the corrections DB, to resolve corrections without
+database access (e.g. on grid jobs)
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytz
+import strax
+import straxen
+from straxen.corrections_services import _column_values
+from straxen.corrections_services import arrays_corrections
+from straxen.corrections_services import corrections_w_file
+from straxen.corrections_services import interpolate_corrections
+from straxen.corrections_services import per_pmt_corrections
+
+export, __all__ = strax.exporter()
+
+@export
+def make_cmt_snapshot(file_name, global_version='latest', run_ids=None,
+                      extra_versions=(), cmt=None):
+    """
+    Store everything needed to resolve the corrections of a CMT global
+    version in a single npz file, to be used with use_cmt_snapshot.
+    This needs access to the corrections DB.
+
+    :param file_name: name of the snapshot file (.npz)
+    :param global_version: CMT global version, or 'latest'
+    :param run_ids: list of run ids for which the start times are
+        stored, by default all runs
+    :param extra_versions: other local versions (e.g. 'ONLINE') to
+        store for every correction, where they exist
+    :param cmt: CorrectionsManagementServices to read the corrections
+        from, by default get_shared_cmt()
+    """
+    if cmt is None:
+        cmt = straxen.get_shared_cmt()
+    if global_version == 'latest':
+        global_version = cmt.global_versions[-1]
+    global_table = cmt._read_global_versions()
+    if global_version not in global_table:
+        raise ValueError(f'Global version {global_version} not found')
+    local_versions = dict(global_table[global_version].iloc[0])
+    global_name = 'global_xenonnt' if cmt.is_nt else 'global_xenon1t'
+
+    arrays = {}
+    corrections = {}
+    per_pmt_names = set()
+    for detector in per_pmt_corrections:
+        # Same selection as in CorrectionsManagementServices._read_correction
+        names = [name for name in global_table['global_ONLINE'].iloc[0].keys()
+                 if detector in name]
+        if not names:
+            continue
+        per_pmt_names.update(names)
+        versions = {local_versions[name] for name in names if name in local_versions}
+        stored = []
+        for version in sorted(versions | set(extra_versions)):
+            try:
+                times, values = cmt._read_corrections(names, version, global_name)
+            except KeyError:
+                if version in versions:
+                    raise
+                continue
+            arrays[f'{detector}/{version}/time'] = times
+            arrays[f'{detector}/{version}/values'] = values
+            stored.append(version)
+        corrections[detector] = dict(versions=stored, pmts=names)
+
+    for correction, version in local_versions.items():
+        if correction in per_pmt_names:
+            continue
+        df = cmt.interface.read(correction)
+        if df is None:
+            raise ValueError(f'No entries for {correction}')
+        stored = []
+        for version in sorted({version} | set(extra_versions)):
+            if version not in df:
+                continue
+            arrays[f'{correction}/{version}/time'] = (
+                df.index.tz_convert(None).values.astype('datetime64[ns]'))
+            arrays[f'{correction}/{version}/values'] = _column_values(df[version])
+            stored.append(version)
+        corrections[correction] = dict(versions=stored)
+
+    query = {}
+    if run_ids is not None:
+        query = {'number' if cmt.is_nt else 'name': {
+            '$in': [int(r) if cmt.is_nt else r for r in run_ids]}}
+    run_docs = list(cmt.collection.find(
+        query, {'number' if cmt.is_nt else 'name': 1, 'start': 1}))
+    arrays['runs/run_id'] = np.array(
+        [str(doc['number' if cmt.is_nt else 'name']) for doc in run_docs], dtype=str)
+    arrays['runs/start'] = np.array(
+        [_naive_utc(doc['start']) for doc in run_docs], dtype='datetime64[ns]')
+
+    metadata = dict(is_nt=cmt.is_nt,
+                    global_versions={global_version: local_versions},
+                    corrections=corrections)
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                     suffix='.npz')
+    try:
+        with os.fdopen(fd, mode='wb') as f:
+            np.savez_compressed(f, metadata=np.array(json.dumps(metadata)), **arrays)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+def _naive_utc(time):
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+@export
+class CorrectionsSnapshot(straxen.CorrectionsManagementServices):
+    """
+    CorrectionsManagementServices that reads the corrections from a
+    snapshot made with make_cmt_snapshot, rather than from the
+    corrections DB. Only the local versions in the snapshot, and the
+    runs in the snapshot, are available.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: snapshot file made with make_cmt_snapshot
+        """
+        with np.load(file_name, allow_pickle=False) as f:
+            self.metadata = json.loads(str(f['metadata']))
+            self.tables = {key: f[key] for key in f.files if key != 'metadata'}
+        self.file_name = file_name
+        self.is_nt = self.metadata['is_nt']
+        self.client = self.interface = self.collection = None
+        self.cache_namespace = (os.path.abspath(file_name), self.is_nt)
+        self.run_starts = dict(zip(self.tables.pop('runs/run_id'),
+                                   self.tables.pop('runs/start')))
+
+    def __repr__(self):
+        return f'CorrectionsSnapshot({self.file_name})'
+
+    def _read_correction(self, run_id, correction, version):
+        if version not in self.metadata['corrections'].get(correction, {}).get('versions', []):
+            raise ValueError(f'Version {version} of correction {correction} is not in '
+                             f'the snapshot {self.file_name}, please check')
+        when = self.get_start_time(run_id)
+        times = self.tables[f'{correction}/{version}/time']
+        values = self.tables[f'{correction}/{version}/values']
+        if correction in per_pmt_corrections:
+            return interpolate_corrections(
+                times, values, when,
+                how='fill' if version in 'ONLINE' else 'interpolate')
+
+        if (values.dtype.kind == 'f' and values.ndim == 1
+                and not (correction in corrections_w_file
+                         or correction in arrays_corrections
+                         or version in 'ONLINE')):
+            return interpolate_corrections(times[np.newaxis], values[np.newaxis], when)
+
+        # Last entry with a value, up to 'when'
+        if values.dtype.kind == 'U':
+            valid = values != ''
+        else:
+            valid = ~np.isnan(values.reshape(len(values), -1)).all(axis=1)
+        valid &= times <= np.datetime64(when.replace(tzinfo=None), 'ns')
+        if not np.any(valid):
+            return np.array([np.nan])
+        return values[np.flatnonzero(valid)[-1:]]
+
+    def _read_correction_table(self, correction, version):
+        if version not in self.metadata['corrections'].get(correction, {}).get('versions', []):
+            raise KeyError(f'{version} of {correction} is not in the snapshot')
+        return (self.tables[f'{correction}/{version}/time'],
+                self.tables[f'{correction}/{version}/values'])
+
+    def _read_start_time(self, run_id):
+        if self.is_nt:
+            # xenonnt use int
+            run_id = int(run_id)
+        if str(run_id) not in self.run_starts:
+            raise ValueError(f'run_id = {run_id} not in the snapshot {self.file_name}')
+        start = pd.Timestamp(self.run_starts[str(run_id)]).to_pydatetime()
+        return start.replace(tzinfo=pytz.utc)
+
+    def _read_global_versions(self):
+        return pd.DataFrame({global_version: [dict(local_versions)]
+                             for global_version, local_versions
+                             in self.metadata['global_versions'].items()})
+
+
+@export
+def use_cmt_snapshot(file_name):
+    """
+    Resolve all CMT corrections of this process (get_correction_from_cmt,
+    apply_cmt_version) from a snapshot made with make_cmt_snapshot, so
+    no database access is needed. The STRAXEN_CMT_SNAPSHOT environment
+    variable does the same.
+
+    :param file_name: snapshot file, or None to use the corrections DB
+        again
+    """
+    straxen.corrections_services.set_shared_cmt(
+        None if file_name is None else CorrectionsSnapshot(file_name))
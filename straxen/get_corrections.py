@@ -93,7 +93,7 @@ def get_correction_from_cmt(run_id, conf):
 
     elif isinstance(conf, tuple) and len(conf) == 3:
         model_conf, global_version, is_nt = conf[:3]
-        cmt = straxen.CorrectionsManagementServices(is_nt=is_nt)
+        cmt = straxen.get_shared_cmt(is_nt=is_nt)
         correction = cmt.get_corrections_config(run_id, conf[:2])
         if correction.size == 0:
             raise ValueError(f"Could not find a value for {model_conf} "
@@ -123,6 +123,44 @@ def get_correction_from_cmt(run_id, conf):
                          f"User specify {conf} please modify")
 
 
+@export
+def get_corrections_for_runs(run_ids, conf):
+    """
+    Get a correction for many runs at once. For CMT options
+    (correction, version, is_nt), every correction is read once and
+    evaluated at the start of all runs together. The results are also
+    cached, so get_correction_from_cmt for these runs does not query
+    the corrections DB anymore.
+
+    :param run_ids: list of run ids from runDB
+    :param conf: configuration, as for get_correction_from_cmt
+    :return: dict of the correction value(s) by run id
+    """
+    if is_cmt_option(conf) and len(conf) == 3:
+        model_conf, version, is_nt = conf
+        cmt = straxen.get_shared_cmt(is_nt=is_nt)
+        correction = straxen.corrections_services.gain_detectors.get(model_conf, model_conf)
+        if (model_conf in straxen.corrections_services.gain_detectors
+                or model_conf in single_value_corrections
+                or model_conf in arrays_corrections
+                or model_conf in corrections_w_file):
+            cmt.preload_corrections(run_ids, correction, version)
+    return {run_id: get_correction_from_cmt(run_id, conf) for run_id in run_ids}
+
+
+@strax.Context.add_method
+def preload_cmt_corrections(context: strax.Context, run_ids):
+    """
+    Read all CMT corrections of the context for many runs at once (see
+    get_corrections_for_runs), so setting up the plugins of these runs
+    does not query the corrections DB again.
+
+    :param run_ids: list of run ids
+    """
+    for conf in set(get_cmt_options(context).values()):
+        get_corrections_for_runs(strax.to_str_tuple(run_ids), conf)
+
+
 @export
 def get_cmt_resource(run_id, conf, fmt=''):
     """
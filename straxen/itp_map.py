@@ -1,8 +1,13 @@
+import hashlib
 import logging
 import gzip
 import json
+import os
 import re
+import shutil
+import tempfile
 
+import numba
 import numpy as np
 from scipy.spatial import cKDTree
 from scipy.interpolate import RectBivariateSpline, RegularGridInterpolator
@@ -17,42 +22,248 @@ class InterpolateAndExtrapolate:
     weighted averaging between nearby points.
     """
 
-    def __init__(self, points, values, neighbours_to_use=None, array_valued=False):
+    def __init__(self, points, values, neighbours_to_use=None, array_valued=False,
+                 kdtree=None, workers=1):
         """
         :param points: array (n_points, n_dims) of coordinates
         :param values: array (n_points) of values
         :param neighbours_to_use: Number of neighbouring points to use for
         averaging. Default is 2 * dimensions of points.
+        :param kdtree: cKDTree of the points, if already built
+        :param workers: number of threads for the neighbour query, -1 to
+        use all CPUs
         """
-        self.kdtree = cKDTree(points)
+        self.kdtree = cKDTree(points) if kdtree is None else kdtree
         self.values = values
         if neighbours_to_use is None:
             neighbours_to_use = points.shape[1] * 2
         self.neighbours_to_use = neighbours_to_use
+        self.workers = workers
         self.array_valued = array_valued
         if array_valued:
             self.n_dim = self.values.shape[-1]
+        # One row per point, also for values given on a (nested) grid.
+        # The compiled average does not check the indices, so this must
+        # match the number of points.
+        self._values = np.asarray(values, dtype=np.float64).reshape(self.kdtree.n, -1)
 
-    def __call__(self, points):
-        distances, indices = self.kdtree.query(points, self.neighbours_to_use)
+    def __call__(self, points, out=None):
+        """
+        :param points: array (n_points, n_dims) of positions, or a
+        single position (n_dims)
+        :param out: optional C-contiguous array (n_points) or
+        (n_points, n_values) to write the result in, e.g. a float32
+        array to save the conversion of the result
+        :returns: array (n_points) or (n_points, n_values) of values,
+        NaN for positions without neighbours (e.g. a NaN coordinate)
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        shape = (len(points), self.n_dim) if self.array_valued else (len(points),)
+        if out is None:
+            out = np.zeros(shape, dtype=np.float64)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError(f'Output buffer must be a C-contiguous array of shape {shape}')
+
+        # Points with a NaN coordinate have no neighbours (and recent
+        # scipy versions refuse to query them)
+        finite = np.all(np.isfinite(points), axis=-1)
+        if np.all(finite):
+            distances, indices = self._query(points)
+        else:
+            distances = np.full((len(points), self.neighbours_to_use), np.inf)
+            indices = np.zeros((len(points), self.neighbours_to_use), dtype=np.int64)
+            distances[finite], indices[finite] = self._query(points[finite])
+        _weighted_average(self._values,
+                          indices.reshape(len(points), -1),
+                          distances.reshape(len(points), -1),
+                          out.reshape(len(points), -1))
+        return out
+
+    def _query(self, points):
+        """Query the kdtree, the workers argument needs scipy >= 1.6"""
+        if self.workers == 1:
+            return self.kdtree.query(points, self.neighbours_to_use)
+        try:
+            return self.kdtree.query(points, self.neighbours_to_use, workers=self.workers)
+        except TypeError:
+            # Called n_jobs in older versions
+            return self.kdtree.query(points, self.neighbours_to_use, n_jobs=self.workers)
+
+
+@numba.njit(cache=True, nogil=True)
+def _weighted_average(values, indices, distances, out):
+    """Average of the values of the neighbours of each point, weighted
+    by the inverse distance. Neighbours at an infinite distance (which the
+    kdtree returns if it cannot find them) are skipped.
+    """
+    n_values = values.shape[1]
+    weights = np.zeros(indices.shape[1], dtype=np.float64)
+    for point_i in range(len(indices)):
+        weight_sum = 0.
+        for neighbour_i in range(indices.shape[1]):
+            distance = distances[point_i, neighbour_i]
+            if distance < np.inf:
+                weights[neighbour_i] = 1 / max(distance, 1e-6)
+            else:
+                weights[neighbour_i] = 0.
+            weight_sum += weights[neighbour_i]
+        if weight_sum == 0:
+            out[point_i, :] = np.nan
+            continue
+        for value_i in range(n_values):
+            value_sum = 0.
+            for neighbour_i in range(indices.shape[1]):
+                if weights[neighbour_i] > 0:
+                    value_sum += values[indices[point_i, neighbour_i], value_i] * weights[neighbour_i]
+            out[point_i, value_i] = value_sum / weight_sum
 
-        result = np.ones(len(points)) * float('nan')
-        if self.array_valued:
-            result = np.repeat(result.reshape(-1, 1), self.n_dim, axis=1)
 
-        # If one of the coordinates is NaN, the neighbour-query fails.
-        # If we don't filter these out, it would result in an IndexError
-        # as the kdtree returns an invalid index if it can't find neighbours.
-        valid = (distances < float('inf')).max(axis=-1)
+@export
+class MultilinearGridInterpolator:
+    """Multilinear interpolation of values on a rectangular grid.
+    Beyond its edges, positions are clamped to the grid by default, so
+    the map is constant there, like the inverse-distance weighting of
+    InterpolateAndExtrapolate is close to. With extrapolation='linear'
+    the map is extrapolated linearly instead (like
+    RegularGridInterpolator with fill_value=None).
+
+    The cell of a position is looked up in O(1) along the axes with
+    equally spaced grid points, and by a binary search along the others.
+    """
 
-        values = self.values[indices[valid]]
-        weights = 1 / np.clip(distances[valid], 1e-6, float('inf'))
-        if self.array_valued:
-            weights = np.repeat(weights, self.n_dim).reshape(values.shape)
+    def __init__(self, grid, values, extrapolation='clamp'):
+        """
+        :param grid: list of n_dims increasing arrays with the grid
+        coordinates along each axis
+        :param values: array (*grid_shape) of values, or array
+        (*grid_shape, n_values) for array valued maps
+        :param extrapolation: 'clamp' to use the value at the edge of
+        the grid beyond it, or 'linear' to extrapolate linearly
+        """
+        if extrapolation not in ('clamp', 'linear'):
+            raise ValueError(f'Extrapolation {extrapolation} is not supported, '
+                             f'use "clamp" or "linear"')
+        self.extrapolation = extrapolation
+        grid_shape = tuple(len(g) for g in grid)
+        self.n_dims = len(grid)
+        self.array_valued = values.ndim == self.n_dims + 1
+        if values.shape[:self.n_dims] != grid_shape:
+            raise ValueError(f'Values of shape {values.shape} do not match '
+                             f'the grid of shape {grid_shape}')
+
+        self.grid_shape = np.array(grid_shape, dtype=np.int64)
+        self.grid = np.full((self.n_dims, max(grid_shape)), np.nan)
+        self.uniform = np.zeros(self.n_dims, dtype=np.bool_)
+        for dim, g in enumerate(grid):
+            g = np.asarray(g, dtype=np.float64)
+            if np.any(np.diff(g) <= 0):
+                raise ValueError('Grid coordinates must be strictly increasing')
+            self.grid[dim, :len(g)] = g
+            step = np.diff(g)
+            self.uniform[dim] = len(step) > 0 and np.allclose(step, step.mean(), rtol=1e-9, atol=0)
+        self.values = np.ascontiguousarray(
+            values.reshape(np.prod(grid_shape), -1), dtype=np.float64)
+
+    @classmethod
+    def from_points(cls, points, values, **kwargs):
+        """
+        Make the interpolator from a list of points and values, if the
+        points are all points of a rectangular grid (in any order).
+        Otherwise return None.
 
-        result[valid] = np.average(values, weights=weights,
-                                   axis=-2 if self.array_valued else -1)
-        return result
+        :param points: array (n_points, n_dims) of coordinates
+        :param values: array (n_points) or (n_points, n_values) of values
+        :param kwargs: passed to the interpolator, e.g. extrapolation
+        """
+        points = np.asarray(points, dtype=np.float64)
+        grid = [np.unique(points[:, dim]) for dim in range(points.shape[1])]
+        grid_shape = tuple(len(g) for g in grid)
+        if np.prod(grid_shape) != len(points):
+            return None
+        node_i = np.ravel_multi_index(
+            [np.searchsorted(g, points[:, dim]) for dim, g in enumerate(grid)],
+            grid_shape)
+        if len(np.unique(node_i)) != len(points):
+            return None
+        grid_values = np.zeros_like(values, dtype=np.float64)
+        grid_values[node_i] = values
+        return cls(grid, grid_values.reshape(grid_shape + values.shape[1:]), **kwargs)
+
+    def __call__(self, points, out=None):
+        """
+        :param points: array (n_points, n_dims) of positions
+        :param out: optional C-contiguous array (n_points) or
+        (n_points, n_values) to write the result in
+        :returns: array (n_points) or (n_points, n_values) of values,
+        NaN for positions with a non-finite coordinate
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.n_dims)
+        shape = (len(points), self.values.shape[1]) if self.array_valued else (len(points),)
+        if out is None:
+            out = np.zeros(shape, dtype=np.float64)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError(f'Output buffer must be a C-contiguous array of shape {shape}')
+        _multilinear_interpolate(points, self.grid, self.grid_shape, self.uniform,
+                                 self.values, out.reshape(len(points), -1),
+                                 self.extrapolation == 'clamp')
+        return out
+
+
+@numba.njit(cache=True, nogil=True)
+def _multilinear_interpolate(points, grid, grid_shape, uniform, values, out, clamp):
+    n_dims = len(grid_shape)
+    strides = np.ones(n_dims, dtype=np.int64)
+    for dim in range(n_dims - 2, -1, -1):
+        strides[dim] = strides[dim + 1] * grid_shape[dim + 1]
+    lower = np.zeros(n_dims, dtype=np.int64)
+    fraction = np.zeros(n_dims, dtype=np.float64)
+
+    for point_i in range(len(points)):
+        valid = True
+        for dim in range(n_dims):
+            x = points[point_i, dim]
+            n = grid_shape[dim]
+            if not np.isfinite(x):
+                valid = False
+                break
+            if n == 1:
+                lower[dim] = 0
+                fraction[dim] = 0.
+                continue
+            if clamp:
+                x = min(max(x, grid[dim, 0]), grid[dim, n - 1])
+            if uniform[dim]:
+                u = (x - grid[dim, 0]) / (grid[dim, n - 1] - grid[dim, 0]) * (n - 1)
+                # Clip before casting, beyond the grid we extrapolate anyway
+                i = int(np.floor(min(max(u, 0.), n - 2.)))
+            else:
+                i = np.searchsorted(grid[dim, :n], x, side='right') - 1
+            i = min(max(i, 0), n - 2)
+            lower[dim] = i
+            fraction[dim] = (x - grid[dim, i]) / (grid[dim, i + 1] - grid[dim, i])
+
+        if not valid:
+            out[point_i, :] = np.nan
+            continue
+
+        out[point_i, :] = 0
+        for corner in range(2 ** n_dims):
+            weight = 1.
+            node_i = 0
+            in_grid = True
+            for dim in range(n_dims):
+                if corner >> dim & 1:
+                    # Axes with a single grid point have no upper corner
+                    in_grid &= grid_shape[dim] > 1
+                    weight *= fraction[dim]
+                    node_i += (lower[dim] + 1) * strides[dim]
+                else:
+                    weight *= 1 - fraction[dim]
+                    node_i += lower[dim] * strides[dim]
+            if not in_grid:
+                continue
+            for value_i in range(values.shape[1]):
+                out[point_i, value_i] += weight * values[node_i, value_i]
 
 
 @export
@@ -87,6 +298,11 @@ class InterpolatingMap:
     Extra support includes RectBivariateSpline, RegularGridInterpolator in scipy
     by pass keyword argument like
         method='RectBivariateSpline'
+    For maps on a rectangular grid (a gridspec, or points that make up a
+    full grid), method='MultilinearGrid' interpolates linearly with a
+    compiled lookup of the grid cell. Beyond the edges it takes the value
+    at the edge, or extrapolates linearly with extrapolation='linear'.
+    These interpolators also take an out=buffer argument.
 
     The interpolators are called with
         'positions' :  [[x1, y1], [x2, y2], [x3, y3], [x4, y4], ...]
@@ -95,7 +311,70 @@ class InterpolatingMap:
     metadata_field_names = ['timestamp', 'description', 'coordinate_system',
                             'name', 'irregular', 'compressed', 'quantized']
 
-    def __init__(self, data, method='WeightedNearestNeighbors', **kwargs):
+    def __init__(self, data, method='WeightedNearestNeighbors', cache_dir=None, **kwargs):
+        """
+        :param data: dictionary, json string or gzipped json bytes of the map
+        :param method: interpolation method, see above
+        :param cache_dir: directory for an on-disk cache of the decoded
+            map, by default the STRAXEN_MAP_CACHE_DIR environment variable
+            (no cache if it is not set). Only maps given as (gzipped) json
+            are cached, by the hash of their content.
+        :param kwargs: passed to the interpolators
+        """
+        self.method = method
+        self._kwargs = kwargs
+        self._kdtree = None
+        if cache_dir is None:
+            cache_dir = os.environ.get('STRAXEN_MAP_CACHE_DIR')
+        cache_path = None
+        if cache_dir and isinstance(data, (str, bytes)):
+            cache_path = self._cache_path(data, cache_dir)
+        if cache_path is None or not self._load_cache(cache_path):
+            self._decode(data)
+            if cache_path is not None:
+                self._save_cache(cache_path)
+        csys = self.coordinate_system
+        self.interpolators = {}
+
+        log = logging.getLogger('InterpolatingMap')
+        log.debug('Map name: %s' % self.data.get('name',
+                                                 "NO NAME?!"))
+        log.debug('Map description:\n    ' +
+                  re.sub(r'\n', r'\n    ', self.data.get('description',
+                                                         "NO DESCRIPTION?!")))
+        log.debug("Map names found: %s" % self.map_names)
+
+        for map_name in self.map_names:
+            # Specify dtype float to set Nones to nan
+            map_data = np.asarray(self.data[map_name], dtype=float)
+            array_valued = len(map_data.shape) == self.dimensions + 1
+
+            if self.dimensions == 0:
+                # 0 D -- placeholder maps which take no arguments
+                # and always return a single value
+                def itp_fun(positions):
+                    return np.array([map_data])
+
+            elif method == 'RectBivariateSpline':
+                itp_fun = self._rect_bivariate_spline(csys, map_data, array_valued, **kwargs)
+
+            elif method == 'RegularGridInterpolator':
+                itp_fun = self._regular_grid_interpolator(csys, map_data, array_valued, **kwargs)
+
+            elif method == 'WeightedNearestNeighbors':
+                itp_fun = self._weighted_nearest_neighbors(
+                    csys, map_data, array_valued, kdtree=self.kdtree, **kwargs)
+
+            elif method == 'MultilinearGrid':
+                itp_fun = self._multilinear_grid(csys, map_data, array_valued, **kwargs)
+
+            else:
+                raise ValueError(f'Interpolation method {method} is not supported')
+
+            self.interpolators[map_name] = itp_fun
+
+    def _decode(self, data):
+        """Parse, decompress and dequantize the map"""
         if isinstance(data, bytes):
             data = gzip.decompress(data).decode()
         if isinstance(data, (str, bytes)):
@@ -132,49 +411,98 @@ class InterpolatingMap:
             self.dimensions = len(csys[0])
 
         self.coordinate_system = csys
-        self.interpolators = {}
         self.map_names = sorted([k for k in self.data.keys()
                                  if k not in self.metadata_field_names])
 
-        log = logging.getLogger('InterpolatingMap')
-        log.debug('Map name: %s' % self.data.get('name',
-                                                 "NO NAME?!"))
-        log.debug('Map description:\n    ' +
-                  re.sub(r'\n', r'\n    ', self.data.get('description',
-                                                         "NO DESCRIPTION?!")))
-        log.debug("Map names found: %s" % self.map_names)
-
-        for map_name in self.map_names:
-            # Specify dtype float to set Nones to nan
-            map_data = np.array(self.data[map_name], dtype=np.float)
-            array_valued = len(map_data.shape) == self.dimensions + 1
-
-            if self.dimensions == 0:
-                # 0 D -- placeholder maps which take no arguments
-                # and always return a single value
-                def itp_fun(positions):
-                    return np.array([map_data])
-
-            elif method == 'RectBivariateSpline':
-                itp_fun = self._rect_bivariate_spline(csys, map_data, array_valued, **kwargs)
-
-            elif method == 'RegularGridInterpolator':
-                itp_fun = self._regular_grid_interpolator(csys, map_data, array_valued, **kwargs)
-
-            elif method == 'WeightedNearestNeighbors':
-                itp_fun = self._weighted_nearest_neighbors(csys, map_data, array_valued, **kwargs)
-
-            else:
-                raise ValueError(f'Interpolation method {method} is not supported')
-
-            self.interpolators[map_name] = itp_fun
+    @property
+    def kdtree(self):
+        """cKDTree of the coordinate system, shared by all maps"""
+        if self._kdtree is None:
+            self._kdtree = cKDTree(self.coordinate_system)
+        return self._kdtree
+
+    # Increase when changing the layout of the on-disk cache
+    _cache_version = 1
+
+    @classmethod
+    def _cache_path(cls, data, cache_dir):
+        if isinstance(data, str):
+            data = data.encode()
+        content_hash = hashlib.sha1(data).hexdigest()
+        return os.path.join(
+            cache_dir, strax.deterministic_hash((cls._cache_version, content_hash)))
+
+    def _load_cache(self, cache_path):
+        """Open the decoded map in cache_path. The arrays are memory
+        mapped (copy-on-write), so this takes hardly any time or memory.
+
+        :return: True if the map was in the cache
+        """
+        if not os.path.exists(cache_path):
+            return False
+        try:
+            with open(os.path.join(cache_path, 'metadata.json'), mode='r') as f:
+                metadata = json.load(f)
+            self.dimensions = metadata['dimensions']
+            self.map_names = metadata['map_names']
+            self.coordinate_system = np.load(
+                os.path.join(cache_path, 'coordinate_system.npy'), mmap_mode='c')
+            self.data = metadata['data']
+            self.data.setdefault('coordinate_system', self.coordinate_system)
+            for map_i, map_name in enumerate(self.map_names):
+                self.data[map_name] = np.load(
+                    os.path.join(cache_path, f'map_{map_i}.npy'), mmap_mode='c')
+        except (OSError, ValueError, KeyError) as e:
+            logging.getLogger('InterpolatingMap').warning(
+                f'Cannot load map from {cache_path}, decoding it again: {e}')
+            return False
+        return True
+
+    def _save_cache(self, cache_path):
+        """Store the decoded map in cache_path, for _load_cache. The map
+        is written to a temporary directory first, so processes that
+        open the map at the same time never see an incomplete cache.
+        """
+        data = {k: v for k, v in self.data.items()
+                if k not in self.map_names and k != 'coordinate_system'}
+        csys = self.data['coordinate_system']
+        if len(csys) and isinstance(csys[0][0], str):
+            # A gridspec is small, store as is
+            data['coordinate_system'] = csys
+        metadata = dict(dimensions=self.dimensions,
+                        map_names=self.map_names,
+                        data=data)
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            temp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+            with open(os.path.join(temp_path, 'metadata.json'), mode='w') as f:
+                json.dump(metadata, f)
+            np.save(os.path.join(temp_path, 'coordinate_system.npy'),
+                    self.coordinate_system)
+            for map_i, map_name in enumerate(self.map_names):
+                np.save(os.path.join(temp_path, f'map_{map_i}.npy'),
+                        np.asarray(self.data[map_name], dtype=float))
+        except (OSError, TypeError) as e:
+            logging.getLogger('InterpolatingMap').warning(
+                f'Cannot store map in {cache_path}: {e}')
+            if temp_path is not None:
+                shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        try:
+            os.rename(temp_path, cache_path)
+        except OSError:
+            # Stored by another process in the meantime
+            shutil.rmtree(temp_path, ignore_errors=True)
 
-    def __call__(self, *args, map_name='map'):
+    def __call__(self, *args, map_name='map', **kwargs):
         """Returns the value of the map at the position given by coordinates
         :param positions: array (n_dim) or (n_points, n_dim) of positions
         :param map_name: Name of the map to use. Default is 'map'.
+        :param kwargs: passed to the interpolator, e.g. out=buffer for
+            the MultilinearGrid method
         """
-        return self.interpolators[map_name](*args)
+        return self.interpolators[map_name](*args, **kwargs)
 
     @staticmethod
     def _rect_bivariate_spline(csys, map_data, array_valued, **kwargs):
@@ -216,6 +544,18 @@ class InterpolatingMap:
 
         return InterpolateAndExtrapolate(csys, map_data, array_valued=array_valued, **kwargs)
 
+    @staticmethod
+    def _multilinear_grid(csys, map_data, array_valued, **kwargs):
+        # Point maps of array values come as (n_points, n_values)
+        if array_valued or map_data.size != len(csys):
+            map_data = map_data.reshape((len(csys), -1))
+        else:
+            map_data = map_data.reshape(-1)
+        itp_fun = MultilinearGridInterpolator.from_points(csys, map_data, **kwargs)
+        if itp_fun is None:
+            raise ValueError('MultilinearGrid interpolates maps on a rectangular grid only')
+        return itp_fun
+
     def scale_coordinates(self, scaling_factor, map_name='map'):
         """Scales the coordinate system by the specified factor
         :params scaling_factor: array (n_dim) of scaling factors if different or single scalar.
@@ -231,14 +571,21 @@ class InterpolatingMap:
             self._sf = [scaling_factor] * self.dimensions
 
         alt_csys = self.coordinate_system
-        for i, gp in enumerate(self.coordinate_system):
-            alt_csys[i] = [gc * k for (gc, k) in zip(gp, self._sf)]
+        # The kdtree of the unscaled coordinate system is no longer valid
+        self._kdtree = None
+        alt_csys[:] = alt_csys * np.asarray(self._sf)
 
         map_data = np.array(self.data[map_name])
         array_valued = len(map_data.shape) == self.dimensions + 1
         if array_valued:
             map_data = map_data.reshape((-1, map_data.shape[-1]))
-        itp_fun = InterpolateAndExtrapolate(points=np.array(alt_csys),
-                                            values=np.array(map_data),
-                                            array_valued=array_valued)
+        if self.method == 'MultilinearGrid':
+            itp_fun = self._multilinear_grid(np.array(alt_csys), map_data, array_valued,
+                                             **self._kwargs)
+        else:
+            kwargs = self._kwargs if self.method == 'WeightedNearestNeighbors' else {}
+            itp_fun = InterpolateAndExtrapolate(points=np.array(alt_csys),
+                                                values=np.array(map_data),
+                                                array_valued=array_valued,
+                                                **kwargs)
         self.interpolators[map_name] = itp_fun
@@ -1,5 +1,7 @@
 import os
 import tempfile
+import threading
+import time
 from datetime import datetime
 from warnings import warn
 import pytz
@@ -14,6 +16,14 @@ from straxen import uconfig
 
 export, __all__ = exporter()
 
+# Index of the files in GridFS, by (collection, config_identifier), as
+# (time of the listing, {config_name: document of the last version})
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+# Shared MongoDownloader, see get_shared_downloader
+_shared_downloader = None
+_shared_downloader_lock = threading.Lock()
+
 
 @export
 class GridFsInterface:
@@ -32,6 +42,7 @@ class GridFsInterface:
                  file_database='files',
                  config_identifier='config_name',
                  collection=None,
+                 index_ttl=600,
                  ):
         """
         GridFsInterface
@@ -46,7 +57,10 @@ class GridFsInterface:
             PyMongo DataName Collection to bypass normal initiation
             using utilix. Should be an object of the form:
                 pymongo.MongoClient(..).DATABASE_NAME.COLLECTION_NAME
+        :param index_ttl: float, seconds after which the file_index is
+            listed again from the database
         """
+        self.index_ttl = index_ttl
         if collection is None:
             if not readonly:
                 # We want admin access to start writing data!
@@ -137,6 +151,38 @@ class GridFsInterface:
         query = {'md5': self.compute_md5(abs_path)}
         return self.collection.count_documents(query) > 0
 
+    def file_index(self, refresh=False):
+        """
+        Index of the files stored in the database, shared by all
+        instances in this process that use the same collection. The
+        index is listed again if it is older than index_ttl seconds.
+
+        :param refresh: bool, list the files again regardless of the age
+            of the index
+        :return: dict, {config_name: dict(md5, length, uploadDate)} of
+            the last version of each file
+        """
+        key = (self.collection, self.config_identifier)
+        with _file_indexes_lock:
+            listed_at, index = _file_indexes.get(key, (None, None))
+            if (refresh or index is None
+                    or time.monotonic() - listed_at > self.index_ttl):
+                index = {}
+                for doc in self.collection.find(
+                        {self.config_identifier: {'$exists': True}},
+                        projection={self.config_identifier: 1, 'md5': 1,
+                                    'length': 1, 'uploadDate': 1, '_id': 0}
+                ).sort('uploadDate', 1):
+                    # Later uploads of the same config overwrite earlier ones
+                    index[doc.pop(self.config_identifier)] = doc
+                _file_indexes[key] = (time.monotonic(), index)
+            return index
+
+    def clear_file_index(self):
+        """Forget the index of this collection, e.g. after uploading"""
+        with _file_indexes_lock:
+            _file_indexes.pop((self.collection, self.config_identifier), None)
+
     def test_find(self):
         """
         Test the connection to the self.collection to see if we can 
@@ -147,19 +193,14 @@ class GridFsInterface:
 
     def list_files(self):
         """
-        Get a complete list of files that are stored in the database
+        Get a complete list of files that are stored in the database,
+        from the (cached) file_index
 
         :return: list, list of the names of the items stored in this
             database
 
         """
-        return [doc[self.config_identifier]
-                for doc in
-                self.collection.find(
-                    projection=
-                    {self.config_identifier: 1})
-                if self.config_identifier in doc
-                ]
+        return list(self.file_index())
 
     @staticmethod
     def compute_md5(abs_path):
@@ -248,6 +289,7 @@ class MongoUploader(GridFsInterface):
         print(f'uploading {config}')
         with open(abs_path, 'rb') as file:
             self.grid_fs.put(file, **doc)
+        self.clear_file_index()
 
 
 @export
@@ -290,57 +332,79 @@ class MongoDownloader(GridFsInterface):
 
         :return: str, the absolute path of the file requested
         """
-        if self.config_exists(config_name):
-            # Query by name
-            query = self.get_query_config(config_name)
-            try:
-                # This could return multiple since we upload files if 
-                # they have changed again! Therefore just take the last.
-                fs_object = self.grid_fs.get_last_version(**query)
-            except gridfs.NoFile as e:
-                raise CouldNotLoadError(
-                    f'{config_name} cannot be downloaded from GridFs') from e
-
-            # Ok, so we can open it. We will store the file under it's 
-            # md5-hash as that allows to easily compare if we already 
-            # have the correct file.
-            if human_readable_file_name:
-                target_file_name = config_name
-            else:
-                target_file_name = fs_object.md5
-
-            for cache_folder in self.storage_options:
-                possible_path = os.path.join(cache_folder, target_file_name)
-                if os.path.exists(possible_path):
-                    # Great! This already exists. Let's just return
-                    # where it is stored.
-                    return possible_path
-
-            # Apparently the file does not exist, let's find a place to
-            # store the file and download it.
-            store_files_at = self._check_store_files_at(self.storage_options)
-            destination_path = os.path.join(store_files_at, target_file_name)
-
-            # Let's open a temporary directory, download the file, and
-            # try moving it to the destination_path. This prevents
-            # simultaneous writes of the same file.
-            with tempfile.TemporaryDirectory() as temp_directory_name:
-                temp_path = os.path.join(temp_directory_name, target_file_name)
-
-                with open(temp_path, 'wb') as stored_file:
-                    # This is were we do the actual downloading!
-                    warn(f'Downloading {config_name} to {destination_path}')
-                    stored_file.write(fs_object.read())
-
-                if not os.path.exists(destination_path):
-                    # Move the file to the place we want to store it.
-                    move(temp_path, destination_path)
-            return destination_path
-
-        else:
+        file_doc = self.file_index().get(config_name)
+        if file_doc is None:
+            # Perhaps it was uploaded after the index was listed
+            file_doc = self.file_index(refresh=True).get(config_name)
+        if file_doc is None:
             raise ValueError(f'Config {config_name} cannot be downloaded '
                              f'since it is not stored')
 
+        # We store the file under it's md5-hash as that allows to easily
+        # compare if we already have the correct file.
+        if human_readable_file_name or not file_doc.get('md5'):
+            target_file_name = config_name
+        else:
+            target_file_name = file_doc['md5']
+
+        possible_path = self._stored_file(target_file_name)
+        if possible_path is not None:
+            return possible_path
+
+        # Query by name
+        query = self.get_query_config(config_name)
+        try:
+            # This could return multiple since we upload files if
+            # they have changed again! Therefore just take the last.
+            fs_object = self.grid_fs.get_last_version(**query)
+        except gridfs.NoFile as e:
+            raise CouldNotLoadError(
+                f'{config_name} cannot be downloaded from GridFs') from e
+
+        if (not human_readable_file_name and fs_object.md5
+                and fs_object.md5 != file_doc.get('md5')):
+            # The config was uploaded again after the index was listed.
+            # Store the file under the md5 of what we download.
+            self.file_index(refresh=True)
+            target_file_name = fs_object.md5
+            possible_path = self._stored_file(target_file_name)
+            if possible_path is not None:
+                return possible_path
+
+        # Apparently the file does not exist, let's find a place to
+        # store the file and download it.
+        store_files_at = self._check_store_files_at(self.storage_options)
+        destination_path = os.path.join(store_files_at, target_file_name)
+
+        # Let's open a temporary directory, download the file, and
+        # try moving it to the destination_path. This prevents
+        # simultaneous writes of the same file.
+        with tempfile.TemporaryDirectory() as temp_directory_name:
+            temp_path = os.path.join(temp_directory_name, target_file_name)
+
+            with open(temp_path, 'wb') as stored_file:
+                # This is were we do the actual downloading!
+                warn(f'Downloading {config_name} to {destination_path}')
+                stored_file.write(fs_object.read())
+
+            if not os.path.exists(destination_path):
+                # Move the file to the place we want to store it.
+                move(temp_path, destination_path)
+        return destination_path
+
+    def _stored_file(self, target_file_name):
+        """
+        :return: str, the path of target_file_name in the first of the
+            storage_options where it is stored, or None
+        """
+        for cache_folder in self.storage_options:
+            possible_path = os.path.join(cache_folder, target_file_name)
+            if os.path.exists(possible_path):
+                # Great! This already exists. Let's just return
+                # where it is stored.
+                return possible_path
+        return None
+
     def get_abs_path(self, config_name):
         return self.download_single(config_name)
 
@@ -379,6 +443,19 @@ class MongoDownloader(GridFsInterface):
             f'{cache_folder_alternatives}')
 
 
+@export
+def get_shared_downloader():
+    """
+    MongoDownloader shared by get_resource, so the connection and the
+    file_index are only set up once per process
+    """
+    global _shared_downloader
+    with _shared_downloader_lock:
+        if _shared_downloader is None:
+            _shared_downloader = MongoDownloader()
+        return _shared_downloader
+
+
 class CouldNotLoadError(Exception):
     """Raise if we cannot load this kind of data"""
     # Disable the inspection of 'Unnecessary pass statement'
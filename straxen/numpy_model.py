@@ -0,0 +1,240 @@
+"""Evaluate (small) Keras models with numpy, without tensorflow"""
+import json
+import os
+import tempfile
+
+import numpy as np
+import strax
+from straxen.common import _apply_umask
+
+export, __all__ = strax.exporter()
+
+
+def _softmax(x):
+    x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return x / np.sum(x, axis=-1, keepdims=True)
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def _elu(x, alpha=1.):
+    return np.where(x > 0, x, alpha * np.expm1(np.minimum(x, 0)))
+
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': _elu,
+    'selu': lambda x: np.float32(1.0507009873554805) * _elu(x, np.float32(1.6732632423543772)),
+    'tanh': np.tanh,
+    'sigmoid': _sigmoid,
+    'softplus': lambda x: np.logaddexp(x, 0),
+    'softsign': lambda x: x / (1 + np.abs(x)),
+    'swish': lambda x: x * _sigmoid(x),
+    'softmax': _softmax,
+}
+
+
+def _activation(x, config):
+    activation = config.get('activation', 'linear')
+    return _ACTIVATIONS[activation](x)
+
+
+def _dense(x, config, weights):
+    x = x @ weights[0]
+    if config.get('use_bias', True):
+        x += weights[1]
+    return _activation(x, config)
+
+
+def _padding(x, config, spatial_axes):
+    """Zero-pad x along the spatial axes for padding='same'"""
+    if config.get('padding', 'valid') == 'valid':
+        return x
+    if config['padding'] != 'same':
+        raise NotImplementedError(f"Padding {config['padding']} is not supported")
+    pad_width = [(0, 0)] * x.ndim
+    for axis, size, stride in zip(spatial_axes, config['kernel_size'], config['strides']):
+        n_out = -(-x.shape[axis] // stride)
+        pad = max((n_out - 1) * stride + size - x.shape[axis], 0)
+        pad_width[axis] = (pad // 2, pad - pad // 2)
+    return np.pad(x, pad_width)
+
+
+def _windows(x, config, spatial_axes, window_shape):
+    """Sliding windows of window_shape over the spatial axes of x, with
+    the window axes last. A read-only view of x, like numpy's
+    sliding_window_view (which needs numpy >= 1.20) with strides."""
+    shape = list(x.shape)
+    strides = list(x.strides)
+    for axis, size, stride in zip(spatial_axes, window_shape, config['strides']):
+        shape[axis] = (x.shape[axis] - size) // stride + 1
+        strides[axis] = x.strides[axis] * stride
+    return np.lib.stride_tricks.as_strided(
+        x,
+        shape=tuple(shape) + tuple(window_shape),
+        strides=tuple(strides) + tuple(x.strides[axis] for axis in spatial_axes),
+        writeable=False)
+
+
+def _conv(x, config, weights):
+    """Conv1D and Conv2D, for channels_last data"""
+    n_spatial = len(config['kernel_size'])
+    if config.get('data_format', 'channels_last') != 'channels_last':
+        raise NotImplementedError('Only channels_last convolutions are supported')
+    if any(d != 1 for d in config.get('dilation_rate', (1,))) or config.get('groups', 1) != 1:
+        raise NotImplementedError('Dilated and grouped convolutions are not supported')
+    spatial_axes = tuple(range(1, n_spatial + 1))
+    x = _padding(x, config, spatial_axes)
+    # (n, *out_spatial, in_channels, *kernel_size)
+    windows = _windows(x, config, spatial_axes, config['kernel_size'])
+    # Kernel is (*kernel_size, in_channels, out_channels)
+    kernel = np.moveaxis(weights[0], n_spatial, 0)
+    x = np.tensordot(windows, kernel, axes=n_spatial + 1)
+    if config.get('use_bias', True):
+        x += weights[1]
+    return _activation(x, config)
+
+
+def _pooling(reduce):
+    def pool(x, config, weights):
+        n_spatial = len(config['pool_size'])
+        config = dict(config, kernel_size=config['pool_size'])
+        if config.get('strides') is None:
+            config['strides'] = config['pool_size']
+        spatial_axes = tuple(range(1, n_spatial + 1))
+        if config.get('padding', 'valid') != 'valid':
+            raise NotImplementedError('Only pooling with padding=valid is supported')
+        windows = _windows(x, config, spatial_axes, config['pool_size'])
+        return reduce(windows, axis=tuple(range(-n_spatial, 0)))
+    return pool
+
+
+def _batch_normalization(x, config, weights):
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get('scale', True) else np.float32(1)
+    beta = weights.pop(0) if config.get('center', True) else np.float32(0)
+    mean, variance = weights
+    axis = config.get('axis', -1)
+    if isinstance(axis, (list, tuple)):
+        (axis,) = axis
+    shape = [1] * x.ndim
+    shape[axis] = -1
+    scale = gamma / np.sqrt(variance + np.float32(config.get('epsilon', 1e-3)))
+    return (x - mean.reshape(shape)) * np.reshape(scale, shape) + np.reshape(beta, shape)
+
+
+def _leaky_relu(x, config, weights):
+    # The slope is called alpha in Keras 2 and negative_slope in Keras 3
+    slope = config.get('negative_slope', config.get('alpha', 0.3))
+    return np.where(x > 0, x, np.float32(slope) * x)
+
+
+_LAYERS = {
+    'Dense': _dense,
+    'Conv1D': _conv,
+    'Conv2D': _conv,
+    'MaxPooling1D': _pooling(np.max),
+    'MaxPooling2D': _pooling(np.max),
+    'AveragePooling1D': _pooling(np.mean),
+    'AveragePooling2D': _pooling(np.mean),
+    'BatchNormalization': _batch_normalization,
+    'Activation': lambda x, config, weights: _activation(x, config),
+    'LeakyReLU': _leaky_relu,
+    'Flatten': lambda x, config, weights: x.reshape(len(x), -1),
+    'Reshape': lambda x, config, weights: x.reshape(len(x), *config['target_shape']),
+    # Layers that do nothing at inference
+    'InputLayer': lambda x, config, weights: x,
+    'Dropout': lambda x, config, weights: x,
+    'GaussianNoise': lambda x, config, weights: x,
+}
+
+
+@export
+class NumpyModel:
+    """
+    Evaluate a Keras model, whose layers form a chain, with numpy in
+    float32. Supported are the Dense, Conv1D/2D, pooling,
+    BatchNormalization, Activation, LeakyReLU, Flatten, Reshape and
+    Dropout layers. Graph convolution layers (as in the GCN position
+    reconstruction model) are not supported.
+
+    Convert a model with NumpyModel.from_keras(model) (this needs
+    tensorflow), save it to an npz file, and load it with
+    NumpyModel.load(file_name) wherever tensorflow is not available.
+    """
+
+    def __init__(self, layers):
+        """
+        :param layers: list of (class_name, config, weights) of the
+            layers, as given by Keras layer.__class__.__name__,
+            layer.get_config() and layer.get_weights()
+        """
+        self.layers = []
+        for class_name, config, weights in layers:
+            if class_name not in _LAYERS:
+                raise NotImplementedError(f'{class_name} layers are not supported')
+            activation = config.get('activation', 'linear')
+            if activation not in _ACTIVATIONS:
+                raise NotImplementedError(f'{activation} activation is not supported')
+            self.layers.append((class_name, config,
+                                [np.asarray(w, dtype=np.float32) for w in weights]))
+
+    @classmethod
+    def from_keras(cls, model):
+        """Convert a keras model"""
+        return cls([(layer.__class__.__name__, layer.get_config(), layer.get_weights())
+                    for layer in model.layers])
+
+    @classmethod
+    def load(cls, file_name):
+        """Load the model from an npz file written by save"""
+        with np.load(file_name, allow_pickle=False) as f:
+            layers = json.loads(str(f['layers']))
+            return cls([(class_name, config,
+                         [f[f'layer_{layer_i}_weight_{weight_i}'] for weight_i in range(n_weights)])
+                        for layer_i, (class_name, config, n_weights) in enumerate(layers)])
+
+    def save(self, file_name):
+        """Save the model to an npz file. The file is written under a
+        temporary name first, so other processes never read a partial
+        file."""
+        layers = []
+        arrays = {}
+        for layer_i, (class_name, config, weights) in enumerate(self.layers):
+            layers.append((class_name, config, len(weights)))
+            for weight_i, w in enumerate(weights):
+                arrays[f'layer_{layer_i}_weight_{weight_i}'] = w
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                         suffix='.npz')
+        try:
+            with os.fdopen(fd, mode='wb') as f:
+                np.savez(f, layers=np.array(json.dumps(layers)), **arrays)
+            # mkstemp makes the file readable only for the user
+            os.chmod(temp_name, _apply_umask(0o666))
+            os.replace(temp_name, file_name)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+    def predict(self, x, batch_size=4096):
+        """
+        :param x: array (n_samples, *input_shape) of inputs
+        :param batch_size: number of samples evaluated at once, to limit
+            the memory for intermediate results
+        :return: float32 array (n_samples, *output_shape)
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) <= batch_size:
+            return self._predict(x)
+        return np.concatenate([self._predict(x[i:i + batch_size])
+                               for i in range(0, len(x), batch_size)])
+
+    __call__ = predict
+
+    def _predict(self, x):
+        for class_name, config, weights in self.layers:
+            x = _LAYERS[class_name](x, config, weights)
+        return x.astype(np.float32, copy=False)
@@ -3,12 +3,18 @@ import os
 import shutil
 import warnings
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from immutabledict import immutabledict
 import numpy as np
 import numba
 
 import strax
 
+try:
+    import inotify_simple
+except ModuleNotFoundError:
+    inotify_simple = None
+
 export, __all__ = strax.exporter()
 __all__ += ['ARTIFICIAL_DEADTIME_CHANNEL']
 
@@ -56,6 +62,15 @@ class ArtificialDeadtimeInserted(UserWarning):
                       "interior to peaklets."),
     strax.Option('erase', default=False, track=False,
                  help="Delete reader data after processing"),
+    strax.Option('daq_load_threads', default=4, track=False, type=int,
+                 help="Number of threads used to decompress the files of "
+                      "the readout threads of a chunk concurrently"),
+    strax.Option('daq_input_inotify', default=False, track=False, type=bool,
+                 help="Watch the daq_input_dir with inotify (requires "
+                      "inotify_simple) rather than checking the folders. "
+                      "Only use if the readers write to a local file "
+                      "system, inotify does not see writes of other hosts "
+                      "on network mounts."),
     strax.Option('channel_map', track=False, type=immutabledict,
                  help="immutabledict mapping subdetector to (min, max) "
                       "channel number."))
@@ -113,6 +128,7 @@ class DAQReader(strax.Plugin):
         self.t0 = int(self.config['run_start_time']) * int(1e9)
         self.dt_max = self.config['max_digitizer_sampling_time']
         self.n_readout_threads = sum(self.config['readout_threads'].values())
+        self._tracker = None
         if (self.config['safe_break_in_pulses']
                 > min(self.config['daq_chunk_duration'],
                       self.config['daq_overlap_chunk_duration'])):
@@ -123,6 +139,15 @@ class DAQReader(strax.Plugin):
     def _path(self, chunk_i):
         return self.config["daq_input_dir"] + f'/{chunk_i:06d}'
 
+    @property
+    def _input_tracker(self):
+        if getattr(self, '_tracker', None) is None:
+            self._tracker = DAQInputTracker(
+                self.config['daq_input_dir'],
+                self.config['readout_threads'],
+                use_inotify=self.config['daq_input_inotify'])
+        return self._tracker
+
     def _chunk_paths(self, chunk_i):
         """Return paths to previous, current and next chunk
         If any of them does not exist, or they are not yet populated
@@ -131,7 +156,7 @@ class DAQReader(strax.Plugin):
         p = self._path(chunk_i)
         result = []
         for q in [p + '_pre', p, p + '_post']:
-            if os.path.exists(q):
+            if self._input_tracker.exists(q):
                 n_files = self._count_files_per_chunk(q)
                 if n_files >= self.n_readout_threads:
                     result.append(q)
@@ -153,29 +178,16 @@ class DAQReader(strax.Plugin):
                 result.append(False)
         return tuple(result)
 
-    @staticmethod
-    def _partial_chunk_to_thread_name(partial_chunk):
-        """Convert name of part of the chunk to the thread_name that wrote it"""
-        return '_'.join(partial_chunk.split('_')[:-1])
-
     def _count_files_per_chunk(self, path_chunk_i):
         """
         Check that the files in the chunks have names consistent with
         the readout threads
         """
-        counted_files = Counter(
-            [self._partial_chunk_to_thread_name(p) for p in os.listdir(path_chunk_i)])
-        for thread, n_counts in counted_files.items():
-            if thread not in self.config['readout_threads']:
-                raise ValueError(f'Bad data for {path_chunk_i}. Got {thread}')
-            if n_counts > self.config['readout_threads'][thread]:
-                raise ValueError(f'{thread} wrote {n_counts}, expected'
-                                 f'{self.config["readout_threads"][thread]}')
-        return sum(counted_files.values())
+        return self._input_tracker.n_files(path_chunk_i)
 
     def source_finished(self):
         end_dir = self.config["daq_input_dir"] + '/THE_END'
-        if not os.path.exists(end_dir):
+        if not self._input_tracker.exists(end_dir):
             return False
         else:
             return self._count_files_per_chunk(end_dir) >= self.n_readout_threads
@@ -183,7 +195,7 @@ class DAQReader(strax.Plugin):
     def is_ready(self, chunk_i):
         ended = self.source_finished()
         pre, current, post = self._chunk_paths(chunk_i)
-        next_ahead = os.path.exists(self._path(chunk_i + 1))
+        next_ahead = self._input_tracker.exists(self._path(chunk_i + 1))
         if (current and (
                 (pre and post
                  or chunk_i == 0 and post
@@ -191,15 +203,28 @@ class DAQReader(strax.Plugin):
             return True
         return False
 
+    def _load_file(self, fn):
+        records = strax.load_file(
+            fn,
+            compressor=self.config["daq_compressor"],
+            dtype=self.dtype_for('raw_records'))
+        if not is_sorted_by_time(records):
+            # Should not happen, a readout thread writes time ordered
+            # data, but the merge below relies on it.
+            records = strax.sort_by_time(records)
+        return records
+
     def _load_chunk(self, path, start, end, kind='central'):
-        records = [
-            strax.load_file(
-                fn,
-                compressor=self.config["daq_compressor"],
-                dtype=self.dtype_for('raw_records'))
-            for fn in sorted(glob.glob(f'{path}/*'))]
-        records = np.concatenate(records)
-        records = strax.sort_by_time(records)
+        files = sorted(glob.glob(f'{path}/*'))
+        # The decompression (lz4/zstd/blosc) releases the GIL, so we can
+        # load the files of the readout threads concurrently.
+        n_threads = max(1, min(self.config['daq_load_threads'], len(files)))
+        if n_threads > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                records = list(pool.map(self._load_file, files))
+        else:
+            records = [self._load_file(fn) for fn in files]
+        records = merge_sorted_records(records)
 
         first_start, last_start, last_end = None, None, None
         if len(records):
@@ -325,22 +350,17 @@ class DAQReader(strax.Plugin):
             x for x in (r_pre, r_main, r_post)
             if x is not None])
 
-        # Split records by channel
+        # Split records by channel and convert time to time in ns since
+        # unix epoch.
         result_arrays = split_channel_ranges(
             records,
-            np.asarray(list(self.config['channel_map'].values())))
+            np.asarray(list(self.config['channel_map'].values())),
+            self.t0)
         del records
 
         # Convert to strax chunks
         result = dict()
         for i, subd in enumerate(self.config['channel_map']):
-            if len(result_arrays[i]):
-                # dt may differ per subdetector
-                dt = result_arrays[i]['dt'][0]
-                # Convert time to time in ns since unix epoch.
-                # Ensure the offset is a whole digitizer sample
-                result_arrays[i]["time"] += dt * (self.t0 // dt)
-
             # Ignore data from the 'blank' channels, corresponding to
             # channels that have nothing connected
             if subd.endswith('blank'):
@@ -377,43 +397,297 @@ class Fake1TDAQReader(DAQReader):
 
 @export
 @numba.njit(nogil=True, cache=True)
-def split_channel_ranges(records, channel_ranges):
+def split_channel_ranges(records, channel_ranges, time_offset=0):
     """Return numba.List of record arrays in channel_ranges.
 
+    The time of the records is shifted by time_offset, rounded down to
+    a whole digitizer sample (dt * (time_offset // dt), where dt is the
+    sampling time of the first record in the channel range). The
+    records keep their order within each of the channel ranges.
+
     ~2.5x as fast as a naive implementation with np.in1d
     """
     n_subdetectors = len(channel_ranges)
-    which_detector = np.zeros(len(records), dtype=np.int8)
     n_in_detector = np.zeros(n_subdetectors, dtype=np.int64)
 
+    # Lookup table of the subdetector of each channel (-1 if unknown)
+    channel_to_detector = np.full(channel_ranges[-1][1] + 1, -1, dtype=np.int16)
+    for d_i in range(n_subdetectors):
+        left, right = channel_ranges[d_i]
+        channel_to_detector[left:right + 1] = d_i
+
     # First loop to count number of records per detector
-    for r_i, r in enumerate(records):
-        for d_i in range(n_subdetectors):
-            left, right = channel_ranges[d_i]
-            if r['channel'] > right:
-                continue
-            elif r['channel'] >= left:
-                which_detector[r_i] = d_i
-                n_in_detector[d_i] += 1
-                break
-            else:
-                # channel_ranges should be sorted ascending.
-                print(r['time'], r['channel'], channel_ranges)
-                raise ValueError(
-                    "Bad data from DAQ: data in unknown channel!")
+    for r in records:
+        ch = r['channel']
+        if ch < 0 or ch >= len(channel_to_detector) or channel_to_detector[ch] < 0:
+            # channel_ranges should be sorted ascending.
+            print(r['time'], r['channel'], channel_ranges)
+            raise ValueError(
+                "Bad data from DAQ: data in unknown channel!")
+        n_in_detector[channel_to_detector[ch]] += 1
 
     # Allocate memory
     results = numba.typed.List()
     for d_i in range(n_subdetectors):
         results.append(np.empty(n_in_detector[d_i], dtype=records.dtype))
 
-    # Second loop to fill results
+    # Second loop to fill results and shift the time
     # This is slightly faster than using which_detector == d_i masks,
     # since it only needs one loop over the data.
     n_placed = np.zeros(n_subdetectors, dtype=np.int64)
-    for r_i, r in enumerate(records):
-        d_i = which_detector[r_i]
-        results[d_i][n_placed[d_i]] = r
+    offset = np.zeros(n_subdetectors, dtype=np.int64)
+    for r in records:
+        d_i = channel_to_detector[r['channel']]
+        if n_placed[d_i] == 0:
+            # dt may differ per subdetector
+            offset[d_i] = r['dt'] * (time_offset // r['dt'])
+        res = results[d_i]
+        res[n_placed[d_i]] = r
+        res[n_placed[d_i]]['time'] += offset[d_i]
         n_placed[d_i] += 1
 
     return results
+
+
+@export
+class DAQInputTracker:
+    """
+    Keep track of the folders in the daq_input_dir and the number of
+    files the readout threads wrote in each of them.
+
+    Folders that are complete (a file from every readout thread) are
+    remembered and never checked again, so does the existence of a
+    folder. Without inotify, only folders that do not exist (yet) or
+    are incomplete are checked again when asked for. With inotify, the
+    daq_input_dir is watched and only the folders for which we received
+    an event are listed again, such that answering does not require
+    any file-system access.
+    """
+
+    def __init__(self, input_dir, readout_threads, use_inotify=False):
+        if use_inotify and inotify_simple is None:
+            raise ModuleNotFoundError(
+                'Install inotify_simple to watch the daq_input_dir')
+        self.input_dir = input_dir
+        self.readout_threads = readout_threads
+        self.n_readout_threads = sum(readout_threads.values())
+        self.use_inotify = use_inotify
+
+        # Number of files per folder name, only for folders that exist
+        self._n_files = dict()
+        self._complete = set()
+        # Watch descriptor for the folder names (inotify only)
+        self._inotify = None
+        self._watches = dict()
+
+    def __getstate__(self):
+        # We cannot share the inotify file descriptor between processes.
+        # Start clean if we are unpickled (e.g. in a strax worker).
+        return dict(input_dir=self.input_dir,
+                    readout_threads=self.readout_threads,
+                    use_inotify=self.use_inotify)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def exists(self, path):
+        """Does the folder in the input_dir exist"""
+        folder = os.path.basename(path)
+        if self.use_inotify:
+            self._process_events()
+        elif folder not in self._n_files and os.path.exists(self._path(folder)):
+            self._scan(folder)
+        return folder in self._n_files
+
+    def n_files(self, path):
+        """Number of files the readout threads wrote to the folder"""
+        folder = os.path.basename(path)
+        if self.use_inotify:
+            self._process_events()
+        elif folder not in self._complete:
+            self._scan(folder)
+        return self._n_files[folder]
+
+    def _path(self, folder):
+        return os.path.join(self.input_dir, folder)
+
+    @staticmethod
+    def _partial_chunk_to_thread_name(partial_chunk):
+        """Convert name of part of the chunk to the thread_name that wrote it"""
+        return '_'.join(partial_chunk.split('_')[:-1])
+
+    def _scan(self, folder):
+        """List the files in the folder and check that they have names
+        consistent with the readout threads"""
+        path = self._path(folder)
+        counted_files = Counter(
+            [self._partial_chunk_to_thread_name(p) for p in os.listdir(path)])
+        for thread, n_counts in counted_files.items():
+            if thread not in self.readout_threads:
+                raise ValueError(f'Bad data for {path}. Got {thread}')
+            if n_counts > self.readout_threads[thread]:
+                raise ValueError(f'{thread} wrote {n_counts}, expected'
+                                 f'{self.readout_threads[thread]}')
+        n_files = sum(counted_files.values())
+        self._n_files[folder] = n_files
+        if n_files >= self.n_readout_threads:
+            self._complete.add(folder)
+            self._stop_watching(folder)
+
+    def _process_events(self):
+        """Update the folders for which inotify reported a change"""
+        if self._inotify is None:
+            if not os.path.exists(self.input_dir):
+                # Nothing to watch yet
+                return
+            self._start_watching()
+            return
+
+        changed = set()
+        for event in self._inotify.read(timeout=0):
+            if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                # We lost events, start over
+                self._inotify.close()
+                self.__init__(**self.__getstate__())
+                return self._process_events()
+            folder = self._watches.get(event.wd)
+            if folder is None or event.mask & inotify_simple.flags.IGNORED:
+                continue
+            if folder != '':
+                changed.add(folder)
+            elif not event.mask & inotify_simple.flags.ISDIR:
+                continue
+            elif event.mask & (inotify_simple.flags.CREATE
+                               | inotify_simple.flags.MOVED_TO):
+                self._watch(event.name)
+            else:
+                # Deleted or moved away
+                self._stop_watching(event.name)
+                self._n_files.pop(event.name, None)
+                self._complete.discard(event.name)
+
+        for folder in changed:
+            if folder in self._n_files and folder not in self._complete:
+                self._scan(folder)
+
+    def _start_watching(self):
+        self._inotify = inotify_simple.INotify()
+        self._add_watch(self.input_dir, '')
+        for folder in os.listdir(self.input_dir):
+            if os.path.isdir(self._path(folder)):
+                self._watch(folder)
+
+    def _watch(self, folder):
+        # Start watching before listing, so we can't miss any file
+        try:
+            self._add_watch(self._path(folder), folder)
+            self._scan(folder)
+        except FileNotFoundError:
+            # Was already moved or deleted, we will get the event
+            self._stop_watching(folder)
+
+    def _add_watch(self, path, folder):
+        flags = inotify_simple.flags
+        wd = self._inotify.add_watch(
+            path,
+            flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+        self._watches[wd] = folder
+
+    def _stop_watching(self, folder):
+        for wd, watched_folder in list(self._watches.items()):
+            if watched_folder == folder:
+                del self._watches[wd]
+                try:
+                    self._inotify.rm_watch(wd)
+                except OSError:
+                    # Watch was already removed (folder got deleted)
+                    pass
+
+
+@export
+def merge_sorted_records(records_per_thread):
+    """Merge a list of record arrays that are each sorted by time (and
+    channel) into one array sorted by time and channel.
+
+    Equivalent to strax.sort_by_time(np.concatenate(records_per_thread))
+    without the full sort, since each of the inputs is already sorted.
+    """
+    non_empty = [r for r in records_per_thread if len(r)]
+    if len(non_empty) < 2:
+        # Nothing to merge
+        return np.concatenate(records_per_thread)
+    result = np.empty(sum([len(r) for r in non_empty]),
+                      dtype=non_empty[0].dtype)
+    _merge_sorted_records(numba.typed.List(non_empty), result)
+    return result
+
+
+@numba.njit(nogil=True, cache=True)
+def _merge_sorted_records(records_per_thread, result):
+    """K-way merge of time sorted record arrays into result using a
+    binary heap of the heads of each of the inputs.
+    """
+    n_inputs = len(records_per_thread)
+    heap = np.arange(n_inputs)
+    heads = np.zeros(n_inputs, dtype=np.int64)
+    # Keep the sort keys of the heads in separate buffers, such that we
+    # don't have to look them up in the records for every comparison
+    head_time = np.zeros(n_inputs, dtype=np.int64)
+    head_channel = np.zeros(n_inputs, dtype=np.int64)
+    for input_i in range(n_inputs):
+        head_time[input_i] = records_per_thread[input_i][0]['time']
+        head_channel[input_i] = records_per_thread[input_i][0]['channel']
+
+    # Heapify
+    for start in range(n_inputs // 2 - 1, -1, -1):
+        _sift_down(heap, n_inputs, start, head_time, head_channel)
+
+    n_in_heap = n_inputs
+    for out_i in range(len(result)):
+        input_i = heap[0]
+        records = records_per_thread[input_i]
+        result[out_i] = records[heads[input_i]]
+        heads[input_i] += 1
+        if heads[input_i] == len(records):
+            # This input is exhausted, replace it by the last in the heap
+            n_in_heap -= 1
+            heap[0] = heap[n_in_heap]
+        else:
+            head_time[input_i] = records[heads[input_i]]['time']
+            head_channel[input_i] = records[heads[input_i]]['channel']
+        _sift_down(heap, n_in_heap, 0, head_time, head_channel)
+
+
+@numba.njit(nogil=True, cache=True)
+def _sift_down(heap, n_in_heap, i, head_time, head_channel):
+    """Restore the heap property below position i. Inputs are ordered by
+    the time, then the channel of their heads, then by their index.
+    """
+    while True:
+        smallest = i
+        for child in (2 * i + 1, 2 * i + 2):
+            if child >= n_in_heap:
+                continue
+            a, b = heap[child], heap[smallest]
+            if (head_time[a] < head_time[b]
+                    or (head_time[a] == head_time[b]
+                        and (head_channel[a] < head_channel[b]
+                             or (head_channel[a] == head_channel[b]
+                                 and a < b)))):
+                smallest = child
+        if smallest == i:
+            return
+        heap[i], heap[smallest] = heap[smallest], heap[i]
+        i = smallest
+
+
+@export
+@numba.njit(nogil=True, cache=True)
+def is_sorted_by_time(records):
+    """Check if records are sorted by time, then channel"""
+    for r_i in range(1, len(records)):
+        t_0, t_1 = records[r_i - 1]['time'], records[r_i]['time']
+        if t_1 < t_0 or (t_1 == t_0
+                         and records[r_i]['channel'] < records[r_i - 1]['channel']):
+            return False
+    return True
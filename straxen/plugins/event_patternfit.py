@@ -1,5 +1,7 @@
+import math
 import strax
 import straxen
+import numba
 import numpy as np
 from scipy.special import betainc, gammaln, loggamma
 import warnings
@@ -14,6 +16,12 @@ export, __all__ = strax.exporter()
                  default='XENONnT_s2_xy_patterns_LCE_corrected_qes_MCva43fa9b_wires.pkl'),
     strax.Option('s1_aft_map', help='Date drive S1 area fraction top map.',
                  default='s1_aft_dd_xyz_XENONnT_Kr83m_41500eV_25May2021.json'),
+    strax.Option('s1_optical_map_method', default='WeightedNearestNeighbors',
+                 help='Interpolation method of the s1_optical_map, see InterpolatingMap'),
+    strax.Option('s2_optical_map_method', default='WeightedNearestNeighbors',
+                 help='Interpolation method of the s2_optical_map, see InterpolatingMap'),
+    strax.Option('s1_aft_map_method', default='WeightedNearestNeighbors',
+                 help='Interpolation method of the s1_aft_map, see InterpolatingMap'),
     strax.Option('mean_pe_per_photon', help='Mean of full VUV single photon response',
                  default=1.2),
     strax.Option('gain_model',
@@ -40,7 +48,7 @@ class EventPatternFit(strax.Plugin):
     
     depends_on = ('event_area_per_channel', 'event_basics', 'event_positions')
     provides = 'event_pattern_fit'
-    __version__ = '0.0.7'
+    __version__ = '0.0.8'
 
     def infer_dtype(self):
         dtype = [('s2_2llh', np.float32,
@@ -95,17 +103,20 @@ class EventPatternFit(strax.Plugin):
         self.s1_aft_map = straxen.InterpolatingMap(
             straxen.get_resource(
                 self.config['s1_aft_map'],
-                fmt=self._infer_map_format(self.config['s1_aft_map'])))
+                fmt=self._infer_map_format(self.config['s1_aft_map'])),
+            method=self.config['s1_aft_map_method'])
                     
         # Getting optical maps
         self.s1_pattern_map = straxen.InterpolatingMap(
             straxen.get_resource(
                 self.config['s1_optical_map'],
-                fmt=self._infer_map_format(self.config['s1_optical_map'])))
+                fmt=self._infer_map_format(self.config['s1_optical_map'])),
+            method=self.config['s1_optical_map_method'])
         self.s2_pattern_map = straxen.InterpolatingMap(
             straxen.get_resource(
                 self.config['s2_optical_map'],
-                fmt=self._infer_map_format(self.config['s2_optical_map'])))
+                fmt=self._infer_map_format(self.config['s2_optical_map'])),
+            method=self.config['s2_optical_map_method'])
         
         # Getting gain model to get dead PMTs
         self.to_pe = straxen.get_correction_from_cmt(self.run_id, self.config['gain_model'])
@@ -127,49 +138,29 @@ class EventPatternFit(strax.Plugin):
         self.compute_s2_llhvalue(events, result)
         
         # Computing binomial test for s1 area fraction top
-        s1_area_fraction_top_probability = np.vectorize(_s1_area_fraction_top_probability)
         positions = np.vstack([events['x'], events['y'], events['z']]).T
         aft_prob = self.s1_aft_map(positions)
-        
-        # main s1 events
-        mask_s1 = ~np.isnan(aft_prob)
-        mask_s1 &= ~np.isnan(events['s1_area'])
-        mask_s1 &= ~np.isnan(events['s1_area_fraction_top'])
-        
-        # default value is nan, it will be overwrite if the event satisfy the requirements
-        result['s1_area_fraction_top_continuous_probability'][:] = np.nan
-        result['s1_area_fraction_top_discrete_probability'][:] = np.nan
-        result['s1_photon_fraction_top_continuous_probability'][:] = np.nan
-        result['s1_photon_fraction_top_discrete_probability'][:] = np.nan
-        
-        # compute binomial test only if we have events that have valid aft prob, s1 area and s1 aft
-        if np.sum(mask_s1):
-            arg = aft_prob[mask_s1], events['s1_area'][mask_s1], events['s1_area_fraction_top'][mask_s1]
-            result['s1_area_fraction_top_continuous_probability'][mask_s1] = s1_area_fraction_top_probability(*arg)
-            result['s1_area_fraction_top_discrete_probability'][mask_s1] = s1_area_fraction_top_probability(*arg, 'discrete')
-            arg = aft_prob[mask_s1], events['s1_area'][mask_s1]/self.config['mean_pe_per_photon'], events['s1_area_fraction_top'][mask_s1]
-            result['s1_photon_fraction_top_continuous_probability'][mask_s1] = s1_area_fraction_top_probability(*arg)
-            result['s1_photon_fraction_top_discrete_probability'][mask_s1] = s1_area_fraction_top_probability(*arg, 'discrete')
-        
-        # alternative s1 events
-        mask_alt_s1 = ~np.isnan(aft_prob)
-        mask_alt_s1 &= ~np.isnan(events['alt_s1_area'])
-        mask_alt_s1 &= ~np.isnan(events['alt_s1_area_fraction_top'])
-        
-        # default value is nan, it will be ovewrite if the event satisfy the requirments
-        result['alt_s1_area_fraction_top_continuous_probability'][:] = np.nan
-        result['alt_s1_area_fraction_top_discrete_probability'][:] = np.nan
-        result['alt_s1_photon_fraction_top_continuous_probability'][:] = np.nan
-        result['alt_s1_photon_fraction_top_discrete_probability'][:] = np.nan
-        
-        # compute binomial test only if we have events that have valid aft prob, alt s1 area and alt s1 aft
-        if np.sum(mask_alt_s1):
-            arg = aft_prob[mask_alt_s1], events['alt_s1_area'][mask_alt_s1], events['alt_s1_area_fraction_top'][mask_alt_s1]
-            result['alt_s1_area_fraction_top_continuous_probability'][mask_alt_s1] = s1_area_fraction_top_probability(*arg)
-            result['alt_s1_area_fraction_top_discrete_probability'][mask_alt_s1] = s1_area_fraction_top_probability(*arg, 'discrete')
-            arg = aft_prob[mask_alt_s1], events['alt_s1_area'][mask_alt_s1]/self.config['mean_pe_per_photon'], events['alt_s1_area_fraction_top'][mask_alt_s1]
-            result['alt_s1_photon_fraction_top_continuous_probability'][mask_alt_s1] = s1_area_fraction_top_probability(*arg)
-            result['alt_s1_photon_fraction_top_discrete_probability'][mask_alt_s1] = s1_area_fraction_top_probability(*arg, 'discrete')
+
+        for s1 in ['s1', 'alt_s1']:
+            # default value is nan, it will be overwrite if the event satisfy the requirements
+            for quantity in ['area', 'photon']:
+                for mode in ['continuous', 'discrete']:
+                    result[f'{s1}_{quantity}_fraction_top_{mode}_probability'][:] = np.nan
+
+            mask_s1 = ~np.isnan(aft_prob)
+            mask_s1 &= ~np.isnan(events[f'{s1}_area'])
+            mask_s1 &= ~np.isnan(events[f'{s1}_area_fraction_top'])
+
+            # compute binomial test only if we have events that have valid aft prob, s1 area and s1 aft
+            if not np.sum(mask_s1):
+                continue
+            s1_area = events[f'{s1}_area'][mask_s1]
+            s1_aft = events[f'{s1}_area_fraction_top'][mask_s1]
+            for quantity, size in [('area', s1_area),
+                                   ('photon', s1_area / self.config['mean_pe_per_photon'])]:
+                for mode in ['continuous', 'discrete']:
+                    result[f'{s1}_{quantity}_fraction_top_{mode}_probability'][mask_s1] = (
+                        _s1_area_fraction_top_probability(aft_prob[mask_s1], size, s1_aft, mode))
                 
         return result
 
@@ -192,54 +183,27 @@ class EventPatternFit(strax.Plugin):
         result['s1_top_2llh'][:] = np.nan
         result['s1_bottom_2llh'][:] = np.nan
         
-        # Making expectation patterns [ in PE ]
         if np.sum(cur_s1_bool):
-            s1_map_effs = self.s1_pattern_map(np.array([x, y, z]).T)[cur_s1_bool, :]
+            s1_map_effs = self.s1_pattern_map(np.array([x, y, z]).T[cur_s1_bool])
             s1_area = events['s1_area'][cur_s1_bool]
-            s1_pattern = s1_area[:, None]*(s1_map_effs[:, self.pmtbool])/np.sum(s1_map_effs[:, self.pmtbool], axis=1)[:, None] 
-
-            s1_pattern_top = (events['s1_area_fraction_top'][cur_s1_bool]*s1_area)
-            s1_pattern_top = s1_pattern_top[:, None]*((s1_map_effs[:, :self.config['n_top_pmts']])[:, self.pmtbool_top])
-            s1_pattern_top /= np.sum((s1_map_effs[:, :self.config['n_top_pmts']])[:, self.pmtbool_top], axis=1)[:, None] 
-            s1_pattern_bottom = ((1-events['s1_area_fraction_top'][cur_s1_bool])*s1_area)
-            s1_pattern_bottom = s1_pattern_bottom[:, None]*((s1_map_effs[:, self.config['n_top_pmts']:])[:, self.pmtbool_bottom])
-            s1_pattern_bottom /= np.sum((s1_map_effs[:, self.config['n_top_pmts']:])[:, self.pmtbool_bottom], axis=1)[:, None] 
-
-            # Getting pattern from data
-            s1_area_per_channel_ = events['s1_area_per_channel'][cur_s1_bool,:]
-            s1_area_per_channel = s1_area_per_channel_[:, self.pmtbool]
-            s1_area_per_channel_top = (s1_area_per_channel_[:, :self.config['n_top_pmts']])[:, self.pmtbool_top]
-            s1_area_per_channel_bottom = (s1_area_per_channel_[:, self.config['n_top_pmts']:])[:, self.pmtbool_bottom]
-
-            # Top and bottom
-            arg1 = s1_pattern/self.mean_pe_photon, s1_area_per_channel, self.mean_pe_photon
-            arg2 = s1_area_per_channel/self.mean_pe_photon, s1_area_per_channel, self.mean_pe_photon
-            norm_llh_val = (neg2llh_modpoisson(*arg1) - neg2llh_modpoisson(*arg2))
-            result['s1_2llh'][cur_s1_bool] = np.sum(norm_llh_val, axis=1)
-
-            # If needed to stire - store only top and bottom array, but not together
+            s1_aft = events['s1_area_fraction_top'][cur_s1_bool]
+
+            # Expected area of the total, top and bottom array patterns [ in PE ]
+            areas = np.stack([s1_area, s1_aft * s1_area, (1 - s1_aft) * s1_area], axis=1)
+            is_top = np.arange(self.config['n_tpc_pmts']) < self.config['n_top_pmts']
+            live = np.stack([self.pmtbool, self.pmtbool & is_top, self.pmtbool & ~is_top])
+
+            neg2llh, pattern, neg2llh_per_channel = self._pattern_neg2llh(
+                s1_map_effs, events['s1_area_per_channel'][cur_s1_bool], areas, live)
+            result['s1_2llh'][cur_s1_bool] = neg2llh[:, 0]
+            result['s1_top_2llh'][cur_s1_bool] = neg2llh[:, 1]
+            result['s1_bottom_2llh'][cur_s1_bool] = neg2llh[:, 2]
+
+            # If needed to store - store only the pattern of the total array
             if self.config['store_per_channel']:
-                # Storring pattern information
-                store_patterns = np.zeros((s1_pattern.shape[0], self.config['n_tpc_pmts']) )  
-                store_patterns[:, self.pmtbool] = s1_pattern
-                result['s1_pattern'][cur_s1_bool] = store_patterns
-                # Storing actual LLH values
-                store_2LLH_ch = np.zeros((norm_llh_val.shape[0], self.config['n_tpc_pmts']) )
-                store_2LLH_ch[:, self.pmtbool] = norm_llh_val
-                result['s1_2llh_per_channel'][cur_s1_bool] = store_2LLH_ch
-
-            # Top
-            arg1 = s1_pattern_top/self.mean_pe_photon, s1_area_per_channel_top, self.mean_pe_photon
-            arg2 = s1_area_per_channel_top/self.mean_pe_photon, s1_area_per_channel_top, self.mean_pe_photon
-            norm_llh_val = (neg2llh_modpoisson(*arg1) - neg2llh_modpoisson(*arg2))
-            result['s1_top_2llh'][cur_s1_bool] = np.sum(norm_llh_val, axis=1)
-
-            # Bottom
-            arg1 = s1_pattern_bottom/self.mean_pe_photon, s1_area_per_channel_bottom, self.mean_pe_photon
-            arg2 = s1_area_per_channel_bottom/self.mean_pe_photon, s1_area_per_channel_bottom, self.mean_pe_photon
-            norm_llh_val = (neg2llh_modpoisson(*arg1) - neg2llh_modpoisson(*arg2))
-            result['s1_bottom_2llh'][cur_s1_bool] = np.sum(norm_llh_val, axis=1)
-            
+                result['s1_pattern'][cur_s1_bool] = pattern
+                result['s1_2llh_per_channel'][cur_s1_bool] = neg2llh_per_channel
+
     def compute_s2_llhvalue(self, events, result):
         for t_ in ['s2', 'alt_s2']:
             # Selecting S2s for pattern fit calculation
@@ -255,41 +219,43 @@ class EventPatternFit(strax.Plugin):
             # default value is nan, it will be ovewrite if the event satisfy the requirments
             result[t_+'_2llh'][:] = np.nan
             
-            # Making expectation patterns [ in PE ]
             if np.sum(cur_s2_bool):
-                s2_map_effs = self.s2_pattern_map(np.array([x, y]).T)[cur_s2_bool, 0:self.config['n_top_pmts']]
-                s2_map_effs = s2_map_effs[:, self.pmtbool_top]
+                n_top = self.config['n_top_pmts']
+                s2_map_effs = self.s2_pattern_map(np.array([x, y]).T[cur_s2_bool])[:, :n_top]
+                # Expected area of the top array pattern [ in PE ]
                 s2_top_area = (events[t_+'_area_fraction_top']*events[t_+'_area'])[cur_s2_bool]
-                s2_pattern  = s2_top_area[:, None]*s2_map_effs/np.sum(s2_map_effs, axis=1)[:,None]
-
-                # Getting pattern from data
-                s2_top_area_per_channel = events[t_+'_area_per_channel'][cur_s2_bool, 0:self.config['n_top_pmts']]
-                s2_top_area_per_channel = s2_top_area_per_channel[:, self.pmtbool_top]
-
-                # Calculating LLH, this is shifted Poisson
-                # we get area expectation and we need to scale them to get
-                # photon expectation
-                norm_llh_val = (neg2llh_modpoisson(
-                                     mu    = s2_pattern/self.mean_pe_photon, 
-                                     areas = s2_top_area_per_channel, 
-                                     mean_pe_photon=self.mean_pe_photon)
-                                        - 
-                                neg2llh_modpoisson(
-                                     mu    = s2_top_area_per_channel/self.mean_pe_photon, 
-                                     areas = s2_top_area_per_channel, 
-                                     mean_pe_photon=self.mean_pe_photon)
-                               )
-                result[t_+'_2llh'][cur_s2_bool] = np.sum(norm_llh_val, axis=1)
+
+                neg2llh, pattern, neg2llh_per_channel = self._pattern_neg2llh(
+                    s2_map_effs,
+                    events[t_+'_area_per_channel'][cur_s2_bool, :n_top],
+                    s2_top_area[:, None],
+                    self.pmtbool_top[None, :])
+                result[t_+'_2llh'][cur_s2_bool] = neg2llh[:, 0]
 
                 if self.config['store_per_channel']:
-                    store_patterns = np.zeros((s2_pattern.shape[0], self.config['n_top_pmts']) )
-                    store_patterns[:, self.pmtbool_top] = s2_pattern
-                    result[t_+'_pattern'][cur_s2_bool] = store_patterns#:s2_pattern[cur_s2_bool]
+                    result[t_+'_pattern'][cur_s2_bool] = pattern
+                    result[t_+'_2llh_per_channel'][cur_s2_bool] = neg2llh_per_channel
+
+    def _pattern_neg2llh(self, map_effs, area_per_channel, areas, live):
+        """
+        Normalized -2LLH of the observed area per channel, given the
+        expected patterns from the optical map. See pattern_neg2llh.
+
+        :returns: array (n_events, n_patterns) of -2LLH values and, if
+            the per channel values are stored, arrays (n_events,
+            n_channels) of the expected pattern and -2LLH per channel of
+            the first pattern.
+        """
+        neg2llh = np.zeros(areas.shape, dtype=np.float64)
+        if self.config['store_per_channel']:
+            pattern = np.zeros(area_per_channel.shape, dtype=np.float32)
+            neg2llh_per_channel = np.zeros(area_per_channel.shape, dtype=np.float32)
+        else:
+            pattern = neg2llh_per_channel = np.zeros((0, 0), dtype=np.float32)
+        pattern_neg2llh(map_effs, area_per_channel, areas, live, self.mean_pe_photon,
+                        neg2llh, pattern, neg2llh_per_channel)
+        return neg2llh, pattern, neg2llh_per_channel
 
-                    store_2LLH_ch = np.zeros((norm_llh_val.shape[0], self.config['n_top_pmts']) )
-                    store_2LLH_ch[:, self.pmtbool_top] = norm_llh_val
-                    result[t_+'_2llh_per_channel'][cur_s2_bool] = store_2LLH_ch
-                    
     @staticmethod
     def _infer_map_format(map_name, known_formats=('pkl', 'json', 'json.gz')):
         for fmt in known_formats:
@@ -320,37 +286,96 @@ def neg2llh_modpoisson(mu=None, areas=None, mean_pe_photon=1.0):
     res[is_zero*neg_mu] = 0.0
     return res
 
+@export
+@numba.njit(cache=True, nogil=True)
+def pattern_neg2llh(map_effs, area_per_channel, areas, live, mean_pe_photon,
+                    neg2llh, pattern, neg2llh_per_channel):
+    """
+    Normalized -2LLH (see neg2llh_modpoisson) of the observed area per
+    channel of each event, given one or more expected patterns, in one
+    pass over the channels of the event.
+
+    :param map_effs: array (n_events, n_channels) of light collection
+        efficiencies from the optical map
+    :param area_per_channel: array (n_events, n_channels) of observed areas
+    :param areas: array (n_events, n_patterns) of the total area of each
+        expected pattern, e.g. of the total, top and bottom array
+    :param live: boolean array (n_patterns, n_channels) of the channels
+        that make up each pattern. The expected area per channel is
+        areas * map_effs normalized over these channels.
+    :param mean_pe_photon: mean of area response for one photon
+    :param neg2llh: array (n_events, n_patterns) to store the -2LLH in
+    :param pattern: array (n_events, n_channels) to store the expected
+        pattern of the first pattern in, or an empty array to skip this
+    :param neg2llh_per_channel: idem, for the -2LLH per channel
+    """
+    n_patterns, n_channels = live.shape
+    store = len(pattern) > 0
+    eff_sum = np.zeros(n_patterns, dtype=np.float64)
+    for event_i in range(len(map_effs)):
+        eff_sum[:] = 0
+        for ch in range(n_channels):
+            for pattern_i in range(n_patterns):
+                if live[pattern_i, ch]:
+                    eff_sum[pattern_i] += map_effs[event_i, ch]
+        neg2llh[event_i, :] = 0
+        for ch in range(n_channels):
+            area = area_per_channel[event_i, ch]
+            photons = area / mean_pe_photon
+            for pattern_i in range(n_patterns):
+                if not live[pattern_i, ch]:
+                    continue
+                # np.divide gives inf or nan (rather than an error) for
+                # patterns without efficiency, as numpy does
+                expected_area = np.divide(areas[event_i, pattern_i] * map_effs[event_i, ch],
+                                          eff_sum[pattern_i])
+                llh = _neg2llh_modpoisson_ratio(expected_area / mean_pe_photon, area, photons)
+                neg2llh[event_i, pattern_i] += llh
+                if store and pattern_i == 0:
+                    pattern[event_i, ch] = expected_area
+                    neg2llh_per_channel[event_i, ch] = llh
+
+
+@numba.njit(cache=True, nogil=True)
+def _neg2llh_modpoisson_ratio(mu, area, photons):
+    """
+    neg2llh_modpoisson(mu, area) - neg2llh_modpoisson(photons, area) for
+    a single channel, with photons = area / mean_pe_photon. The
+    normalization terms of the shifted poisson cancel.
+    """
+    if not area > 0:
+        res = 2. * mu if not mu < 0 else 0.
+        return res - (2. * photons if not photons < 0 else 0.)
+    return 2. * (mu - photons * np.log(mu)) - 2. * (photons - photons * np.log(photons))
+
+
 # continuous and discrete binomial test
 # https://github.com/poliastro/cephes/blob/master/src/bdtr.c
+# These work on arrays (elementwise) as well as on scalars.
 
 def bdtrc(k, n, p):
-    if (k < 0):
-        return (1.0)
-    if (k == n):
-        return (0.0)
+    k, n, p = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (k, n, p)])
     dn = n - k
-    if (k == 0):
-        if (p < .01):
-            dk = -np.expm1(dn * np.log1p(-p))
-        else:
-            dk = 1.0 - np.exp(dn * np.log(1.0 - p))
-    else:
-        dk = k + 1
-        dk = betainc(dk, dn, p)
-    return dk
+    with np.errstate(all='ignore'):
+        dk = betainc(k + 1, dn, p)
+        dk = np.where(k == 0,
+                      np.where(p < .01,
+                               -np.expm1(dn * np.log1p(-p)),
+                               1.0 - np.exp(dn * np.log(1.0 - p))),
+                      dk)
+    dk = np.where(k == n, 0.0, dk)
+    dk = np.where(k < 0, 1.0, dk)
+    return dk[()]
 
 def bdtr(k, n, p):
-    if (k < 0):
-        return np.nan
-    if (k == n):
-        return (1.0)
+    k, n, p = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (k, n, p)])
     dn = n - k
-    if (k == 0):
-        dk = np.exp(dn * np.log(1.0 - p))
-    else:
-        dk = k + 1
-        dk = betainc(dn, dk, 1.0 - p)
-    return dk
+    with np.errstate(all='ignore'):
+        dk = betainc(dn, k + 1, 1.0 - p)
+        dk = np.where(k == 0, np.exp(dn * np.log(1.0 - p)), dk)
+    dk = np.where(k == n, 1.0, dk)
+    dk = np.where(k < 0, np.nan, dk)
+    return dk[()]
 
 # continuous binomial distribution
 def binom_pmf(k, n, p):
@@ -370,100 +395,136 @@ def binom_test(k, n, p):
     other side of the mean that has the same probability as k, and
     integrate the tails outward from k and j. In the case where either
     k or j are zero, only the non-zero tail is integrated.
+
+    Works on arrays (elementwise) as well as on scalars. The search for
+    j is compiled (see _binom_test_other_side), the tails are integrated
+    for all elements at once.
     """
-    d = binom_pmf(k, n, p)
-    rerr = 1 + 1e-7
-    d = d * rerr
-    # define number of interaction for finding the the value j
-    # the exceptional case of n<=0, is avoid since n_iter is at least 2
-    if n > 0:
-        n_iter = int(max(np.round(np.log10(n)) + 1, 2))
-    else:
-        n_iter = 2
-
-    if k < n * p:
-        # if binom_pmf(n, n, p) > d, with d<<1e-3, means that we have
-        # to look for j value above n. It is likely that the binomial
-        # test for such j is extremely low such that we can stop
-        # the algorithm and return 0
-        if binom_pmf(n, n, p) > d:
-            for n_ in np.arange(n, 2*n, 1):
-                if binom_pmf(n_, n, p) < d:
-                    j_min, j_max = k, n_
-                    do_test = True
-                    break
-                do_test = False
-        else:
-            j_min, j_max = k, n
-            do_test = True
-        def _check_(d, y0, y1):
-            return (d>y1) and (d<=y0)
-    else:
-        if binom_pmf(0, n, p) > d:
-            n_iter, j_min, j_max = 0, 0, 0
-        else:
-            j_min, j_max = 0, k
-        do_test = True
-        def _check_(d, y0, y1):
-            return (d>=y0) and (d<y1)
+    k, n, p = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (k, n, p)])
+    shape = k.shape
+    k, n, p = k.ravel(), n.ravel(), p.ravel()
+
+    j = np.zeros(len(k), dtype=np.float64)
+    do_test = np.zeros(len(k), dtype=np.bool_)
+    _binom_test_other_side(k, n, p, j, do_test)
 
     # if B(k;n,p) is already 0 or I can't find the j in the other side of the mean
     # the returned binomial test is 0
-    if (d==0)|(not do_test):
-        pval = 0.0
-    else:
-        # Here we are actually looking for j
-        for i in range(n_iter):
+    pval = np.zeros(len(k), dtype=np.float64)
+    k, j, n, p = k[do_test], j[do_test], n[do_test], p[do_test]
+    one_sided = k * j == 0
+    with np.errstate(all='ignore'):
+        pval_test = binom_sf(np.maximum(k, j), n, p)
+        pval_test = np.where(
+            one_sided,
+            pval_test,
+            binom_cdf(np.minimum(k, j), n, p) + pval_test)
+    pval[do_test] = np.where(pval_test < 1.0, pval_test, 1.0)
+    return pval.reshape(shape)[()]
+
+
+@numba.njit(cache=True, nogil=True)
+def _binom_pmf(k, n, p):
+    scale_log = math.lgamma(n + 1) - math.lgamma(n - k + 1) - math.lgamma(k + 1)
+    ret_log = scale_log + k * np.log(p) + (n - k) * np.log(1 - p)
+    return np.exp(ret_log)
+
+
+@numba.njit(cache=True, nogil=True)
+def _binom_test_other_side(k, n, p, j, do_test):
+    """Find the value j on the other side of the mean that has the same
+    probability as k, for binom_test. do_test is False if the binomial
+    test is 0.
+    """
+    for i in range(len(k)):
+        d = _binom_pmf(k[i], n[i], p[i])
+        rerr = 1 + 1e-7
+        d = d * rerr
+        # define number of interaction for finding the the value j
+        # the exceptional case of n<=0, is avoid since n_iter is at least 2
+        if n[i] > 0:
+            n_iter = int(max(np.round(np.log10(n[i])) + 1, 2))
+        else:
+            n_iter = 2
+
+        j_min, j_max = 0., 0.
+        below_mean = k[i] < n[i] * p[i]
+        if below_mean:
+            # if binom_pmf(n, n, p) > d, with d<<1e-3, means that we have
+            # to look for j value above n. It is likely that the binomial
+            # test for such j is extremely low such that we can stop
+            # the algorithm and return 0
+            if _binom_pmf(n[i], n[i], p[i]) > d:
+                do_test[i] = False
+                for step in range(int(np.ceil(n[i]))):
+                    if _binom_pmf(n[i] + step, n[i], p[i]) < d:
+                        j_min, j_max = k[i], n[i] + step
+                        do_test[i] = True
+                        break
+            else:
+                j_min, j_max = k[i], n[i]
+                do_test[i] = True
+        else:
+            if _binom_pmf(0., n[i], p[i]) > d:
+                n_iter = 0
+            else:
+                j_min, j_max = 0., k[i]
+            do_test[i] = True
+
+        if d == 0 or not do_test[i]:
+            do_test[i] = False
+            continue
+
+        # Here we are actually looking for j, on a grid of points
+        # between j_min and j_max as np.linspace would give
+        for iteration in range(n_iter):
             n_pts = int(j_max - j_min)
-            if (i<2) and (n_pts < 50): 
+            if iteration < 2 and n_pts < 50:
                 n_pts = 50
-            j_range = np.linspace(j_min, j_max, n_pts, endpoint=True)
-            y = binom_pmf(j_range, n, p)
-            for i in range(len(j_range) - 1):
-                if _check_(d, y[i], y[i + 1]):
-                    j_min, j_max = j_range[i], j_range[i + 1]
+            if n_pts < 2:
+                continue
+            step_size = (j_max - j_min) / (n_pts - 1)
+            j_0 = j_min
+            y_0 = _binom_pmf(j_0, n[i], p[i])
+            for point_i in range(1, n_pts):
+                j_1 = point_i * step_size + j_min if point_i < n_pts - 1 else j_max
+                y_1 = _binom_pmf(j_1, n[i], p[i])
+                if below_mean:
+                    found = (d > y_1) and (d <= y_0)
+                else:
+                    found = (d >= y_0) and (d < y_1)
+                if found:
+                    j_min, j_max = j_0, j_1
                     break
-        j = max(min((j_min + j_max) / 2, n), 0)
+                j_0, y_0 = j_1, y_1
 
-        # One side or two side
-        # binomial test
-        if k * j == 0:
-            pval = binom_sf(max(k, j), n, p)
-        else:
-            pval = binom_cdf(min(k, j), n, p) + binom_sf(max(k, j), n, p)
-        pval = min(1.0, pval)
-        
-    return pval
+        j[i] = (j_min + j_max) / 2
+        if n[i] < j[i]:
+            j[i] = n[i]
+        if 0 > j[i]:
+            j[i] = 0
 
 
 def _s1_area_fraction_top_probability(aft_prob, area_tot, area_fraction_top, mode='continuous'):
     '''
-    Wrapper that does the S1 AFT probability calculation for you
+    Wrapper that does the S1 AFT probability calculation for you, for
+    arrays (or scalars) of S1s
     '''
-    
+    aft_prob, area_tot, area_fraction_top = np.broadcast_arrays(
+        *[np.asarray(x, dtype=np.float64) for x in (aft_prob, area_tot, area_fraction_top)])
     area_top = area_tot * area_fraction_top
-    
-    # Raise a warning in case one of these three condition is verified
-    # and return binomial test equal to nan since they are not physical
+
+    # Return binomial test equal to nan if one of these three conditions is
+    # verified, since they are not physical
     # k: size_top, n: size_tot, p: aft_prob
-    do_test = True
-    if area_tot < area_top:
-        # warnings.warn(f'n {area_tot} must be >= k {area_top}')
-        binomial_test = np.nan
-        do_test = False
-    if (aft_prob > 1.0) or (aft_prob < 0.0):
-        # warnings.warn(f'p {aft_prob} must be in range [0, 1]')
-        binomial_test = np.nan
-        do_test = False
-    if area_top < 0:
-        # warnings.warn(f'k {area_top} must be >= 0')
-        binomial_test = np.nan
-        do_test = False
-        
-    if do_test:
-        if mode == 'discrete':
-            binomial_test = binom_pmf(area_top, area_tot, aft_prob)
-        else:
-            binomial_test = binom_test(area_top, area_tot, aft_prob)
-        
-    return binomial_test
+    do_test = ~(area_tot < area_top)
+    do_test &= ~((aft_prob > 1.0) | (aft_prob < 0.0))
+    do_test &= ~(area_top < 0)
+
+    binomial_test = np.full(area_top.shape, np.nan)
+    arg = area_top[do_test], area_tot[do_test], aft_prob[do_test]
+    if mode == 'discrete':
+        binomial_test[do_test] = binom_pmf(*arg)
+    else:
+        binomial_test[do_test] = binom_test(*arg)
+    return binomial_test[()]
@@ -133,7 +133,7 @@ class EventBasics(strax.Plugin):
     The main S2 and alternative S2 are given by the largest two S2-Peaks
     within the event. By default this is also true for S1.
     """
-    __version__ = '1.0.0'
+    __version__ = '1.0.1'
 
     depends_on = ('events',
                   'peak_basics',
@@ -172,6 +172,7 @@ class EventBasics(strax.Plugin):
         ]
 
         dtype += self._get_posrec_dtypes()
+        self._set_peak_field_map()
         return dtype
 
     def _set_dtype_requirements(self):
@@ -262,149 +263,204 @@ class EventBasics(strax.Plugin):
             else:
                 buffer[field][:] = np.nan
 
+    def _set_peak_field_map(self):
+        """
+        Set the table of which peak field is copied into which event
+        field, for the main S1, alternate S1, main S2 and alternate S2
+        (in that order, see fill_events)
+        """
+        self.peak_field_map = []
+        for s_i in [1, 2]:
+            peak_fields = [name for name, _, _ in self.peak_properties]
+            if s_i == 2:
+                peak_fields += ['x', 'y']
+                peak_fields += self.posrec_save
+            for largest_index, main_or_alt in enumerate(['s', 'alt_s']):
+                peak_i = 2 * (s_i - 1) + largest_index
+                for p_field in peak_fields:
+                    self.peak_field_map.append(
+                        (f'{main_or_alt}{s_i}_{p_field}', p_field, peak_i))
+
     def compute(self, events, peaks):
         result = np.zeros(len(events), dtype=self.dtype)
         self.set_nan_defaults(result)
 
-        split_peaks = strax.split_by_containment(peaks, events)
-        self.fill_events(result, events, split_peaks)
+        # The peaks in an event are consecutive in the contained peaks
+        container = strax.fully_contained_in(peaks, events)
+        peaks = peaks[container != -1]
+        container = container[container != -1]
+        event_i = np.arange(len(events))
+        peak_ranges = np.stack([np.searchsorted(container, event_i, side='left'),
+                                np.searchsorted(container, event_i, side='right')],
+                               axis=1)
+        no_peaks = peak_ranges[:, 0] == peak_ranges[:, 1]
+        if np.any(no_peaks):
+            raise ValueError(f'No peaks within event?\n{events[no_peaks][0]}')
+
+        self.fill_events(result, events, peaks, peak_ranges)
         return result
 
-    # If copy_largest_peaks_into_event is ever numbafied, also numbafy this function
-    def fill_events(self, result_buffer, events, split_peaks):
-        """Loop over the events and peaks within that event"""
-        for event_i, _ in enumerate(events):
-            peaks_in_event_i = split_peaks[event_i]
-            n_peaks = len(peaks_in_event_i)
-
-            result_buffer[event_i]['time'] = events[event_i]['time']
-            result_buffer[event_i]['endtime'] = events[event_i]['endtime']
-            result_buffer[event_i]['n_peaks'] = n_peaks
-
-            if not n_peaks:
-                raise ValueError(f'No peaks within event?\n{events[event_i]}')
-
-            self.fill_result_i(result_buffer[event_i], peaks_in_event_i)
-
-    def fill_result_i(self, event, peaks):
-        """For a single event with the result_buffer"""
-        # Consider S2s first, then S1s (to enable allow_posts2_s1s = False)
-        largest_s2s, s2_idx = self.get_largest_sx_peaks(peaks, s_i=2)
-
-        if self.config['force_main_before_alt']:
-            s2_order = np.argsort(largest_s2s['time'])
-            largest_s2s = largest_s2s[s2_order]
-            s2_idx = s2_idx[s2_order]
+    def fill_events(self, result, events, peaks, peak_ranges):
+        """
+        Fill the result for the events, with peaks[peak_ranges[i, 0]:
+        peak_ranges[i, 1]] the peaks in event i.
 
-        if not self.config['allow_posts2_s1s'] and len(largest_s2s):
-            s1_latest_time = largest_s2s[0]['time']
-        else:
-            s1_latest_time = np.inf
+        Fields with the same dtype in the peaks and the events are copied
+        as bytes by _fill_events, the others (if any) are cast here.
+        """
+        copy_table, cast_fields = [], []
+        for ev_field, p_field, peak_i in self.peak_field_map:
+            if result.dtype[ev_field] == peaks.dtype[p_field]:
+                copy_table.append((peak_i,
+                                   result.dtype.fields[ev_field][1],
+                                   peaks.dtype.fields[p_field][1],
+                                   peaks.dtype[p_field].itemsize))
+            else:
+                cast_fields.append((ev_field, p_field, peak_i))
+        copy_table = np.array(copy_table, dtype=np.int64).reshape(-1, 4)
 
-        largest_s1s, s1_idx = self.get_largest_sx_peaks(
+        largest_peaks = _fill_events(
+            result,
+            result.view(np.uint8).reshape(len(result), result.dtype.itemsize),
+            events,
             peaks,
-            s_i=1,
-            s1_before_time=s1_latest_time,
+            peaks.view(np.uint8).reshape(len(peaks), peaks.dtype.itemsize),
+            peak_ranges,
+            copy_table,
+            allow_posts2_s1s=self.config['allow_posts2_s1s'],
+            force_main_before_alt=self.config['force_main_before_alt'],
             s1_min_coincidence=self.config['event_s1_min_coincidence'])
 
-        self.set_sx_index(event, s1_idx, s2_idx)
-        self.set_event_properties(event, largest_s1s, largest_s2s, peaks)
+        for ev_field, p_field, peak_i in cast_fields:
+            found = largest_peaks[:, peak_i] != -1
+            result[ev_field][found] = peaks[p_field][largest_peaks[found, peak_i]]
 
-        # Loop over S1s and S2s and over main / alt.
-        for s_i, largest_s_i in enumerate([largest_s1s, largest_s2s], 1):
-            # Largest index 0 -> main sx, 1 -> alt sx
-            for largest_index, main_or_alt in enumerate(['s', 'alt_s']):
-                peak_properties_to_save = [name for name, _, _ in self.peak_properties]
-                if s_i == 2:
-                    peak_properties_to_save += ['x', 'y']
-                    peak_properties_to_save += self.posrec_save
-                field_names = [f'{main_or_alt}{s_i}_{name}' for name in peak_properties_to_save]
-                self.copy_largest_peaks_into_event(event,
-                                                   largest_s_i,
-                                                   largest_index,
-                                                   field_names,
-                                                   peak_properties_to_save)
 
-    @staticmethod
-    @numba.njit
-    def set_event_properties(result, largest_s1s, largest_s2s, peaks):
-        """Get properties like drift time and area before main S2"""
+@numba.njit(cache=True, nogil=True)
+def _fill_events(result, result_bytes, events, peaks, peaks_bytes,
+                 peak_ranges, copy_table,
+                 allow_posts2_s1s, force_main_before_alt, s1_min_coincidence):
+    """
+    Fill the event basics of all events.
+
+    :param result_bytes, peaks_bytes: the result and peaks viewed as
+        (n, itemsize) uint8 arrays
+    :param copy_table: rows of (peak, offset in result, offset in peaks,
+        number of bytes), where peak 0, 1, 2 and 3 are the main S1,
+        alternate S1, main S2 and alternate S2
+    :returns: (n_events, 4) array with the index in peaks of the main
+        S1, alternate S1, main S2 and alternate S2 (-1 if there is none)
+    """
+    largest_peaks = np.full((len(events), 4), -1, dtype=np.int64)
+    for event_i, event in enumerate(events):
+        res = result[event_i]
+        start, stop = peak_ranges[event_i]
+        res['time'] = event['time']
+        res['endtime'] = event['endtime']
+        res['n_peaks'] = stop - start
+
+        # Consider S2s first, then S1s (to enable allow_posts2_s1s = False)
+        s2, alt_s2 = _largest_two_peaks(peaks, start, stop, 2, 0, 0, False)
+        if force_main_before_alt and alt_s2 != -1:
+            if peaks[alt_s2]['time'] < peaks[s2]['time']:
+                s2, alt_s2 = alt_s2, s2
+
+        before_s2 = not allow_posts2_s1s and s2 != -1
+        s1_latest_time = peaks[s2]['time'] if before_s2 else 0
+        s1, alt_s1 = _largest_two_peaks(peaks, start, stop, 1,
+                                        s1_latest_time, s1_min_coincidence,
+                                        before_s2)
+
+        largest_peaks[event_i, 0] = s1
+        largest_peaks[event_i, 1] = alt_s1
+        largest_peaks[event_i, 2] = s2
+        largest_peaks[event_i, 3] = alt_s2
+        if s1 != -1:
+            res['s1_index'] = s1 - start
+            if alt_s1 != -1:
+                res['alt_s1_index'] = alt_s1 - start
+        if s2 != -1:
+            res['s2_index'] = s2 - start
+            if alt_s2 != -1:
+                res['alt_s2_index'] = alt_s2 - start
+
         # Compute drift times only if we have a valid S1-S2 pair
-        if len(largest_s1s) > 0 and len(largest_s2s) > 0:
-            result['drift_time'] = largest_s2s[0]['center_time'] - largest_s1s[0]['center_time']
-            if len(largest_s1s) > 1:
-                result['alt_s1_interaction_drift_time'] = largest_s2s[0]['center_time'] - largest_s1s[1]['center_time']
-            if len(largest_s2s) > 1:
-                result['alt_s2_interaction_drift_time'] = largest_s2s[1]['center_time'] - largest_s1s[0]['center_time']
-
-        # areas before main S2
-        if len(largest_s2s):
-            peaks_before_ms2 = peaks[peaks['time'] < largest_s2s[0]['time']]
-            result['area_before_main_s2'] = np.sum(peaks_before_ms2['area'])
-
-            s2peaks_before_ms2 = peaks_before_ms2[peaks_before_ms2['type'] == 2]
-            if len(s2peaks_before_ms2) == 0:
-                result['large_s2_before_main_s2'] = 0
-            else:
-                result['large_s2_before_main_s2'] = np.max(s2peaks_before_ms2['area'])
-        return result
+        if s1 != -1 and s2 != -1:
+            res['drift_time'] = peaks[s2]['center_time'] - peaks[s1]['center_time']
+            if alt_s1 != -1:
+                res['alt_s1_interaction_drift_time'] = (
+                        peaks[s2]['center_time'] - peaks[alt_s1]['center_time'])
+            if alt_s2 != -1:
+                res['alt_s2_interaction_drift_time'] = (
+                        peaks[alt_s2]['center_time'] - peaks[s1]['center_time'])
+
+        # Areas before main S2
+        if s2 != -1:
+            area_before = np.float32(0)
+            # 0 only if there is no S2 before the main S2, the areas
+            # can be negative
+            large_s2_before = np.float32(0)
+            found_s2_before = False
+            for peak_i in range(start, stop):
+                p = peaks[peak_i]
+                if p['time'] >= peaks[s2]['time']:
+                    continue
+                area_before += p['area']
+                if p['type'] != 2:
+                    continue
+                if not found_s2_before:
+                    large_s2_before = p['area']
+                    found_s2_before = True
+                # Like np.max, the first nan is the maximum
+                elif (large_s2_before == large_s2_before
+                        and not p['area'] <= large_s2_before):
+                    large_s2_before = p['area']
+            res['area_before_main_s2'] = area_before
+            res['large_s2_before_main_s2'] = large_s2_before
+
+        # Copy the peak properties
+        for copy_i in range(len(copy_table)):
+            p_i = largest_peaks[event_i, copy_table[copy_i, 0]]
+            if p_i == -1:
+                continue
+            res_offset, peak_offset = copy_table[copy_i, 1], copy_table[copy_i, 2]
+            for b in range(copy_table[copy_i, 3]):
+                result_bytes[event_i, res_offset + b] = peaks_bytes[p_i, peak_offset + b]
+    return largest_peaks
+
+
+@numba.njit(cache=True, nogil=True)
+def _largest_two_peaks(peaks, start, stop, s_i,
+                       s1_latest_time, s1_min_coincidence, before_s1_latest_time):
+    """
+    Get the index of the largest and second largest S1/S2 in
+    peaks[start:stop] (or -1). For S1s require a min coincidence and,
+    if before_s1_latest_time, a time before s1_latest_time.
 
-    @staticmethod
-    # @numba.njit <- works but slows if fill_events is not numbafied
-    def get_largest_sx_peaks(peaks,
-                             s_i,
-                             s1_before_time=np.inf,
-                             s1_min_coincidence=0,
-                             number_of_peaks=2):
-        """Get the largest S1/S2. For S1s allow a min coincidence and max time"""
-        # Find all peaks of this type (S1 or S2)
-        s_mask = peaks['type'] == s_i
+    Like np.argsort, a nan area is larger than any other area. Of equal
+    areas, the last peak is the larger, as in a stable sort.
+    """
+    largest, second = -1, -1
+    for peak_i in range(start, stop):
+        p = peaks[peak_i]
+        if p['type'] != s_i:
+            continue
         if s_i == 1:
-            s_mask &= peaks['time'] < s1_before_time
-            s_mask &= peaks['tight_coincidence'] >= s1_min_coincidence
+            if before_s1_latest_time and p['time'] >= s1_latest_time:
+                continue
+            if p['tight_coincidence'] < s1_min_coincidence:
+                continue
+        if largest == -1 or _not_smaller(p['area'], peaks[largest]['area']):
+            largest, second = peak_i, largest
+        elif second == -1 or _not_smaller(p['area'], peaks[second]['area']):
+            second = peak_i
+    return largest, second
 
-        selected_peaks = peaks[s_mask]
-        s_index = np.arange(len(peaks))[s_mask]
-        largest_peaks = np.argsort(selected_peaks['area'])[-number_of_peaks:][::-1]
-        return selected_peaks[largest_peaks], s_index[largest_peaks]
 
-    # If only we could numbafy this... Unfortunatly we cannot.
-    # Perhaps we could one day consider doing something like strax.copy_to_buffer
-    @staticmethod
-    def copy_largest_peaks_into_event(result,
-                                      largest_s_i,
-                                      main_or_alt_index,
-                                      result_fields,
-                                      peak_fields,
-                                      ):
-        """
-        For one event, write all the peak_fields (e.g. "area") of the peak
-        (largest_s_i) into their associated field in the event (e.g. s1_area),
-        main_or_alt_index differentiates between main (index 0) and alt (index 1)
-        """
-        index_not_in_list_of_largest_peaks = main_or_alt_index >= len(largest_s_i)
-        if index_not_in_list_of_largest_peaks:
-            # There is no such peak. E.g. main_or_alt_index == 1 but largest_s_i = ["Main S1"]
-            # Asking for index 1 doesn't work on a len 1 list of peaks.
-            return
-
-        for i, ev_field in enumerate(result_fields):
-            p_field = peak_fields[i]
-            if p_field not in ev_field:
-                raise ValueError("Event fields must derive from the peak fields")
-            result[ev_field] = largest_s_i[main_or_alt_index][p_field]
-
-    @staticmethod
-    # @numba.njit <- works but slows if fill_events is not numbafied
-    def set_sx_index(res, s1_idx, s2_idx):
-        if len(s1_idx):
-            res['s1_index'] = s1_idx[0]
-            if len(s1_idx) > 1:
-                res['alt_s1_index'] = s1_idx[1]
-        if len(s2_idx):
-            res['s2_index'] = s2_idx[0]
-            if len(s2_idx) > 1:
-                res['alt_s2_index'] = s2_idx[1]
+@numba.njit(cache=True, nogil=True)
+def _not_smaller(area, other_area):
+    """Whether area sorts after other_area, if it comes after it"""
+    return np.isnan(area) or (not np.isnan(other_area) and area >= other_area)
 
 
 @export
@@ -429,6 +485,12 @@ class EventBasics(strax.Plugin):
             (170704_0556, pax_file('XENON1T_FDC_SR1_data_driven_time_dependent_3d_correction_tf_nn_part3_v1.json.gz')), # noqa
             (170925_0622, pax_file('XENON1T_FDC_SR1_data_driven_time_dependent_3d_correction_tf_nn_part4_v1.json.gz'))], # noqa
     ),
+    strax.Option(
+        name='fdc_map_method',
+        default='WeightedNearestNeighbors',
+        help='Interpolation method of the fdc_map, see InterpolatingMap. '
+             'MultilinearGrid is faster for maps on a rectangular grid.'
+    ),
     *DEFAULT_POSREC_ALGO_OPTION
 )
 class EventPositions(strax.Plugin):
@@ -472,7 +534,8 @@ class EventPositions(strax.Plugin):
         
         if isinstance(self.config['fdc_map'], str):
             self.map = InterpolatingMap(
-                get_resource(self.config['fdc_map'], fmt='binary'))
+                get_resource(self.config['fdc_map'], fmt='binary'),
+                method=self.config['fdc_map_method'])
 
         elif is_cmt_option(self.config['fdc_map']):
             self.map = InterpolatingMap(
@@ -480,7 +543,8 @@ class EventPositions(strax.Plugin):
                                  tuple(['suffix',
                                         self.config['default_reconstruction_algorithm'],
                                         *self.config['fdc_map']]),
-                                 fmt='binary'))
+                                 fmt='binary'),
+                method=self.config['fdc_map_method'])
             self.map.scale_coordinates([1., 1., - self.electron_drift_velocity])
 
         else:
@@ -541,6 +605,16 @@ class EventPositions(strax.Plugin):
         default_by_run=[
             (0, pax_file('XENON1T_s2_xy_ly_SR0_24Feb2017.json')),
             (170118_1327, pax_file('XENON1T_s2_xy_ly_SR1_v2.2.json'))]),
+    strax.Option(
+        's1_xyz_correction_map_method',
+        default='WeightedNearestNeighbors',
+        help='Interpolation method of the s1_xyz_correction_map, see '
+             'InterpolatingMap'),
+    strax.Option(
+        's2_xy_correction_map_method',
+        default='WeightedNearestNeighbors',
+        help='Interpolation method of the s2_xy_correction_map, see '
+             'InterpolatingMap'),
    strax.Option(
         'elife_conf',
         default=("elife", "ONLINE", True),
@@ -585,12 +659,14 @@ class CorrectedAreas(strax.Plugin):
                              tuple(['suffix',
                                     self.config['default_reconstruction_algorithm'],
                                     *self.config['s1_xyz_correction_map']]),
-                             fmt='text'))
+                             fmt='text'),
+            method=self.config['s1_xyz_correction_map_method'])
 
         self.s2_map = InterpolatingMap(
             get_cmt_resource(self.run_id,
                              tuple([*self.config['s2_xy_correction_map']]),
-                             fmt='text'))
+                             fmt='text'),
+            method=self.config['s2_xy_correction_map_method'])
 
     def compute(self, events):
         # S1 corrections depend on the actual corrected event position.
@@ -27,7 +27,7 @@ class PeakBasics(strax.Plugin):
     arrays.
     NB: This plugin can therefore be loaded as a pandas DataFrame.
     """
-    __version__ = "0.0.9"
+    __version__ = "0.0.10"
     parallel = True
     depends_on = ('peaks',)
     provides = 'peak_basics'
@@ -66,33 +66,10 @@ class PeakBasics(strax.Plugin):
     ]
 
     def compute(self, peaks):
-        p = peaks
-        r = np.zeros(len(p), self.dtype)
-        for q in 'time length dt area type'.split():
-            r[q] = p[q]
-        r['endtime'] = p['time'] + p['dt'] * p['length']
-        r['n_channels'] = (p['area_per_channel'] > 0).sum(axis=1)
-        r['range_50p_area'] = p['width'][:, 5]
-        r['range_90p_area'] = p['width'][:, 9]
-        r['max_pmt'] = np.argmax(p['area_per_channel'], axis=1)
-        r['max_pmt_area'] = np.max(p['area_per_channel'], axis=1)
-        r['tight_coincidence'] = p['tight_coincidence']
-
-        n_top = self.config['n_top_pmts']
-        area_top = p['area_per_channel'][:, :n_top].sum(axis=1)
-        # Recalculate to prevent numerical inaccuracy #442
-        area_total = p['area_per_channel'].sum(axis=1)
-        # Negative-area peaks get NaN AFT
-        m = p['area'] > 0
-        r['area_fraction_top'][m] = area_top[m]/area_total[m]
-        r['area_fraction_top'][~m] = float('nan')
-        r['rise_time'] = -p['area_decile_from_midpoint'][:, 1]
-
+        r = np.zeros(len(peaks), self.dtype)
+        area_total = compute_peak_basics(peaks, self.config['n_top_pmts'], r)
         if self.config['check_peak_sum_area_rtol'] is not None:
-            self.check_area(area_total, p, self.config['check_peak_sum_area_rtol'])
-        # Negative or zero-area peaks have centertime at startime
-        r['center_time'] = p['time']
-        r['center_time'][m] += self.compute_center_times(peaks[m])
+            self.check_area(area_total, peaks, self.config['check_peak_sum_area_rtol'])
         return r
 
     @staticmethod
@@ -100,10 +77,7 @@ class PeakBasics(strax.Plugin):
     def compute_center_times(peaks):
         result = np.zeros(len(peaks), dtype=np.int32)
         for p_i, p in enumerate(peaks):
-            t = 0
-            for t_i, weight in enumerate(p['data']):
-                t += t_i * p['dt'] * weight
-            result[p_i] = t / p['area']
+            result[p_i] = _center_time(p)
         return result
 
     @staticmethod
@@ -143,10 +117,94 @@ class PeakBasics(strax.Plugin):
             raise ValueError(message)
 
 
+@export
+@numba.njit(cache=True, nogil=True)
+def compute_peak_basics(peaks, n_top_pmts, result):
+    """
+    Fill all fields of PeakBasics in a single pass over each peak.
+
+    The sums over the area per channel are accumulated in float64, so
+    they can differ from the (float32) numpy sums by rounding only.
+
+    :param peaks: peaks (or peaklets) to compute the basics of
+    :param n_top_pmts: number of top PMTs
+    :param result: array of len(peaks) with the PeakBasics dtype, which
+        is filled in place
+    :returns: sum of the area per channel of each peak
+    """
+    area_total = np.zeros(len(peaks), dtype=np.float32)
+    if not len(peaks):
+        return area_total
+    for p_i, p in enumerate(peaks):
+        r = result[p_i]
+        r['time'] = p['time']
+        r['endtime'] = p['time'] + p['dt'] * p['length']
+        r['length'] = p['length']
+        r['dt'] = p['dt']
+        r['area'] = p['area']
+        r['type'] = p['type']
+        r['tight_coincidence'] = p['tight_coincidence']
+        r['range_50p_area'] = p['width'][5]
+        r['range_90p_area'] = p['width'][9]
+        r['rise_time'] = -p['area_decile_from_midpoint'][1]
+
+        area_per_channel = p['area_per_channel']
+        n_contributing = 0
+        max_pmt_area = area_per_channel[0]
+        has_nan = False
+        total = 0.
+        area_top = 0.
+        for ch_i, area in enumerate(area_per_channel):
+            n_contributing += area > 0
+            max_pmt_area = area if area > max_pmt_area else max_pmt_area
+            has_nan |= area != area
+            total += area
+            if ch_i < n_top_pmts:
+                area_top += area
+        # Like np.argmax, the first nan is the maximum
+        max_pmt = 0
+        if has_nan:
+            while area_per_channel[max_pmt] == area_per_channel[max_pmt]:
+                max_pmt += 1
+            max_pmt_area = area_per_channel[max_pmt]
+        else:
+            while area_per_channel[max_pmt] != max_pmt_area:
+                max_pmt += 1
+        r['n_channels'] = n_contributing
+        r['max_pmt'] = max_pmt
+        r['max_pmt_area'] = max_pmt_area
+
+        # Recalculate to prevent numerical inaccuracy #442
+        area_total[p_i] = total
+        if p['area'] > 0:
+            if total != 0:
+                r['area_fraction_top'] = area_top / total
+            else:
+                # As numpy does, rather than raising a ZeroDivisionError
+                r['area_fraction_top'] = np.inf * area_top if area_top != 0 else np.nan
+            r['center_time'] = p['time'] + _center_time(p)
+        else:
+            # Negative-area peaks get NaN AFT and have centertime at
+            # starttime
+            r['area_fraction_top'] = np.nan
+            r['center_time'] = p['time']
+    return area_total
+
+
+@numba.njit(cache=True, nogil=True)
+def _center_time(peak):
+    """Weighted center time of the peak w.r.t. its start (truncated to
+    an int32 number of ns)"""
+    t = 0
+    for t_i, weight in enumerate(peak['data']):
+        t += t_i * peak['dt'] * weight
+    return np.int32(t / peak['area'])
+
+
 @export
 class PeakBasicsHighEnergy(PeakBasics):
     __doc__ = HE_PREAMBLE + PeakBasics.__doc__
-    __version__ = '0.0.2'
+    __version__ = '0.0.3'
     depends_on = 'peaks_he'
     provides = 'peak_basics_he'
     child_ends_with = '_he'
@@ -313,14 +371,104 @@ class PeakProximity(strax.OverlapWindowPlugin):
     @staticmethod
     @numba.jit(nopython=True, nogil=True, cache=True)
     def find_n_competing(peaks, windows, fraction):
+        """
+        Count the peaks in the window of each peak with an area larger
+        than fraction times the area of the peak.
+
+        Peaks in small windows are counted directly. For the others,
+        each count is the difference of the number of larger peaks
+        before two indices, which are counted for all of them at once
+        in O(n log n) with _count_larger_before.
+
+        :param peaks: peaks, sorted by time
+        :param windows: indices of the first and (exclusive) last peak
+            in the window of each peak (see strax.touching_windows)
+        :param fraction: minimum fraction of the area of the peak for a
+            peak to be competing
+        :returns: number of competing peaks left of each peak, and in
+            total
+        """
         n_left = np.zeros(len(peaks), dtype=np.int32)
         n_tot = n_left.copy()
         areas = peaks['area']
 
-        for i, peak in enumerate(peaks):
+        large_windows = np.zeros(len(peaks), dtype=np.int64)
+        n_large = 0
+        for i in range(len(peaks)):
             left_i, right_i = windows[i]
             threshold = areas[i] * fraction
+            if right_i - left_i > _MAX_DIRECT_WINDOW:
+                large_windows[n_large] = i
+                n_large += 1
+                continue
             n_left[i] = np.sum(areas[left_i:i] > threshold)
             n_tot[i] = n_left[i] + np.sum(areas[i + 1:right_i] > threshold)
-
+        if not n_large:
+            return n_left, n_tot
+        large_windows = large_windows[:n_large]
+
+        # Count the larger peaks before the start of the window, the
+        # peak itself, the peak after it and the end of the window
+        indices = np.zeros(4 * n_large, dtype=np.int64)
+        thresholds = np.zeros(4 * n_large, dtype=np.float64)
+        for j, i in enumerate(large_windows):
+            indices[4 * j] = windows[i, 0]
+            indices[4 * j + 1] = i
+            indices[4 * j + 2] = i + 1
+            indices[4 * j + 3] = windows[i, 1]
+            thresholds[4 * j:4 * j + 4] = areas[i] * fraction
+        n_larger = _count_larger_before(areas, indices, thresholds)
+
+        for j, i in enumerate(large_windows):
+            n_left[i] = n_larger[4 * j + 1] - n_larger[4 * j]
+            n_tot[i] = n_left[i] + n_larger[4 * j + 3] - n_larger[4 * j + 2]
         return n_left, n_tot
+
+
+# Above this number of peaks in a window, counting the competing peaks
+# with a Fenwick tree is faster than counting directly
+_MAX_DIRECT_WINDOW = 256
+
+
+@numba.njit(cache=True, nogil=True)
+def _count_larger_before(values, indices, thresholds):
+    """
+    For each query q, count the values before indices[q] that are
+    larger than thresholds[q] (an offline Fenwick tree over the ranks
+    of the values).
+
+    Values and thresholds that are NaN are never larger.
+    """
+    n_values = len(values)
+    sorted_values = np.sort(values.astype(np.float64))
+    # NaNs are sorted to the end
+    n_finite = n_values
+    while n_finite and np.isnan(sorted_values[n_finite - 1]):
+        n_finite -= 1
+    sorted_values = sorted_values[:n_finite]
+    ranks = np.searchsorted(sorted_values, values.astype(np.float64))
+
+    tree = np.zeros(n_finite + 1, dtype=np.int64)
+    result = np.zeros(len(indices), dtype=np.int64)
+    n_inserted = 0
+    value_i = 0
+    for q in np.argsort(indices, kind='mergesort'):
+        while value_i < min(indices[q], n_values):
+            if not np.isnan(values[value_i]):
+                # Fenwick trees are indexed from 1
+                j = ranks[value_i] + 1
+                while j <= n_finite:
+                    tree[j] += 1
+                    j += j & -j
+                n_inserted += 1
+            value_i += 1
+        if np.isnan(thresholds[q]):
+            continue
+        # Number of inserted values <= threshold
+        j = np.searchsorted(sorted_values, thresholds[q], side='right')
+        n_not_larger = 0
+        while j > 0:
+            n_not_larger += tree[j]
+            j -= j & -j
+        result[q] = n_inserted - n_not_larger
+    return result
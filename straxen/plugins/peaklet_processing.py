@@ -1,9 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 import numba
 import numpy as np
 import strax
 from strax.processing.general import _touching_windows
 import straxen
 from .pulse_processing import HITFINDER_OPTIONS, HITFINDER_OPTIONS_he, HE_PREAMBLE
+from .pulse_processing import hit_max_sample
 from straxen.get_corrections import is_cmt_option
 
 
@@ -63,6 +65,11 @@ FAKE_MERGED_S2_TYPE = -42
                       "to correct saturated samples"),
     strax.Option('peaklet_max_duration', default=int(10e6),
                  help="Maximum duration [ns] of a peaklet"),
+    strax.Option('peaklet_threads', default=1, track=False, type=int,
+                 help="Number of threads used to find the peaklets in a "
+                      "chunk. The chunk is split into segments at gaps "
+                      "without records that are longer than the "
+                      "peaklet_gap_threshold plus the peak extensions."),
     *HITFINDER_OPTIONS,
 )
 class Peaklets(strax.Plugin):
@@ -123,15 +130,87 @@ class Peaklets(strax.Plugin):
             self.hit_thresholds = self.config['hit_min_amplitude']
 
     def compute(self, records, start, end):
-        r = records
+        return self.compute_in_segments(records, start, end)
 
-        hits = strax.find_hits(r, min_amplitude=self.hit_thresholds)
+    def compute_in_segments(self, records, start, end,
+                            hits=None, hits_max_sample=None):
+        """
+        Split records at long gaps, in which no peaklet can start or
+        end, and find the peaklets in each segment in a thread pool.
+        The result is the same as when processing all records at once.
+
+        :param hits: hits in records, sorted by time, with record_i
+            referring to records. If None, find the hits in each segment.
+        :param hits_max_sample: index of the maximum sample of the hits
+        """
+        n_threads = self.config['peaklet_threads']
+        breaks = np.zeros(0, dtype=np.int64)
+        if n_threads > 1:
+            min_gap = (self.config['peaklet_gap_threshold']
+                       + self.config['peak_left_extension']
+                       + self.config['peak_right_extension'])
+            # Use a few segments per thread to balance the load
+            breaks = segment_breaks(records, min_gap, n_segments=4 * n_threads)
+
+        if not len(breaks):
+            return self.compute_segment(records, start, end,
+                                        hits=hits,
+                                        hits_max_sample=hits_max_sample)
+
+        record_bounds = np.concatenate([[0], breaks, [len(records)]])
+        if hits is not None:
+            hit_bounds = np.concatenate([
+                [0],
+                np.searchsorted(hits['time'], records['time'][breaks]),
+                [len(hits)]])
+
+        def _compute_segment(i):
+            r_start, r_end = record_bounds[i], record_bounds[i + 1]
+            if hits is None:
+                segment_hits = segment_hits_max_sample = None
+            else:
+                segment_hits = hits[hit_bounds[i]:hit_bounds[i + 1]].copy()
+                segment_hits['record_i'] -= r_start
+                segment_hits_max_sample = hits_max_sample[hit_bounds[i]:hit_bounds[i + 1]]
+            return self.compute_segment(records[r_start:r_end], start, end,
+                                        hits=segment_hits,
+                                        hits_max_sample=segment_hits_max_sample)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(_compute_segment, range(len(record_bounds) - 1)))
+
+        for i, result in enumerate(results):
+            # The record index of lone hits refers to all records
+            result['lone_hits']['record_i'] += record_bounds[i]
+        return {d: np.concatenate([result[d] for result in results])
+                for d in results[0]}
+
+    def compute_segment(self, records, start, end,
+                        hits=None, hits_max_sample=None):
+        """Find the peaklets and lone hits in (a segment of) records"""
+        if hits is not None:
+            return self.compute_from_hits(records, hits, start, end,
+                                          hits_max_sample=hits_max_sample)
+
+        hits = strax.find_hits(records, min_amplitude=self.hit_thresholds)
 
         # Remove hits in zero-gain channels
         # they should not affect the clustering!
         hits = hits[self.to_pe[hits['channel']] != 0]
 
         hits = strax.sort_by_time(hits)
+        return self.compute_from_hits(records, hits, start, end)
+
+    def compute_from_hits(self, records, hits, start, end,
+                          hits_max_sample=None):
+        """
+        Find the peaklets and lone hits in records
+
+        :param hits: hits in records, sorted by time
+        :param hits_max_sample: index of the maximum sample of the hits,
+            if None, compute it from the records.
+        """
+        r = records
 
         # Use peaklet gap threshold for initial clustering
         # based on gaps between hits
@@ -186,6 +265,11 @@ class Peaklets(strax.Plugin):
             r = r.copy()
 
         if self.config['saturation_correction_on']:
+            if hits_max_sample is not None:
+                # The correction changes the records (if writeable), in
+                # which case the maximum of the hits changes too
+                hits_max_sample = hits_max_sample.copy()
+                redo = hits_in_saturated_peaks(records, hits, peaklets)
             peak_list = peak_saturation_correction(
                 r, peaklets, self.to_pe,
                 reference_length=self.config['saturation_reference_length'],
@@ -194,6 +278,12 @@ class Peaklets(strax.Plugin):
             # Compute the width again for corrected peaks
             strax.compute_widths(peaklets, select_peaks_indices=peak_list)
 
+            if hits_max_sample is not None:
+                hits_max_sample[redo] = hit_max_sample(records, hits[redo])
+
+        if hits_max_sample is None:
+            hits_max_sample = hit_max_sample(records, hits)
+
         # Compute tight coincidence level.
         # Making this a separate plugin would
         # (a) doing hitfinding yet again (or storing hits)
@@ -201,7 +291,7 @@ class Peaklets(strax.Plugin):
         #     possibly due to its currently primitive scheduling.
         hit_max_times = np.sort(
             hits['time']
-            + hits['dt'] * hit_max_sample(records, hits))
+            + hits['dt'] * hits_max_sample)
         peaklet_max_times = (
                 peaklets['time']
                 + np.argmax(peaklets['data'], axis=1) * peaklets['dt'])
@@ -254,6 +344,104 @@ class Peaklets(strax.Plugin):
                 p['length'] = (end - p['time']) // p['dt']
 
 
+@export
+class PeakletsFromHits(Peaklets):
+    """
+    Peaklets and lone_hits from the hits provided by the Hits plugin,
+    rather than by repeating the hitfinding on the records. The results
+    are the same as those of Peaklets.
+
+    Register this plugin (and Hits) instead of Peaklets if the records
+    and hits are stored and only the clustering options change.
+    """
+    depends_on = ('records', 'hits')
+
+    def compute(self, records, hits, start, end):
+        # Remove hits in zero-gain channels
+        hits = hits[self.to_pe[hits['channel']] != 0]
+        hits_max_sample = hits['max_sample']
+
+        # Convert to the normal hit dtype, and find the records of the
+        # hits in case the chunks of records were split
+        result = np.zeros(len(hits), dtype=strax.hit_dtype)
+        strax.copy_to_buffer(hits, result, '_copy_hits_max_sample_to_hits')
+        n_channels = max(records['channel'].max(initial=0),
+                         hits['channel'].max(initial=0)) + 1
+        _set_hits_record_i(records, result, n_channels)
+
+        return self.compute_in_segments(records, start, end,
+                                        hits=result,
+                                        hits_max_sample=hits_max_sample)
+
+
+@numba.njit(cache=True, nogil=True)
+def _set_hits_record_i(records, hits, n_channels):
+    """Set record_i of the hits to the index of the record they are in.
+    Both records and hits should be sorted by time.
+    """
+    last_record = np.full(n_channels, -1, dtype=np.int64)
+    r_i = 0
+    for h in hits:
+        while r_i < len(records) and records[r_i]['time'] <= h['time']:
+            last_record[records[r_i]['channel']] = r_i
+            r_i += 1
+        record_i = last_record[h['channel']]
+        if (record_i == -1
+                or records[record_i]['time'] + h['left'] * h['dt'] != h['time']):
+            raise ValueError("Cannot find the record of a hit!")
+        h['record_i'] = record_i
+
+
+@numba.njit(nogil=True, cache=True)
+def _segment_break_candidates(records, min_gap):
+    """Return indices of records before which no record ends within
+    min_gap. Records should be sorted by time.
+    """
+    result = np.zeros(len(records), dtype=np.int64)
+    n = 0
+    last_end = records[0]['time']
+    for r_i, r in enumerate(records):
+        if r_i and r['time'] - last_end > min_gap:
+            result[n] = r_i
+            n += 1
+        last_end = max(last_end, strax.endtime(r))
+    return result[:n]
+
+
+def segment_breaks(records, min_gap, n_segments):
+    """Return the indices at which to split records into at most
+    n_segments segments of a similar number of records, such that no
+    two records in different segments are within min_gap of each other.
+    """
+    if len(records) < 2 or n_segments < 2:
+        return np.zeros(0, dtype=np.int64)
+    candidates = _segment_break_candidates(records, min_gap)
+    if not len(candidates):
+        return candidates
+    targets = np.arange(1, n_segments) * len(records) / n_segments
+    i = np.clip(np.searchsorted(candidates, targets), 0, len(candidates) - 1)
+    return np.unique(candidates[i])
+
+
+def hits_in_saturated_peaks(records, hits, peaks):
+    """Return mask of hits in records which touch peaks with saturated
+    channels, i.e. which may be changed by peak_saturation_correction
+    """
+    result = np.zeros(len(hits), dtype=np.bool_)
+    peaks = peaks[peaks['n_saturated_channels'] > 0]
+    if not len(records) or not len(peaks):
+        return result
+    record_ranges = _touching_windows(
+        records['time'],
+        strax.endtime(records),
+        peaks['time'],
+        strax.endtime(peaks))
+    in_saturated_peak = np.zeros(len(records), dtype=np.bool_)
+    for start, end in record_ranges:
+        in_saturated_peak[start:end] = True
+    return in_saturated_peak[hits['record_i']]
+
+
 @numba.jit(nopython=True, nogil=True, cache=True)
 def peak_saturation_correction(records, peaks, to_pe,
                                reference_length=100,
@@ -497,8 +685,9 @@ class PeakletClassification(strax.Plugin):
 
         ptype = np.zeros(len(peaklets), dtype=np.int8)
 
-        # Properties needed for classification. Bit annoying these computations
-        # are duplicated in peak_basics curently...
+        # Properties needed for classification. compute_peak_basics fills
+        # these too, but also all other peak basics (e.g. the center time,
+        # from the waveform), which is more work than these two columns.
         rise_time = -peaks['area_decile_from_midpoint'][:, 1]
         n_channels = (peaks['area_per_channel'] > 0).sum(axis=1)
 
@@ -615,42 +804,54 @@ class MergedS2s(strax.OverlapWindowPlugin):
         """
 
         peaklet_gaps = peaklet_starts[1:] - peaklet_ends[:-1]
-        peaklet_start_index = np.arange(len(peaklet_starts))
-        peaklet_end_index = np.arange(len(peaklet_starts))
+        n_peaklets = len(peaklet_starts)
+
+        # The peaklets to merge form contiguous clusters. Keep track of
+        # the last index of the cluster starting at an index and the
+        # first index of the cluster ending at an index, as well as the
+        # running area (sum and sum of absolute values) of each cluster.
+        cluster_end = np.arange(n_peaklets)
+        cluster_start = np.arange(n_peaklets)
+        cluster_area = areas.astype(np.float64)
+        cluster_abs_area = np.abs(cluster_area)
 
         for gap_i in np.argsort(peaklet_gaps):
-            start_idx = peaklet_start_index[gap_i]
-            inclusive_end_idx = peaklet_end_index[gap_i + 1]
-            sum_area = np.sum(areas[start_idx:inclusive_end_idx + 1])
             this_gap = peaklet_gaps[gap_i]
-
-            if inclusive_end_idx < start_idx:
-                raise ValueError('Something went wrong, left is bigger then right?!')
-
             if this_gap > max_gap:
                 break
-            if sum_area > max_area:
-                # For very large S2s, we assume that natural breaks is taking care
-                continue
-            if (sum_area > 0) and (
-                    this_gap > merge_s2_threshold(np.log10(sum_area),
-                                                  gap_thresholds)):
-                # The merged peak would be too large
+
+            # gap_i is not merged yet, so it separates two clusters
+            start_idx = cluster_start[gap_i]
+            inclusive_end_idx = cluster_end[gap_i + 1]
+
+            merge = _merge_s2_allowed(
+                areas, start_idx, inclusive_end_idx,
+                cluster_area[start_idx] + cluster_area[gap_i + 1],
+                cluster_abs_area[start_idx] + cluster_abs_area[gap_i + 1],
+                this_gap, gap_thresholds, max_area)
+            if not merge:
                 continue
 
             peak_duration = (peaklet_ends[inclusive_end_idx] - peaklet_starts[start_idx])
             if peak_duration >= max_duration:
                 continue
 
-            # Merge gap in other words this means p @ gap_i and p @gap_i + 1 share the same
-            # start, end and area:
-            peaklet_start_index[start_idx:inclusive_end_idx + 1] = peaklet_start_index[start_idx]
-            peaklet_end_index[start_idx:inclusive_end_idx + 1] = peaklet_end_index[inclusive_end_idx]
-
-        start_merge_at = np.unique(peaklet_start_index)
-        end_merge_at = np.unique(peaklet_end_index)
-        if not len(start_merge_at) == len(end_merge_at):
-            raise ValueError('inconsistent start and end merge instructions')
+            cluster_area[start_idx] += cluster_area[gap_i + 1]
+            cluster_abs_area[start_idx] += cluster_abs_area[gap_i + 1]
+            cluster_end[start_idx] = inclusive_end_idx
+            cluster_start[inclusive_end_idx] = start_idx
+
+        start_merge_at = np.zeros(n_peaklets, dtype=np.int64)
+        end_merge_at = np.zeros(n_peaklets, dtype=np.int64)
+        n_clusters = 0
+        start_idx = 0
+        while start_idx < n_peaklets:
+            start_merge_at[n_clusters] = start_idx
+            end_merge_at[n_clusters] = cluster_end[start_idx]
+            start_idx = cluster_end[start_idx] + 1
+            n_clusters += 1
+        start_merge_at = start_merge_at[:n_clusters]
+        end_merge_at = end_merge_at[:n_clusters]
 
         merge_start, merge_stop_exclusive = _filter_s1_starts(
             start_merge_at, types, end_merge_at)
@@ -658,6 +859,55 @@ class MergedS2s(strax.OverlapWindowPlugin):
         return merge_start, merge_stop_exclusive
 
 
+@numba.njit(cache=True, nogil=True)
+def _merge_s2_allowed(areas, start_idx, inclusive_end_idx,
+                      area_estimate, abs_area, this_gap,
+                      gap_thresholds, max_area):
+    """Return whether the area of the peaklets start_idx up to and
+    including inclusive_end_idx is small enough to merge across
+    this_gap.
+
+    The area is the float32 sum of the areas, which depends on the order
+    of the summation. Decide based on the running (float64) area_estimate
+    if the decision is the same for all areas within the rounding error,
+    and only sum the areas of the peaklets if it is not.
+    """
+    n = inclusive_end_idx - start_idx + 1
+    # Rounding error of the float32 sum, and of the float32 log10 of it
+    error = 2 * n * 2. ** -24 * abs_area + 1e-4 * abs(area_estimate)
+    low, high = area_estimate - error, area_estimate + error
+    if (n * 2. ** -24 < 0.5
+            and np.isfinite(low) and np.isfinite(high)
+            and not low <= 0 < high
+            and not low <= max_area < high):
+        stable = True
+        if low > 0:
+            # The threshold is linear in log10(area) between these points
+            for a, _ in gap_thresholds:
+                if np.log10(low) <= a <= np.log10(high):
+                    stable = False
+        merge = _merge_s2_area_allowed(low, this_gap, gap_thresholds, max_area)
+        if stable and merge == _merge_s2_area_allowed(
+                high, this_gap, gap_thresholds, max_area):
+            return merge
+    return _merge_s2_area_allowed(
+        np.sum(areas[start_idx:inclusive_end_idx + 1]),
+        this_gap, gap_thresholds, max_area)
+
+
+@numba.njit(cache=True, nogil=True)
+def _merge_s2_area_allowed(sum_area, this_gap, gap_thresholds, max_area):
+    if sum_area > max_area:
+        # For very large S2s, we assume that natural breaks is taking care
+        return False
+    if (sum_area > 0) and (
+            this_gap > merge_s2_threshold(np.log10(sum_area),
+                                          gap_thresholds)):
+        # The merged peak would be too large
+        return False
+    return True
+
+
 @numba.njit(cache=True, nogil=True)
 def _filter_s1_starts(start_merge_at, types, end_merge_at):
     for start_merge_idx, _ in enumerate(start_merge_at):
@@ -784,13 +1034,3 @@ def get_tight_coin(hit_max_times, peak_max_times, left, right):
 
     return n_coin
 
-
-@numba.njit(cache=True, nogil=True)
-def hit_max_sample(records, hits):
-    """Return the index of the maximum sample for hits"""
-    result = np.zeros(len(hits), dtype=np.int16)
-    for i, h in enumerate(hits):
-        r = records[h['record_i']]
-        w = r['data'][h['left']:h['right']]
-        result[i] = np.argmax(w)
-    return result
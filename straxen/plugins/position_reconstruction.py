@@ -1,6 +1,7 @@
 """Position reconstruction for Xenon-nT"""
 
 import os
+import shutil
 import tempfile
 import tarfile
 import numpy as np
@@ -20,7 +21,20 @@ DEFAULT_POSREC_ALGO_OPTION = tuple([strax.Option("default_reconstruction_algorit
                  help='Skip reconstruction if area (PE) is less than this',
                  default=10),
     strax.Option('n_top_pmts', default=straxen.n_top_pmts,
-                 help="Number of top PMTs")
+                 help="Number of top PMTs"),
+    strax.Option('posrec_backend', default='tensorflow', track=False,
+                 help="Evaluate the model with 'tensorflow', or with 'numpy' "
+                      "(see straxen.NumpyModel). The numpy backend converts "
+                      "the tensorflow model once to an npz file in "
+                      "posrec_model_cache_dir, or uses the model file directly "
+                      "if it is an npz file. Only the MLP and CNN models are "
+                      "supported: the graph convolution layers of the GCN "
+                      "model are not implemented in NumpyModel, so the GCN "
+                      "model always needs 'tensorflow' (or gcn_model=None)."),
+    strax.Option('posrec_model_cache_dir', default='/tmp/straxen_posrec_models',
+                 track=False,
+                 help="Directory where the models are extracted (and converted "
+                      "for the numpy backend) once, by the md5 of the model file"),
 )
 
 class PeakPositionsBaseNT(strax.Plugin):
@@ -37,74 +51,219 @@ class PeakPositionsBaseNT(strax.Plugin):
     # self.model during multiprocessing (to fix?)
     parallel = True
     __version__ = '0.0.0'
+    # Algorithms whose models straxen.NumpyModel can evaluate. The GCN
+    # model uses custom graph convolution layers, which are not
+    # implemented, so it is only evaluated with tensorflow.
+    numpy_backend_algorithms = ('mlp', 'cnn')
 
     def infer_dtype(self):
         if self.algorithm is None:
             raise NotImplementedError(f'Base class should not be used without '
                                       f'algorithm as done in {__class__.__name__}')
-        dtype = [('x_' + self.algorithm, np.float32,
-                  f'Reconstructed {self.algorithm} S2 X position (cm), uncorrected'),
-                 ('y_' + self.algorithm, np.float32,
-                  f'Reconstructed {self.algorithm} S2 Y position (cm), uncorrected')]
+        return self._algorithm_dtype(self.algorithm)
+
+    @staticmethod
+    def _algorithm_dtype(algorithm):
+        dtype = [('x_' + algorithm, np.float32,
+                  f'Reconstructed {algorithm} S2 X position (cm), uncorrected'),
+                 ('y_' + algorithm, np.float32,
+                  f'Reconstructed {algorithm} S2 Y position (cm), uncorrected')]
         dtype += strax.time_fields
         return dtype
 
     def setup(self):
-        self.model_file = self._get_model_file_name()
-        if self.model_file is None:
-            warn(f'No file provided for {self.algorithm}. Setting all values '
-                 f'for {self.provides} to None.')
+        self.model_file, self.model = self._get_model(self.algorithm)
+
+    def _get_model(self, algorithm):
+        """
+        :return: the model file and the model of the algorithm, or
+            (None, None) if no model is provided for the algorithm
+        """
+        model_file = self._get_model_file_name(algorithm)
+        if model_file is None:
+            warn(f'No file provided for {algorithm}. Setting all values '
+                 f'for peak_positions_{algorithm} to None.')
             # No further setup required
-            return
+            return None, None
+        if (self.config['posrec_backend'] == 'numpy'
+                and algorithm not in self.numpy_backend_algorithms):
+            raise ValueError(f"The {algorithm} model cannot be evaluated with "
+                             f"posrec_backend='numpy', as its layers are not "
+                             f"implemented in NumpyModel. Use posrec_backend="
+                             f"'tensorflow' or set {algorithm}_model to None.")
 
-        # Load the tensorflow model
-        import tensorflow as tf
-        if os.path.exists(self.model_file):
-            print(f"Path is local. Loading {self.algorithm} TF model locally "
+        if os.path.exists(model_file):
+            print(f"Path is local. Loading {algorithm} model locally "
                   f"from disk.")
         else:
-            downloader = straxen.MongoDownloader()
+            downloader = straxen.get_shared_downloader()
             try:
-                self.model_file = downloader.download_single(self.model_file)
+                model_file = downloader.download_single(model_file)
             except straxen.mongo_storage.CouldNotLoadError as e:
-                raise RuntimeError(f'Model files {self.model_file} is not found') from e
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            tar = tarfile.open(self.model_file, mode="r:gz")
-            tar.extractall(path=tmpdirname)
-            self.model = tf.keras.models.load_model(tmpdirname)
+                raise RuntimeError(f'Model files {model_file} is not found') from e
 
-    def compute(self, peaks):
-        result = np.ones(len(peaks), dtype=self.dtype)
-        result['time'], result['endtime'] = peaks['time'], strax.endtime(peaks)
+        model = self._load_model(model_file,
+                                 self.config['posrec_backend'],
+                                 self.config['posrec_model_cache_dir'])
+        return model_file, model
+
+    # Models loaded in this process by (backend, md5 of the model file),
+    # shared by all posrec plugins and runs. At most _max_loaded_models
+    # are kept, the oldest are dropped first.
+    _loaded_models = {}
+    _max_loaded_models = 8
+    # md5 of the model files by (path, modification time, size)
+    _model_md5s = {}
+
+    @classmethod
+    def _load_model(cls, model_file, backend, cache_dir):
+        """Load the model, unless the same model was loaded before"""
+        if backend not in ('tensorflow', 'numpy'):
+            raise ValueError(f'Unknown posrec_backend {backend}')
+        key = (backend, cls._md5(model_file))
+        if key in cls._loaded_models:
+            return cls._loaded_models[key]
 
-        result['x_' + self.algorithm] *= float('nan')
-        result['y_' + self.algorithm] *= float('nan')
+        if backend == 'numpy':
+            model = cls._load_numpy_model(model_file, key[1], cache_dir)
+        else:
+            model = cls._load_tensorflow_model(model_file, key[1], cache_dir)
+        while len(cls._loaded_models) >= cls._max_loaded_models:
+            cls._loaded_models.pop(next(iter(cls._loaded_models)))
+        cls._loaded_models[key] = model
+        return model
+
+    @classmethod
+    def _md5(cls, model_file):
+        stat = os.stat(model_file)
+        key = (os.path.abspath(model_file), stat.st_mtime_ns, stat.st_size)
+        if key not in cls._model_md5s:
+            cls._model_md5s[key] = straxen.mongo_storage.GridFsInterface.compute_md5(
+                model_file)
+        return cls._model_md5s[key]
+
+    @staticmethod
+    def _extract_model(model_file, md5, cache_dir):
+        """
+        Extract the model to cache_dir/md5, unless it was extracted
+        before. The model is extracted to a temporary directory first,
+        so processes that load the model at the same time never see an
+        incomplete model.
+
+        :return: directory of the extracted model
+        :raises OSError: if the model cannot be extracted, or was
+            extracted by another user who did not allow us to read it
+        """
+        model_dir = os.path.join(cache_dir, md5)
+        if os.path.exists(model_dir):
+            if not os.access(model_dir, os.R_OK | os.X_OK):
+                raise PermissionError(f'Cannot read the extracted model {model_dir}')
+            return model_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            with tarfile.open(model_file, mode="r:gz") as tar:
+                tar.extractall(path=temp_dir)
+            # mkdtemp makes the directory accessible only for the user
+            os.chmod(temp_dir, straxen.common._apply_umask(0o777))
+            os.rename(temp_dir, model_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.exists(model_dir):
+                raise
+            # Extracted by another process in the meantime
+        return model_dir
+
+    @classmethod
+    def _load_tensorflow_model(cls, model_file, md5, cache_dir):
+        import tensorflow as tf
+        try:
+            model_dir = cls._extract_model(model_file, md5, cache_dir)
+        except OSError as e:
+            warn(f'Cannot use the model cache {cache_dir}: {e}')
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                with tarfile.open(model_file, mode="r:gz") as tar:
+                    tar.extractall(path=tmpdirname)
+                return tf.keras.models.load_model(tmpdirname)
+        return tf.keras.models.load_model(model_dir)
 
-        if self.model_file is None:
+    @classmethod
+    def _load_numpy_model(cls, model_file, md5, cache_dir):
+        """Load the model as a NumpyModel. Tensorflow is only needed the
+        first time, to convert the model to cache_dir/md5.npz."""
+        if model_file.endswith('.npz'):
+            return straxen.NumpyModel.load(model_file)
+        npz_file = os.path.join(cache_dir, md5 + '.npz')
+        if os.path.exists(npz_file):
+            try:
+                return straxen.NumpyModel.load(npz_file)
+            except OSError as e:
+                # E.g. converted by another user, convert it again
+                warn(f'Cannot load the converted model {npz_file}: {e}')
+        try:
+            keras_model = cls._load_tensorflow_model(model_file, md5, cache_dir)
+        except ModuleNotFoundError as e:
+            raise RuntimeError(
+                f'Converting {model_file} for the numpy backend needs tensorflow. '
+                f'Convert it once where tensorflow is installed, with the same '
+                f'posrec_model_cache_dir, or use a model stored as npz file '
+                f'with straxen.NumpyModel.save') from e
+        model = straxen.NumpyModel.from_keras(keras_model)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            model.save(npz_file)
+        except OSError as e:
+            warn(f'Could not store the converted model in {npz_file}: {e}')
+        return model
+
+    def compute(self, peaks):
+        if self.model is None:
             # This plugin is disabled since no model is provided
-            return result
+            peak_mask, _in = None, None
+        else:
+            peak_mask, _in = self._posrec_input(peaks)
+        return self._reconstruct(peaks, self.algorithm, self.model, peak_mask, _in,
+                                 self.dtype)
 
-        # Keep large peaks only
+    def _posrec_input(self, peaks):
+        """
+        :return: mask of the peaks larger than min_reconstruction_area,
+            and the float32 area per top array channel of these peaks,
+            normalised to the largest channel
+        """
         peak_mask = peaks['area'] > self.config['min_reconstruction_area']
-        if not np.sum(peak_mask):
+        # The selection is a copy, so normalise it in place
+        _in = peaks['area_per_channel'][peak_mask, 0:self.config['n_top_pmts']]
+        _in = _in.astype(np.float32, copy=False)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _in /= np.max(_in, axis=1, keepdims=True)
+        return peak_mask, _in
+
+    @staticmethod
+    def _reconstruct(peaks, algorithm, model, peak_mask, _in, dtype):
+        """Positions of the peaks, reconstructed with model from the
+        input given by _posrec_input"""
+        result = np.ones(len(peaks), dtype=dtype)
+        result['time'], result['endtime'] = peaks['time'], strax.endtime(peaks)
+
+        result['x_' + algorithm] *= float('nan')
+        result['y_' + algorithm] *= float('nan')
+
+        if model is None or not np.any(peak_mask):
             # Nothing to do, and .predict crashes on empty arrays
             return result
 
         # Getting actual position reconstruction
-        _in = peaks['area_per_channel'][peak_mask, 0:self.config['n_top_pmts']]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            _in = _in / np.max(_in, axis=1).reshape(-1, 1)
-        _in = _in.reshape(-1, self.config['n_top_pmts'])
-        _out = self.model.predict(_in)
+        _out = model.predict(_in)
 
         # writing output to the result
-        result['x_' + self.algorithm][peak_mask] = _out[:, 0]
-        result['y_' + self.algorithm][peak_mask] = _out[:, 1]
+        result['x_' + algorithm][peak_mask] = _out[:, 0]
+        result['y_' + algorithm][peak_mask] = _out[:, 1]
         return result
 
-    def _get_model_file_name(self):
+    def _get_model_file_name(self, algorithm):
 
-        config_file = f'{self.algorithm}_model'
+        config_file = f'{algorithm}_model'
         model_from_config = self.config.get(config_file, 'No file')
         if model_from_config == 'No file':
             raise ValueError(f'{__class__.__name__} should have {config_file} '
@@ -167,6 +326,61 @@ class PeakPositionsCNN(PeakPositionsBaseNT):
     __version__ = '0.0.1'
 
 
+@export
+@strax.takes_config(
+    strax.Option('mlp_model',
+                 help='Neural network model.'
+                      'If CMT, specify as (mlp_model, ONLINE, True)'
+                      'Set to None to skip the computation of this algorithm.',
+                 default=('mlp_model', "ONLINE", True)
+                 ),
+    strax.Option('cnn_model',
+                 help='Neural network model.'
+                      'If CMT, specify as (cnn_model, ONLINE, True)'
+                      'Set to None to skip the computation of this algorithm.',
+                 default=('cnn_model', "ONLINE", True)
+                 ),
+    strax.Option('gcn_model',
+                 help='Neural network model.'
+                      'If CMT, specify as (gcn_model, ONLINE, True)'
+                      'Set to None to skip the computation of this algorithm.',
+                 default=('gcn_model', "ONLINE", True)
+                 ),
+)
+class PeakPositionsCombinedNT(PeakPositionsBaseNT):
+    """
+    Reconstruct the positions with the MLP, CNN and GCN models at once.
+    Provides the same data types as PeakPositionsMLP, PeakPositionsCNN
+    and PeakPositionsGCN, but builds the normalised top array input
+    only once per chunk and evaluates all models on it.
+
+    Register this plugin instead of the separate plugins to use it. As
+    it is a different plugin, its data is stored under other lineage
+    hashes than the data of the separate plugins.
+    """
+    algorithms = ('mlp', 'cnn', 'gcn')
+    provides = tuple(f'peak_positions_{algorithm}' for algorithm in algorithms)
+    data_kind = {data_type: 'peaks' for data_type in provides}
+    __version__ = '0.0.0'
+
+    def infer_dtype(self):
+        return {f'peak_positions_{algorithm}': self._algorithm_dtype(algorithm)
+                for algorithm in self.algorithms}
+
+    def setup(self):
+        self.models = {algorithm: self._get_model(algorithm)[1]
+                       for algorithm in self.algorithms}
+
+    def compute(self, peaks):
+        peak_mask, _in = None, None
+        if any(model is not None for model in self.models.values()):
+            peak_mask, _in = self._posrec_input(peaks)
+        return {f'peak_positions_{algorithm}': self._reconstruct(
+                    peaks, algorithm, model, peak_mask, _in,
+                    self.dtype[f'peak_positions_{algorithm}'])
+                for algorithm, model in self.models.items()}
+
+
 @export
 @strax.takes_config(
     *DEFAULT_POSREC_ALGO_OPTION
@@ -8,7 +8,7 @@ import straxen
 from straxen.get_corrections import is_cmt_option
 
 export, __all__ = strax.exporter()
-__all__ += ['NO_PULSE_COUNTS']
+__all__ += ['NO_PULSE_COUNTS', 'hits_dtype']
 
 # These are also needed in peaklets, since hitfinding is repeated
 HITFINDER_OPTIONS = tuple([
@@ -37,6 +37,10 @@ HITFINDER_OPTIONS_he = tuple([
 
 HE_PREAMBLE = """High energy channels: attenuated signals of the top PMT-array\n"""
 
+hits_dtype = strax.hit_dtype + [
+    (('Index of the maximum sample of the hit, counted from the left of the hit',
+      'max_sample'), np.int16)]
+
 
 @export
 @strax.takes_config(
@@ -96,6 +100,12 @@ HE_PREAMBLE = """High energy channels: attenuated signals of the top PMT-array\n
         default=True, track=False,
         help='Crash if any of the pulses in raw_records overlap with others '
              'in the same channel'),
+    strax.Option(
+        'fused_pulse_processing',
+        default=False, track=False, type=bool,
+        help='Convert, baseline, integrate and count the pulses in a single '
+             'pass over the records. Gives identical records and '
+             'pulse_counts but saves memory bandwidth.'),
     strax.Option(
         'allow_sloppy_chunking',
         default=False, track=False,
@@ -179,23 +189,32 @@ class PulseProcessing(strax.Plugin):
         raw_records = raw_records[
             raw_records['channel'] < self.config['n_tpc_pmts']]
 
-        # Convert everything to the records data type -- adds extra fields.
-        r = strax.raw_to_records(raw_records)
-        del raw_records
+        if self.config['fused_pulse_processing']:
+            # Same as below, in a single pass over the records
+            r, pulse_counts = fused_pulse_processing(
+                raw_records,
+                n_channels=self.config['n_tpc_pmts'],
+                baseline_samples=self.config['baseline_samples'],
+                allow_sloppy_chunking=self.config['allow_sloppy_chunking'])
+            del raw_records
+        else:
+            # Convert everything to the records data type -- adds extra fields.
+            r = strax.raw_to_records(raw_records)
+            del raw_records
 
-        # Do not trust in DAQ + strax.baseline to leave the
-        # out-of-bounds samples to zero.
-        # TODO: better to throw an error if something is nonzero
-        strax.zero_out_of_bounds(r)
+            # Do not trust in DAQ + strax.baseline to leave the
+            # out-of-bounds samples to zero.
+            # TODO: better to throw an error if something is nonzero
+            strax.zero_out_of_bounds(r)
 
-        strax.baseline(r,
-                       baseline_samples=self.config['baseline_samples'],
-                       allow_sloppy_chunking=self.config['allow_sloppy_chunking'],
-                       flip=True)
+            strax.baseline(r,
+                           baseline_samples=self.config['baseline_samples'],
+                           allow_sloppy_chunking=self.config['allow_sloppy_chunking'],
+                           flip=True)
 
-        strax.integrate(r)
+            strax.integrate(r)
 
-        pulse_counts = count_pulses(r, self.config['n_tpc_pmts'])
+            pulse_counts = count_pulses(r, self.config['n_tpc_pmts'])
         pulse_counts['time'] = start
         pulse_counts['endtime'] = end
 
@@ -239,6 +258,47 @@ class PulseProcessing(strax.Plugin):
                     pulse_counts=pulse_counts,
                     veto_regions=veto_regions)
 
+
+@export
+@strax.takes_config(
+    *HITFINDER_OPTIONS)
+class Hits(strax.Plugin):
+    """
+    Hits in the records, sorted by time, including the index of their
+    maximum sample. PeakletsFromHits clusters these hits rather than
+    repeating the hitfinding, which saves time when the hits are stored
+    and only the clustering options change. This plugin is not
+    registered by default.
+    """
+    __version__ = '0.0.1'
+
+    depends_on = ('records',)
+    provides = 'hits'
+    data_kind = 'hits'
+    dtype = hits_dtype
+    parallel = 'process'
+    rechunk_on_save = False
+    compressor = 'zstd'
+
+    def setup(self):
+        # Same hit thresholds as Peaklets
+        if is_cmt_option(self.config['hit_min_amplitude']):
+            self.hit_thresholds = straxen.get_correction_from_cmt(self.run_id,
+                self.config['hit_min_amplitude'])
+        elif isinstance(self.config['hit_min_amplitude'], str):
+            self.hit_thresholds = straxen.hit_min_amplitude(
+                self.config['hit_min_amplitude'])
+        else:  # int or array
+            self.hit_thresholds = self.config['hit_min_amplitude']
+
+    def compute(self, records):
+        hits = strax.find_hits(records, min_amplitude=self.hit_thresholds)
+        hits = strax.sort_by_time(hits)
+        result = np.zeros(len(hits), dtype=hits_dtype)
+        strax.copy_to_buffer(hits, result, '_copy_hits_to_hits_max_sample')
+        result['max_sample'] = hit_max_sample(records, hits)
+        return result
+
     
 @export
 @strax.takes_config(
@@ -519,6 +579,13 @@ def _count_pulses(records, n_channels, result):
             # This is a subsequent fragment of a lone pulse
             lone_area[ch] += r['area']
 
+    _store_pulse_counts(result, count, lone_count, area, lone_area,
+                        baseline_buffer, baseline_rms_buffer)
+
+
+@numba.njit(cache=True, nogil=True)
+def _store_pulse_counts(result, count, lone_count, area, lone_area,
+                        baseline_buffer, baseline_rms_buffer):
     res = result[0]
     res['pulse_count'][:] = count[:]
     res['lone_pulse_count'][:] = lone_count[:]
@@ -530,9 +597,169 @@ def _count_pulses(records, n_channels, result):
     res['baseline_rms_mean'][:] = (baseline_rms_buffer/count)[:]
 
 
+##
+# Fused pulse processing
+##
+@export
+def fused_pulse_processing(raw_records,
+                           n_channels,
+                           baseline_samples=40,
+                           allow_sloppy_chunking=False,
+                           fallback_baseline=16000):
+    """
+    Convert raw_records to records, zero the samples out of the pulse
+    bounds, baseline, integrate and count the pulses in a single pass
+    over the data. The result is identical to:
+        r = strax.raw_to_records(raw_records)
+        strax.zero_out_of_bounds(r)
+        strax.baseline(r, baseline_samples, flip=True, ...)
+        strax.integrate(r)
+        pulse_counts = count_pulses(r, n_channels)
+
+    :param raw_records: raw_records, sorted by time
+    :param n_channels: number of channels, all channels in raw_records
+        should be smaller than this number
+    :param baseline_samples: number of samples at start of pulse to
+        average to determine the baseline.
+    :param allow_sloppy_chunking: Allow use of the fallback_baseline in
+        case the 0th fragment of a pulse is missing
+    :param fallback_baseline: Fallback baseline (ADC counts)
+    :return: records, pulse_counts
+    """
+    records = np.empty(
+        len(raw_records),
+        dtype=strax.record_dtype(
+            strax.record_length_from_dtype(raw_records.dtype)))
+    if not len(raw_records):
+        return records, np.zeros(0, dtype=pulse_count_dtype(n_channels))
+
+    pulse_counts = np.zeros(1, dtype=pulse_count_dtype(n_channels))
+    _fused_pulse_processing(raw_records, records, pulse_counts,
+                            n_channels,
+                            baseline_samples,
+                            allow_sloppy_chunking,
+                            fallback_baseline)
+    return records, pulse_counts
+
+
+@numba.njit(cache=True, nogil=True)
+def _fused_pulse_processing(raw_records, records, result, n_channels,
+                            baseline_samples, allow_sloppy_chunking,
+                            fallback_baseline):
+    samples_per_record = len(records[0]['data'])
+
+    # Baseline (mean, rms) and whether we saw the 0th fragment, per channel
+    last_bl_in = np.zeros((n_channels, 2), dtype=np.float32)
+    seen_first = np.zeros(n_channels, dtype=np.bool_)
+
+    # Pulse counting, see _count_pulses
+    count = np.zeros(n_channels, dtype=np.int64)
+    lone_count = np.zeros(n_channels, dtype=np.int64)
+    area = np.zeros(n_channels, dtype=np.int64)
+    lone_area = np.zeros(n_channels, dtype=np.int64)
+    last_end_seen = 0
+    next_start = 0
+    in_lone_pulse = np.zeros(n_channels, dtype=np.bool_)
+    baseline_buffer = np.zeros(n_channels, dtype=np.float64)
+    baseline_rms_buffer = np.zeros(n_channels, dtype=np.float64)
+
+    for r_i in range(len(raw_records)):
+        rr = raw_records[r_i]
+        r = records[r_i]
+        ch = rr['channel']
+        if ch >= n_channels:
+            print('Channel:', ch)
+            raise RuntimeError("Out of bounds channel in get_counts!")
+
+        # 1. Convert to records, all fields are written since the buffer
+        # is not initialized.
+        r['time'] = rr['time']
+        r['length'] = rr['length']
+        r['dt'] = rr['dt']
+        r['channel'] = ch
+        r['pulse_length'] = rr['pulse_length']
+        r['record_i'] = rr['record_i']
+        r['reduction_level'] = 0
+        r['amplitude_bit_shift'] = 0
+
+        # 2. Copy the data and zero out of bounds
+        length = r['length']
+        data = r['data']
+        raw_data = rr['data']
+        for s_i in range(samples_per_record):
+            if s_i < length:
+                data[s_i] = raw_data[s_i]
+            else:
+                data[s_i] = 0
+
+        # 3. Baseline, see strax.baseline
+        if r['record_i'] == 0:
+            seen_first[ch] = True
+            w = data[:baseline_samples]
+            last_bl_in[ch] = bl, rms = w.mean(), w.std()
+        else:
+            bl, rms = last_bl_in[ch]
+            if not seen_first[ch]:
+                if not allow_sloppy_chunking:
+                    print(r['time'], ch, r['record_i'])
+                    raise RuntimeError("Cannot baseline, missing 0th fragment!")
+                bl = last_bl_in[ch] = fallback_baseline
+                rms = np.nan
+        int_bl = int(bl)
+        r['baseline'] = bl
+        r['baseline_rms'] = rms
+
+        # 4. Flip the waveform and integrate, see strax.integrate. The
+        # samples out of bounds are zero and do not add to the sum.
+        data_sum = 0
+        for s_i in range(min(length, samples_per_record)):
+            data[s_i] = -(data[s_i] - int_bl)
+            data_sum += data[s_i]
+        r['area'] = data_sum + int(round((r['baseline'] % 1) * r['length']))
+
+        # 5. Count pulses
+        if r_i != len(raw_records) - 1:
+            next_start = raw_records[r_i + 1]['time']
+
+        area[ch] += r['area']
+
+        if r['record_i'] == 0:
+            count[ch] += 1
+            baseline_buffer[ch] += r['baseline']
+            baseline_rms_buffer[ch] += r['baseline_rms']
+
+            if (r['time'] > last_end_seen
+                    and r['time'] + r['pulse_length'] * r['dt'] < next_start):
+                lone_count[ch] += 1
+                in_lone_pulse[ch] = True
+                lone_area[ch] += r['area']
+            else:
+                in_lone_pulse[ch] = False
+
+            last_end_seen = max(last_end_seen,
+                                r['time'] + r['pulse_length'] * r['dt'])
+
+        elif in_lone_pulse[ch]:
+            lone_area[ch] += r['area']
+
+    _store_pulse_counts(result, count, lone_count, area, lone_area,
+                        baseline_buffer, baseline_rms_buffer)
+
+
 ##
 # Misc
 ##
+@numba.njit(cache=True, nogil=True)
+def hit_max_sample(records, hits):
+    """Return the index of the maximum sample for hits"""
+    result = np.zeros(len(hits), dtype=np.int16)
+    for i, h in enumerate(hits):
+        r = records[h['record_i']]
+        w = r['data'][h['left']:h['right']]
+        result[i] = np.argmax(w)
+    return result
+
+
 @export
 @numba.njit(cache=True, nogil=True)
 def mask_and_not(x, mask):
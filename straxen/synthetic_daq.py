@@ -0,0 +1,471 @@
+"""
+Synthetic DAQ data, for benchmarking the live processing (DAQReader ->
+PulseProcessing -> Peaklets) at a known data rate without real data.
+"""
+import os
+import time
+from collections import defaultdict
+
+import numba
+import numpy as np
+import strax
+import straxen
+
+export, __all__ = strax.exporter()
+
+# Digitizers are 14 bit, pulses go down from the baseline, so a
+# saturated sample is 0 ADC.
+ADC_MAX = 2 ** 14 - 1
+
+
+@export
+def synthetic_raw_records(start,
+                          end,
+                          n_channels=straxen.n_tpc_pmts,
+                          channel_rate=500.,
+                          pulse_length=(60, 0.3),
+                          s1_rate=20.,
+                          s1_n_channels=(3, 100),
+                          s2_rate=20.,
+                          s2_duration=(1_000, 10_000),
+                          s2_n_photons=(1e2, 1e5),
+                          s2_n_channels=(20, straxen.n_tpc_pmts),
+                          saturation_fraction=0.01,
+                          quiet_gap_rate=0.,
+                          quiet_gap_duration=int(1e5),
+                          record_length=110,
+                          dt=10,
+                          baseline=16000,
+                          noise_rms=2.,
+                          spe_amplitude=25.,
+                          pretrigger=15,
+                          posttrigger=50,
+                          seed=0,
+                          last_end=None,
+                          allow_beyond_end=True):
+    """
+    Return raw_records of pulses that start in [start, end) as the DAQ
+    would give them (in ADC counts, pulses going down from the baseline).
+
+    :param start: start of the interval [ns]
+    :param end: end of the interval [ns]
+    :param n_channels: number of channels (channels 0 ... n_channels - 1)
+    :param channel_rate: rate [Hz] of single PE pulses per channel
+        (dark counts, afterpulses etc.)
+    :param pulse_length: (median, log-normal sigma) of the length [samples]
+        of the single PE and S1 pulses
+    :param s1_rate: rate [Hz] of S1s
+    :param s1_n_channels: (min, max) number of channels seeing an S1
+    :param s2_rate: rate [Hz] of S2s
+    :param s2_duration: (min, max) duration of an S2 [ns]
+    :param s2_n_photons: (min, max) of the log-uniform number of PE of an S2
+    :param s2_n_channels: (min, max) number of channels seeing an S2
+    :param saturation_fraction: fraction of the S2 pulses saturating the
+        digitizer
+    :param quiet_gap_rate: rate [Hz] of periods without any data
+    :param quiet_gap_duration: mean (exponential) duration of the quiet
+        periods [ns]
+    :param record_length: samples per raw_record
+    :param dt: sampling time [ns]
+    :param baseline: baseline [ADC counts]
+    :param noise_rms: electronic noise [ADC counts]
+    :param spe_amplitude: amplitude of a single PE [ADC counts]
+    :param pretrigger: samples in a pulse before the signal
+    :param posttrigger: samples in a S2 pulse after the signal
+    :param seed: seed for the random number generation, the same seed and
+        arguments give the same data
+    :param last_end: array of the end time of the last pulse in each
+        channel. Pulses starting before it are dropped, such that pulses
+        never overlap. Updated in place, use it to generate consecutive
+        intervals.
+    :param allow_beyond_end: if False, drop pulses that end after end
+    :return: raw_records sorted by time
+    """
+    rng = np.random.default_rng(seed)
+    duration_sec = (end - start) / 1e9
+    if last_end is None:
+        last_end = np.zeros(n_channels, dtype=np.int64)
+
+    pulses = []
+    # Single PE pulses
+    n = rng.poisson(channel_rate * n_channels * duration_sec)
+    pulses.append(_single_pe_pulses(
+        rng,
+        t=rng.integers(start, end, n),
+        channel=rng.integers(0, n_channels, n),
+        n_pe=np.ones(n),
+        pulse_length=pulse_length,
+        spe_amplitude=spe_amplitude,
+        pretrigger=pretrigger,
+        dt=dt))
+
+    # S1s: a few PE in many channels at (nearly) the same time
+    n = rng.poisson(s1_rate * duration_sec)
+    n_ch = rng.integers(s1_n_channels[0], min(s1_n_channels[1], n_channels) + 1, n)
+    t, channel = _signal_channels(rng, rng.integers(start, end, n), n_ch, n_channels)
+    pulses.append(_single_pe_pulses(
+        rng,
+        t=t + rng.normal(0, 10, len(t)).astype(np.int64),
+        channel=channel,
+        n_pe=1 + rng.poisson(1, len(t)),
+        pulse_length=pulse_length,
+        spe_amplitude=spe_amplitude,
+        pretrigger=pretrigger,
+        dt=dt))
+
+    # S2s: long pulses with many PE, distributed over the channels
+    n = rng.poisson(s2_rate * duration_sec)
+    n_ch = rng.integers(s2_n_channels[0], min(s2_n_channels[1], n_channels) + 1, n)
+    s2_samples = rng.integers(*s2_duration, n) // dt
+    s2_pe = 10 ** rng.uniform(*np.log10(s2_n_photons), n)
+    t, channel = _signal_channels(rng, rng.integers(start, end, n), n_ch, n_channels)
+    samples = np.repeat(s2_samples, n_ch)
+    # Split the PE over the channels
+    weight = rng.exponential(1, len(t))
+    if len(t):
+        weight /= np.repeat(np.add.reduceat(weight, np.cumsum(n_ch) - n_ch), n_ch)
+    width = np.maximum(samples / 4, 1)
+    amplitude = (np.repeat(s2_pe, n_ch) * weight
+                 * spe_amplitude * _SPE_WIDTH / width)
+    saturated = rng.random(len(t)) < saturation_fraction
+    amplitude[saturated] = baseline * rng.uniform(1.2, 3, saturated.sum())
+    pulses.append(dict(
+        time=t - pretrigger * dt,
+        channel=channel,
+        length=samples + pretrigger + posttrigger,
+        center=pretrigger + samples / 2,
+        width=width,
+        amplitude=amplitude))
+
+    pulses = {k: np.concatenate([p[k] for p in pulses]) for k in pulses[0]}
+    pulses['time'] = pulses['time'] // dt * dt
+
+    keep = (pulses['time'] >= start) & (pulses['time'] < end)
+    if not allow_beyond_end:
+        keep &= pulses['time'] + pulses['length'] * dt <= end
+    if quiet_gap_rate:
+        # Remove all pulses starting in the quiet periods
+        n = rng.poisson(quiet_gap_rate * duration_sec)
+        gap_start = rng.integers(start, end, n)
+        gap_end = gap_start + rng.exponential(quiet_gap_duration, n).astype(np.int64)
+        for gap_i in range(n):
+            keep &= ((pulses['time'] < gap_start[gap_i])
+                     | (pulses['time'] >= gap_end[gap_i]))
+    pulses = {k: v[keep] for k, v in pulses.items()}
+
+    # Like the digitizer, we cannot have overlapping pulses in a channel
+    order = np.lexsort((pulses['time'], pulses['channel']))
+    pulses = {k: v[order] for k, v in pulses.items()}
+    keep = _no_overlap(pulses['time'],
+                       pulses['time'] + pulses['length'] * dt,
+                       pulses['channel'],
+                       last_end)
+    pulses = {k: v[keep] for k, v in pulses.items()}
+
+    n_records = np.ceil(pulses['length'] / record_length).astype(np.int64)
+    records = np.zeros(n_records.sum(),
+                       dtype=strax.raw_record_dtype(samples_per_record=record_length))
+    _fill_raw_records(records,
+                      pulses['time'],
+                      pulses['channel'],
+                      pulses['length'].astype(np.int64),
+                      pulses['center'].astype(np.float64),
+                      pulses['width'].astype(np.float64),
+                      pulses['amplitude'].astype(np.float64),
+                      np.cumsum(n_records) - n_records,
+                      dt,
+                      baseline,
+                      noise_rms,
+                      rng.integers(2 ** 31))
+    return strax.sort_by_time(records)
+
+
+# Width (sigma) of a single PE pulse [samples]
+_SPE_WIDTH = 2.
+
+
+def _single_pe_pulses(rng, t, channel, n_pe, pulse_length, spe_amplitude,
+                      pretrigger, dt):
+    length = rng.lognormal(np.log(pulse_length[0]), pulse_length[1], len(t))
+    length = np.maximum(length.astype(np.int64), pretrigger + 5)
+    return dict(time=t - pretrigger * dt,
+                channel=channel,
+                length=length,
+                center=np.full(len(t), pretrigger, dtype=np.float64),
+                width=np.full(len(t), _SPE_WIDTH),
+                amplitude=n_pe * spe_amplitude * rng.normal(1, 0.3, len(t)).clip(0.1))
+
+
+def _signal_channels(rng, t, n_channels_per_signal, n_channels):
+    """Return the times and (distinct) channels of signals at t seen by
+    n_channels_per_signal channels"""
+    channels = [rng.choice(n_channels, n, replace=False)
+                for n in n_channels_per_signal]
+    if not len(channels):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.repeat(t, n_channels_per_signal), np.concatenate(channels)
+
+
+@numba.njit(nogil=True, cache=True)
+def _no_overlap(starts, ends, channels, last_end):
+    """Return mask of pulses (sorted by channel, then time) not starting
+    before the end of the previous pulse in the channel"""
+    keep = np.zeros(len(starts), dtype=np.bool_)
+    for p_i in range(len(starts)):
+        ch = channels[p_i]
+        if starts[p_i] >= last_end[ch]:
+            keep[p_i] = True
+            last_end[ch] = ends[p_i]
+    return keep
+
+
+@numba.njit(nogil=True, cache=True)
+def _fill_raw_records(records, p_time, p_channel, p_length, p_center,
+                      p_width, p_amplitude, first_record, dt, baseline,
+                      noise_rms, seed):
+    """Split the pulses in records and fill their waveforms"""
+    np.random.seed(seed)
+    record_length = len(records[0]['data']) if len(records) else 0
+    for p_i in range(len(p_time)):
+        n_records = (p_length[p_i] + record_length - 1) // record_length
+        for fragment_i in range(n_records):
+            r = records[first_record[p_i] + fragment_i]
+            offset = fragment_i * record_length
+            r['time'] = p_time[p_i] + offset * dt
+            r['length'] = min(record_length, p_length[p_i] - offset)
+            r['dt'] = dt
+            r['channel'] = p_channel[p_i]
+            r['pulse_length'] = p_length[p_i]
+            r['record_i'] = fragment_i
+            for sample_i in range(r['length']):
+                x = (offset + sample_i - p_center[p_i]) / p_width[p_i]
+                value = (baseline
+                         - p_amplitude[p_i] * np.exp(-0.5 * x * x)
+                         + np.random.normal(0., noise_rms))
+                r['data'][sample_i] = min(max(round(value), 0), ADC_MAX)
+
+
+@export
+def write_synthetic_daq_data(output_dir,
+                             duration=int(10e9),
+                             n_readout_threads=8,
+                             chunk_duration=int(5e9),
+                             overlap_duration=int(5e8),
+                             compressor='lz4',
+                             seed=0,
+                             **kwargs):
+    """
+    Write synthetic raw_records to output_dir like redax does: a folder per
+    chunk (000000, 000001, ...) and the overlap between chunks in the
+    _post and _pre folders of the chunks next to it, with a file per
+    readout thread. The THE_END folder is written at the end.
+
+    :param output_dir: folder to write to (as the daq_input_dir)
+    :param duration: duration of the run [ns]
+    :param n_readout_threads: number of files per folder, the channels
+        are divided evenly over the readout threads
+    :param chunk_duration: duration of the regular chunks [ns]
+    :param overlap_duration: duration of the overlap chunks [ns]
+    :param compressor: compressor of the files
+    :param seed: seed for the random number generation
+    :param kwargs: passed to synthetic_raw_records
+    :return: the DAQReader config to read the data, including the
+        number of bytes written (raw_bytes)
+    """
+    n_channels = kwargs.get('n_channels', straxen.n_tpc_pmts)
+    channels_per_reader = int(np.ceil(n_channels / n_readout_threads))
+    last_end = np.zeros(n_channels, dtype=np.int64)
+    os.makedirs(output_dir)
+
+    # Records of pulses that go into the next (part of the) chunk
+    spill_over = None
+    t_start = 0
+    raw_bytes = 0
+    part_i = 0
+    while t_start < duration:
+        is_overlap = part_i % 2
+        t_end = min(duration,
+                    t_start + (overlap_duration if is_overlap else chunk_duration))
+        records = synthetic_raw_records(t_start, t_end,
+                                        seed=(seed, part_i),
+                                        last_end=last_end,
+                                        allow_beyond_end=t_end < duration,
+                                        **kwargs)
+        if spill_over is not None:
+            records = strax.sort_by_time(np.concatenate([spill_over, records]))
+        spill_over = records[records['time'] >= t_end]
+        records = records[records['time'] < t_end]
+        raw_bytes += records.nbytes
+
+        data = []
+        for reader_i in range(n_readout_threads):
+            first_channel = reader_i * channels_per_reader
+            r = records[(records['channel'] >= first_channel)
+                        & (records['channel'] < first_channel + channels_per_reader)]
+            data.append(strax.io.COMPRESSORS[compressor]['compress'](r))
+
+        chunk_i = part_i // 2
+        if is_overlap:
+            folders = [f'{chunk_i:06d}_post', f'{chunk_i + 1:06d}_pre']
+        else:
+            folders = [f'{chunk_i:06d}']
+        for folder in folders:
+            _write_daq_folder(data, os.path.join(output_dir, folder))
+        t_start = t_end
+        part_i += 1
+
+    end_dir = os.path.join(output_dir, 'THE_END')
+    os.makedirs(end_dir)
+    for reader_i in range(n_readout_threads):
+        with open(os.path.join(end_dir, f'reader_{reader_i}'), mode='w') as f:
+            f.write("That's all folks!")
+
+    return dict(daq_input_dir=output_dir,
+                readout_threads={'reader': n_readout_threads},
+                daq_chunk_duration=chunk_duration,
+                daq_overlap_chunk_duration=overlap_duration,
+                daq_compressor=compressor,
+                record_length=kwargs.get('record_length', 110),
+                raw_bytes=raw_bytes)
+
+
+def _write_daq_folder(data_per_reader, folder):
+    """Write the data in a temporary folder first, such that the folder
+    is complete once it appears, like redax does"""
+    temp_folder = folder + '_temp'
+    os.makedirs(temp_folder)
+    for reader_i, data in enumerate(data_per_reader):
+        with open(os.path.join(temp_folder, f'reader_{reader_i}'), 'wb') as f:
+            f.write(data)
+    os.rename(temp_folder, folder)
+
+
+@export
+def benchmark_daq_processing(daq_config,
+                             targets='peaklets',
+                             config=None,
+                             run_id='000000',
+                             warm_up=True):
+    """
+    Process the data in daq_config['daq_input_dir'] (e.g. from
+    write_synthetic_daq_data) from the DAQReader up to the targets in a
+    single process, and time it.
+
+    :param daq_config: config of the DAQReader as returned by
+        write_synthetic_daq_data
+    :param targets: data types to make
+    :param config: other config to use, by default fixed gains and hit
+        thresholds, so we don't need the database
+    :param run_id: run_id to use
+    :param warm_up: first process a small synthetic dataset, such that
+        the numba compilation is not part of the benchmark
+    :return: dict with the wall time (total and per plugin) [s], the raw
+        data rate [MB/s], the peak RSS during the processing [MB] and
+        how much the processing raised the RSS (rss_increase_mb) [MB].
+        The peak RSS only excludes what happened before (e.g.
+        generating the data) on Linux. Elsewhere it is the peak of the
+        whole process, and rss_increase_mb how much the processing
+        raised that.
+    """
+    import tempfile
+
+    daq_config = daq_config.copy()
+    raw_bytes = daq_config.pop('raw_bytes', None)
+    timings = defaultdict(float)
+    plugins = [straxen.DAQReader, straxen.PulseProcessing, straxen.Peaklets]
+
+    context_config = dict(straxen.contexts.xnt_common_config,
+                          gain_model=('to_pe_placeholder', True),
+                          hit_min_amplitude=15,
+                          **daq_config)
+    context_config.update(config if config is not None else dict())
+
+    if warm_up:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            warm_up_config = write_synthetic_daq_data(
+                os.path.join(temp_dir, 'live_data'),
+                duration=int(1e8),
+                n_readout_threads=sum(daq_config['readout_threads'].values()),
+                chunk_duration=int(4e7),
+                overlap_duration=int(1e7),
+                compressor=daq_config.get('daq_compressor', 'lz4'),
+                record_length=daq_config.get('record_length', 110))
+            benchmark_daq_processing(warm_up_config, targets, config,
+                                     warm_up=False)
+
+    baseline_rss = _reset_peak_rss()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        st = strax.Context(storage=[strax.DataDirectory(temp_dir)],
+                           register=[_timed_plugin(p, timings) for p in plugins],
+                           config=context_config,
+                           free_options=tuple(context_config.keys()),
+                           allow_multiprocess=False)
+        t_start = time.time()
+        for target in strax.to_str_tuple(targets):
+            st.make(run_id, target)
+        wall_time = time.time() - t_start
+
+        if raw_bytes is None:
+            raw_bytes = sum([md['nbytes'] for md in
+                             st.get_meta(run_id, 'raw_records')['chunks']])
+
+    peak_rss = _peak_rss()
+    return dict(wall_time=wall_time,
+                plugin_time=dict(timings),
+                raw_mb=raw_bytes / 1e6,
+                raw_mbs=raw_bytes / 1e6 / wall_time,
+                peak_rss_mb=peak_rss / 1e3,
+                rss_increase_mb=(peak_rss - baseline_rss) / 1e3)
+
+
+def _proc_status_kb(field):
+    """Field of /proc/self/status in kB, None if not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process to the current RSS, which the
+    Linux kernel allows through /proc/self/clear_refs
+    :return: the current RSS [kB], or, if the peak cannot be reset,
+        the peak RSS so far
+    """
+    current_rss = _proc_status_kb('VmRSS')
+    try:
+        with open('/proc/self/clear_refs', mode='w') as f:
+            f.write('5')
+    except OSError:
+        return _peak_rss()
+    return current_rss
+
+
+def _peak_rss():
+    """Peak RSS of this process [kB], since the last _reset_peak_rss"""
+    peak_rss = _proc_status_kb('VmHWM')
+    if peak_rss is None:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss
+
+
+def _timed_plugin(plugin_class, timings):
+    """Return plugin_class that adds the time spent in its do_compute to
+    timings. Only works when processing in a single process."""
+
+    class TimedPlugin(plugin_class):
+        def do_compute(self, chunk_i=None, **kwargs):
+            t_start = time.time()
+            result = super().do_compute(chunk_i=chunk_i, **kwargs)
+            timings[plugin_class.__name__] += time.time() - t_start
+            return result
+
+    # Keep the name for the lineage
+    TimedPlugin.__name__ = plugin_class.__name__
+    return TimedPlugin
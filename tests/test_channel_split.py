@@ -1,5 +1,6 @@
 import numpy as np
 import hypothesis
+import hypothesis.strategies
 
 import strax.testutils
 import straxen
@@ -26,3 +27,21 @@ def test_channel_split(records):
             np.unique(result[i]['channel']),
             np.unique(result_2[i]['channel']))
         np.testing.assert_array_equal(result[i], result_2[i])
+
+
+@hypothesis.settings(deadline=None)
+@hypothesis.given(strax.testutils.several_fake_records,
+                  hypothesis.strategies.integers(min_value=0, max_value=int(1e18)))
+def test_channel_split_time_offset(records, time_offset):
+    channel_range = np.asarray([[0, 0], [1, 2], [3, 3], [4, 999]])
+    result = list(straxen.split_channel_ranges(records, channel_range, time_offset))
+    result_2 = channel_split_naive(records, channel_range)
+
+    for i, _ in enumerate(result):
+        if not len(result_2[i]):
+            assert not len(result[i])
+            continue
+        dt = result_2[i]['dt'][0]
+        np.testing.assert_array_equal(result[i]['time'],
+                                      result_2[i]['time'] + dt * (time_offset // dt))
+        np.testing.assert_array_equal(result[i]['data'], result_2[i]['data'])
@@ -0,0 +1,330 @@
+"""Test the CMT services against a local mongomock database"""
+import datetime
+import bson
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+import strax
+import straxen
+
+mongomock = pytest.importorskip('mongomock')
+
+N_PMTS = {'pmt': 30, 'n_veto': 12, 'mu_veto': 5}
+OTHER_CORRECTIONS = {
+    'elife': lambda rng: float(rng.normal(1e6, 1e4)),
+    'mlp_model': lambda rng: f'mlp_model_{rng.integers(100)}.tar.gz',
+    'hit_thresholds_tpc': lambda rng: rng.integers(10, 20, 4).tolist(),
+}
+START = datetime.datetime(2021, 1, 1)
+
+
+def _cmt(client):
+    """CorrectionsManagementServices on a mongomock client (which
+    strax.CorrectionsInterface refuses as it is no pymongo.MongoClient)"""
+    cmt = straxen.CorrectionsManagementServices.__new__(
+        straxen.CorrectionsManagementServices)
+    cmt.client = client
+    cmt.interface = strax.CorrectionsInterface.__new__(strax.CorrectionsInterface)
+    cmt.interface.client = client
+    cmt.interface.database_name = 'corrections'
+    cmt.is_nt = True
+    cmt.collection = client['xenonnt']['runs']
+    cmt.cache_namespace = (id(client), True)
+    return cmt
+
+
+def _insert_entries(collection, rng, make_value):
+    """Insert entries of the ONLINE and v1 versions at random times,
+    some without a value or without the version"""
+    n_entries = rng.integers(1, 8)
+    times = START + pd.to_timedelta(
+        np.sort(rng.choice(100, n_entries, replace=False)), unit='D')
+    docs = []
+    for time in times:
+        doc = {'time': time.to_pydatetime(),
+               'ONLINE': make_value(),
+               'v1': make_value()}
+        if rng.random() < 0.2:
+            doc['v1'] = None
+        if rng.random() < 0.1:
+            del doc['ONLINE']
+        docs.append(doc)
+    # Stored in random order
+    collection.insert_many(list(rng.permutation(docs)))
+
+
+def _fill_database(client, seed=0):
+    rng = np.random.default_rng(seed)
+    database = client['corrections']
+    local_versions = {}
+    for detector, n_pmts in N_PMTS.items():
+        for pmt in range(n_pmts):
+            name = f'{detector}_{pmt:03d}_gain_xenonnt'
+            local_versions[name] = 'ONLINE'
+            _insert_entries(database[name], rng, lambda: float(rng.normal(0.005, 0.001)))
+    for name, make_value in OTHER_CORRECTIONS.items():
+        local_versions[name] = 'ONLINE'
+        _insert_entries(database[name], rng, lambda: make_value(rng))
+    database['global_xenonnt'].insert_one(
+        {'time': START,
+         'global_ONLINE': local_versions,
+         'global_v1': {name: 'v1' for name in local_versions}})
+
+    runs = client['xenonnt']['runs']
+    for number in range(20):
+        runs.insert_one({'number': number,
+                         'start': START + datetime.timedelta(days=5 * number + 0.5)})
+    # A run at exactly the time of the first entry
+    runs.insert_one({'number': 20, 'start': START})
+
+
+def _get_correction_reference(cmt, run_id, correction, version):
+    """Previous implementation of the per-PMT corrections, reading and
+    interpolating every PMT by itself"""
+    when = cmt.get_start_time(run_id)
+    values = []
+    df_global = cmt.interface.read('global_xenonnt')
+    for it_correction in df_global['global_ONLINE'][0].keys():
+        if correction in it_correction:
+            df = cmt.interface.read(it_correction)
+            if version in 'ONLINE':
+                df = cmt.interface.interpolate(df, when, how='fill')
+            else:
+                df = cmt.interface.interpolate(df, when)
+            values.append(df.loc[df.index == when, version].values[0])
+    return np.asarray(values, dtype=np.float64)
+
+
+@pytest.mark.parametrize('version', ['ONLINE', 'v1'])
+def test_get_gains(version):
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    cmt = _cmt(client)
+    # Join the PMTs in several queries, a few per query
+    first = list(client[cmt.interface.database_name]['pmt_000_gain_xenonnt'].find())
+    cmt._max_lookup_bytes = 7 * len(bson.encode({'pmt_000_gain_xenonnt': first}))
+    for detector, n_pmts in N_PMTS.items():
+        for run_id in range(21):
+            result = cmt._get_correction(str(run_id), detector, version)
+            expected = _get_correction_reference(cmt, str(run_id), detector, version)
+            assert result.shape == (n_pmts,)
+            np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        cmt._get_correction('0', 'pmt', 'v2')
+
+
+def test_interpolate_corrections():
+    when = datetime.datetime(2021, 1, 10, tzinfo=pytz.utc)
+    day = np.timedelta64(1, 'D')
+    start = np.datetime64('2021-01-01', 'ns')
+    times = start + day * np.array([[0, 5, 12, 20], [0, 5, 9, 20],
+                                    [9, 12, 13, 20], [0, 1, 2, 2]])
+    times[3, 3] = np.datetime64('NaT')
+    values = np.array([[1, np.nan, 4, 5], [1, 2, 3, 4],
+                       [1, 2, 3, 4], [1, 2, np.nan, np.nan]])
+    np.testing.assert_array_equal(
+        straxen.interpolate_corrections(times, values, when, how='fill'),
+        [1, 3, 1, 2])
+    # Linear between the positions of the entries, as pandas does
+    np.testing.assert_array_equal(
+        straxen.interpolate_corrections(times, values, when),
+        [1 + 3 * 2 / 3, 3, 1, 2])
+    with pytest.raises(ValueError):
+        straxen.interpolate_corrections(times, values, when.replace(tzinfo=None))
+
+
+def test_corrections_cache():
+    """Corrections are read once for all instances"""
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    straxen.clear_cmt_cache()
+    gains = _cmt(client)._get_correction('1', 'pmt', 'ONLINE')
+    assert straxen.cmt_cache_info() == dict(hits=0, misses=1, size=1,
+                                            start_time_hits=0, start_time_misses=1)
+    assert not gains.flags.writeable
+
+    # Another instance on the same database
+    assert _cmt(client)._get_correction('1', 'pmt', 'ONLINE') is gains
+    _cmt(client)._get_correction('1', 'n_veto', 'ONLINE')
+    assert straxen.cmt_cache_info() == dict(hits=1, misses=2, size=2,
+                                            start_time_hits=1, start_time_misses=1)
+
+    # But not for another database
+    other_client = mongomock.MongoClient()
+    _fill_database(other_client, seed=1)
+    other_gains = _cmt(other_client)._get_correction('1', 'pmt', 'ONLINE')
+    assert not np.array_equal(other_gains, gains, equal_nan=True)
+    assert straxen.cmt_cache_info()['misses'] == 3
+
+    straxen.clear_cmt_cache()
+    assert straxen.cmt_cache_info()['size'] == 0
+
+
+def test_corrections_cache_limits(monkeypatch):
+    """The cache is bounded, and ONLINE corrections expire"""
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    straxen.clear_cmt_cache()
+    cache = straxen.corrections_services._corrections_cache
+    max_bytes = cache.max_bytes
+    cmt = _cmt(client)
+    try:
+        gains = cmt._get_correction('1', 'pmt', 'v1')
+        cache.resize(3 * cache.nbytes)
+        for run_id in range(2, 10):
+            cmt._get_correction(str(run_id), 'pmt', 'v1')
+        assert len(cache) == 3
+        # The least recently used were evicted
+        assert cmt._get_correction('1', 'pmt', 'v1') is not gains
+        np.testing.assert_array_equal(cmt._get_correction('1', 'pmt', 'v1'), gains)
+    finally:
+        cache.resize(max_bytes)
+
+    gains = cmt._get_correction('1', 'pmt', 'ONLINE')
+    assert cmt._get_correction('1', 'pmt', 'ONLINE') is gains
+    monkeypatch.setattr(straxen.CorrectionsManagementServices, 'online_ttl', -1)
+    assert cmt._get_correction('1', 'pmt', 'ONLINE') is not gains
+    # Other versions do not expire
+    gains = cmt._get_correction('1', 'pmt', 'v1')
+    assert cmt._get_correction('1', 'pmt', 'v1') is gains
+    straxen.clear_cmt_cache()
+
+
+def test_cmt_snapshot(tmp_path):
+    """A snapshot gives the same corrections as the database"""
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    cmt = _cmt(client)
+    file_name = str(tmp_path / 'snapshot.npz')
+    straxen.make_cmt_snapshot(file_name, 'global_v1', run_ids=[str(r) for r in range(15)],
+                              extra_versions=('ONLINE',), cmt=cmt)
+    snapshot = straxen.CorrectionsSnapshot(file_name)
+
+    for run_id in range(15):
+        for correction in list(N_PMTS) + list(OTHER_CORRECTIONS):
+            for version in ('ONLINE', 'v1'):
+                np.testing.assert_array_equal(
+                    snapshot._read_correction(str(run_id), correction, version),
+                    cmt._read_correction(str(run_id), correction, version))
+    assert snapshot.global_versions == ['global_v1']
+    assert snapshot.get_local_versions('latest') == cmt.get_local_versions('global_v1')
+    with pytest.raises(ValueError):
+        # Run not in the snapshot
+        snapshot._read_correction('16', 'elife', 'v1')
+    with pytest.raises(ValueError):
+        snapshot._read_correction('1', 'elife', 'v2')
+
+    straxen.use_cmt_snapshot(file_name)
+    try:
+        assert straxen.get_shared_cmt() is not cmt
+        assert straxen.get_correction_from_cmt('12', ('elife', 'ONLINE', True)) == \
+               float(cmt._read_correction('12', 'elife', 'ONLINE'))
+        np.testing.assert_array_equal(
+            straxen.get_correction_from_cmt('12', ('hit_thresholds_tpc', 'ONLINE', True)),
+            cmt._read_correction('12', 'hit_thresholds_tpc', 'ONLINE')[0])
+        assert straxen.corrections_services.get_cmt_local_versions('global_v1')['elife'] == 'v1'
+    finally:
+        straxen.use_cmt_snapshot(None)
+
+
+class _RunsContext:
+    """Reads the run metadata from the runs collection, like a context"""
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.calls = 0
+
+    def run_metadata(self, run_id, projection=None):
+        self.calls += 1
+        doc = self.runs.find_one({'number': int(run_id)},
+                                 {'_id': 0, **{field: 1 for field in projection}})
+        if doc is None:
+            raise strax.RunMetadataNotAvailable(run_id)
+        return doc
+
+
+def test_run_times_index(tmp_path):
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    runs = client['xenonnt']['runs']
+    for doc in runs.find({'number': {'$lt': 10}}):
+        runs.update_one({'number': doc['number']},
+                        {'$set': {'end': doc['start'] + datetime.timedelta(hours=1)}})
+    runs.update_one({'number': 3}, {'$set': {'livetime': 1234.5}})
+    runs.insert_one({'number': 2500, 'start': START})
+
+    cache_file = str(tmp_path / 'run_times.npz')
+    index = straxen.RunTimesIndex(runs, cache_file=cache_file)
+    for run_id in range(21):
+        assert index.get(f'{run_id:06d}')['start'] == _cmt(client).get_start_time(run_id)
+    assert index.get('002500')['start'] == START.replace(tzinfo=pytz.utc)
+    assert index.get(1500) is None
+    # One query per block of runs, and one for the missing run
+    assert index.stats['queries'] == 3
+
+    # Loaded from disk by another index
+    other_index = straxen.RunTimesIndex(runs, cache_file=cache_file)
+    assert other_index.runs == index.runs
+    assert other_index.get(3, fetch=False) == dict(
+        start=START.replace(tzinfo=pytz.utc) + datetime.timedelta(days=15.5),
+        end=START.replace(tzinfo=pytz.utc) + datetime.timedelta(days=15.5, hours=1),
+        livetime=1234.5)
+    assert other_index.stats['queries'] == 0
+
+    # CMT and get_livetime_sec use the index of the shared CMT
+    straxen.clear_cmt_cache()
+    cmt = _cmt(client)
+    straxen.corrections_services.set_shared_cmt(cmt)
+    try:
+        for run_id in range(21):
+            cmt.get_start_time(str(run_id))
+        assert cmt.run_times.stats['queries'] == 1
+        context = _RunsContext(runs)
+        assert straxen.get_livetime_sec(context, '000003') == 1234.5
+        assert context.calls == 0
+        assert straxen.get_livetime_sec(context, '000004') == 3600
+        # A livetime written after the run was indexed is not missed
+        runs.update_one({'number': 4}, {'$set': {'livetime': 1800.}})
+        assert straxen.get_livetime_sec(context, '000004') == 1800
+        assert context.calls == 2
+    finally:
+        straxen.corrections_services.set_shared_cmt(None)
+        straxen.clear_cmt_cache()
+
+
+@pytest.mark.parametrize('version', ['ONLINE', 'v1'])
+def test_preload_corrections(version):
+    """Corrections evaluated at many runs at once are the same as
+    those evaluated per run"""
+    client = mongomock.MongoClient()
+    _fill_database(client)
+    run_ids = [str(run_id) for run_id in range(21)]
+    cmt = _cmt(client)
+    expected = {(run_id, correction): cmt._read_correction(run_id, correction, version)
+                for run_id in run_ids
+                for correction in list(N_PMTS) + list(OTHER_CORRECTIONS)}
+
+    straxen.clear_cmt_cache()
+    for correction in list(N_PMTS) + list(OTHER_CORRECTIONS):
+        cmt.preload_corrections(run_ids, correction, version)
+    assert straxen.cmt_cache_info()['size'] == len(expected)
+    for (run_id, correction), value in expected.items():
+        result = cmt._get_correction(run_id, correction, version)
+        # Integer arrays (hit thresholds) are returned as float
+        assert (result.dtype.kind == 'U') == (value.dtype.kind == 'U')
+        np.testing.assert_array_equal(result, value)
+    assert straxen.cmt_cache_info()['misses'] == 0
+
+    # Also through get_corrections_for_runs, with the shared CMT
+    straxen.corrections_services.set_shared_cmt(cmt)
+    try:
+        results = straxen.get_corrections_for_runs(run_ids[10:], ('elife', version, True))
+        assert list(results) == run_ids[10:]
+        np.testing.assert_array_equal(
+            list(results.values()),
+            [float(expected[run_id, 'elife'][0]) for run_id in run_ids[10:]])
+    finally:
+        straxen.corrections_services.set_shared_cmt(None)
+        straxen.clear_cmt_cache()
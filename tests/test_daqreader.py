@@ -0,0 +1,115 @@
+import os
+import tempfile
+import numpy as np
+import hypothesis
+import hypothesis.strategies
+import pytest
+
+import strax
+import strax.testutils
+import straxen
+
+
+@hypothesis.settings(deadline=None)
+@hypothesis.given(strax.testutils.several_fake_records,
+                  hypothesis.strategies.integers(min_value=1, max_value=5))
+def test_merge_sorted_records(records, n_threads):
+    """Splitting sorted records over several (fake) readout threads and
+    merging them should give the same as the concatenate + sort"""
+    records = strax.sort_by_time(records)
+    per_thread = [records[records['channel'] % n_threads == thread_i]
+                  for thread_i in range(n_threads)]
+    assert all([straxen.is_sorted_by_time(r) for r in per_thread])
+
+    result = straxen.merge_sorted_records(per_thread)
+    expected = strax.sort_by_time(np.concatenate(per_thread))
+    assert straxen.is_sorted_by_time(result)
+    np.testing.assert_array_equal(result, expected)
+
+
+def _write_daq_folder(records, folder, n_readers=2):
+    """Write records in a folder like the readout threads of redax"""
+    os.makedirs(folder)
+    for reader_i in range(n_readers):
+        r = records[records['channel'] % n_readers == reader_i]
+        with open(os.path.join(folder, f'reader_{reader_i}'), 'wb') as f:
+            f.write(strax.io.COMPRESSORS['lz4']['compress'](r))
+
+
+def _fake_daq_input(input_dir, n_readers=2):
+    """Write two chunks (and the overlap between them) of pulses every
+    5 us in the TPC to the input_dir and return the records"""
+    dt_central, dt_overlap = int(1e7), int(1e6)
+    chunk_duration = dt_central + dt_overlap
+    records = np.zeros(2 * chunk_duration // 5000, dtype=strax.raw_record_dtype())
+    records['time'] = np.arange(len(records)) * 5000
+    records['channel'] = np.arange(len(records)) % 494
+    records['length'] = records['pulse_length'] = 110
+    records['dt'] = 10
+
+    for chunk_i in range(2):
+        t_start = chunk_i * chunk_duration
+        central = ((records['time'] >= t_start)
+                   & (records['time'] < t_start + dt_central))
+        _write_daq_folder(records[central],
+                          os.path.join(input_dir, f'{chunk_i:06d}'),
+                          n_readers)
+        post = ((records['time'] >= t_start + dt_central)
+                & (records['time'] < t_start + chunk_duration))
+        for folder in (f'{chunk_i:06d}_post', f'{chunk_i + 1:06d}_pre'):
+            _write_daq_folder(records[post], os.path.join(input_dir, folder),
+                              n_readers)
+    os.makedirs(os.path.join(input_dir, 'THE_END'))
+    for reader_i in range(n_readers):
+        with open(os.path.join(input_dir, 'THE_END', f'reader_{reader_i}'), 'w') as f:
+            f.write("That's all folks!")
+
+    config = dict(daq_input_dir=input_dir,
+                  readout_threads={'reader': n_readers},
+                  daq_chunk_duration=dt_central,
+                  daq_overlap_chunk_duration=dt_overlap,
+                  channel_map=straxen.contexts.xnt_common_config['channel_map'])
+    return records, config
+
+
+@pytest.mark.parametrize('use_inotify', [
+    False,
+    pytest.param(True, marks=pytest.mark.skipif(
+        straxen.plugins.daqreader.inotify_simple is None,
+        reason='inotify_simple is not installed'))])
+def test_daqreader(use_inotify):
+    """Read fake DAQ data and check that we get all records back"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        records, config = _fake_daq_input(os.path.join(temp_dir, 'live_data'))
+        config['daq_input_inotify'] = use_inotify
+        st = strax.Context(storage=[],
+                           register=straxen.DAQReader,
+                           config=config)
+        raw_records = st.get_array('0', 'raw_records')
+        np.testing.assert_array_equal(raw_records, records)
+
+
+def test_synthetic_raw_records():
+    kwargs = dict(start=0, end=int(1e7), channel_rate=1e4, s2_rate=1e3,
+                  saturation_fraction=0.5, quiet_gap_rate=100)
+    records = straxen.synthetic_raw_records(seed=1, **kwargs)
+    assert len(records)
+    np.testing.assert_array_equal(
+        records, straxen.synthetic_raw_records(seed=1, **kwargs))
+    assert straxen.is_sorted_by_time(records)
+    in_pulse = np.arange(records['data'].shape[1]) < records['length'][:, np.newaxis]
+    assert np.any(records['data'][in_pulse] == 0), 'No saturation?'
+    straxen.plugins.pulse_processing.check_overlaps(records, n_channels=3000)
+
+
+def test_benchmark_synthetic_daq_data():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        daq_config = straxen.write_synthetic_daq_data(
+            os.path.join(temp_dir, 'live_data'),
+            duration=int(1e8),
+            chunk_duration=int(4e7),
+            overlap_duration=int(1e7))
+        result = straxen.benchmark_daq_processing(daq_config, warm_up=False)
+    assert result['raw_mb'] > 0
+    assert set(result['plugin_time']) == {'DAQReader', 'PulseProcessing', 'Peaklets'}
+    assert 0 <= result['rss_increase_mb'] <= result['peak_rss_mb']
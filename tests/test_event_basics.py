@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+import strax
+import straxen
+
+
+class _EventBasicsReference(straxen.EventBasics):
+    """Previous (python, per event) implementation of EventBasics"""
+
+    def compute(self, events, peaks):
+        result = np.zeros(len(events), dtype=self.dtype)
+        self.set_nan_defaults(result)
+
+        split_peaks = strax.split_by_containment(peaks, events)
+        for event_i, _ in enumerate(events):
+            peaks_in_event_i = split_peaks[event_i]
+            result[event_i]['time'] = events[event_i]['time']
+            result[event_i]['endtime'] = events[event_i]['endtime']
+            result[event_i]['n_peaks'] = len(peaks_in_event_i)
+            self.fill_result_i(result[event_i], peaks_in_event_i)
+        return result
+
+    def fill_result_i(self, event, peaks):
+        largest_s2s, s2_idx = self.get_largest_sx_peaks(peaks, s_i=2)
+        if self.config['force_main_before_alt']:
+            s2_order = np.argsort(largest_s2s['time'])
+            largest_s2s = largest_s2s[s2_order]
+            s2_idx = s2_idx[s2_order]
+        if not self.config['allow_posts2_s1s'] and len(largest_s2s):
+            s1_latest_time = largest_s2s[0]['time']
+        else:
+            s1_latest_time = np.inf
+        largest_s1s, s1_idx = self.get_largest_sx_peaks(
+            peaks,
+            s_i=1,
+            s1_before_time=s1_latest_time,
+            s1_min_coincidence=self.config['event_s1_min_coincidence'])
+
+        for name, idx in (('s1', s1_idx), ('s2', s2_idx)):
+            if len(idx):
+                event[f'{name}_index'] = idx[0]
+                if len(idx) > 1:
+                    event[f'alt_{name}_index'] = idx[1]
+
+        if len(largest_s1s) > 0 and len(largest_s2s) > 0:
+            event['drift_time'] = largest_s2s[0]['center_time'] - largest_s1s[0]['center_time']
+            if len(largest_s1s) > 1:
+                event['alt_s1_interaction_drift_time'] = (
+                        largest_s2s[0]['center_time'] - largest_s1s[1]['center_time'])
+            if len(largest_s2s) > 1:
+                event['alt_s2_interaction_drift_time'] = (
+                        largest_s2s[1]['center_time'] - largest_s1s[0]['center_time'])
+        if len(largest_s2s):
+            peaks_before_ms2 = peaks[peaks['time'] < largest_s2s[0]['time']]
+            # Sum as numba does (in float32, in order)
+            area = np.float32(0)
+            for a in peaks_before_ms2['area']:
+                area += a
+            event['area_before_main_s2'] = area
+            s2peaks_before_ms2 = peaks_before_ms2[peaks_before_ms2['type'] == 2]
+            if len(s2peaks_before_ms2) == 0:
+                event['large_s2_before_main_s2'] = 0
+            else:
+                event['large_s2_before_main_s2'] = np.max(s2peaks_before_ms2['area'])
+
+        for s_i, largest_s_i in enumerate([largest_s1s, largest_s2s], 1):
+            for largest_index, main_or_alt in enumerate(['s', 'alt_s']):
+                if largest_index >= len(largest_s_i):
+                    continue
+                peak_properties_to_save = [name for name, _, _ in self.peak_properties]
+                if s_i == 2:
+                    peak_properties_to_save += ['x', 'y']
+                    peak_properties_to_save += self.posrec_save
+                for p_field in peak_properties_to_save:
+                    event[f'{main_or_alt}{s_i}_{p_field}'] = (
+                        largest_s_i[largest_index][p_field])
+
+    @staticmethod
+    def get_largest_sx_peaks(peaks, s_i, s1_before_time=np.inf,
+                             s1_min_coincidence=0, number_of_peaks=2):
+        s_mask = peaks['type'] == s_i
+        if s_i == 1:
+            s_mask &= peaks['time'] < s1_before_time
+            s_mask &= peaks['tight_coincidence'] >= s1_min_coincidence
+        selected_peaks = peaks[s_mask]
+        s_index = np.arange(len(peaks))[s_mask]
+        largest_peaks = np.argsort(selected_peaks['area'])[-number_of_peaks:][::-1]
+        return selected_peaks[largest_peaks], s_index[largest_peaks]
+
+
+class _PeakPositions:
+    dtype = strax.time_fields + [
+        (xy + algo, np.float32) for algo in ('', '_cnn', '_gcn', '_mlp') for xy in 'xy']
+
+    def dtype_for(self, data_type):
+        return np.dtype(self.dtype)
+
+
+def _event_basics(plugin_class, config):
+    plugin = plugin_class()
+    plugin.config = config
+    plugin.deps = {'peak_positions': _PeakPositions()}
+    plugin.dtype = strax.to_numpy_dtype(plugin.infer_dtype())
+    return plugin
+
+
+def _fake_events(seed, n_peaks=5000):
+    rng = np.random.default_rng(seed)
+    peaks = np.zeros(n_peaks, dtype=strax.merged_dtype([
+        strax.to_numpy_dtype(straxen.PeakBasics.dtype),
+        strax.to_numpy_dtype(_PeakPositions.dtype),
+        strax.to_numpy_dtype(straxen.PeakProximity.dtype)]))
+    duration = rng.integers(10, 1000, n_peaks)
+    peaks['time'] = np.cumsum(duration + rng.integers(0, 1000, n_peaks)) - duration
+    peaks['endtime'] = peaks['time'] + duration
+    peaks['center_time'] = peaks['time'] + rng.integers(0, 10, n_peaks)
+    # Include equal areas, negative areas and nan areas
+    peaks['area'] = np.round(10 ** rng.uniform(0, 3, n_peaks), rng.integers(-1, 2))
+    peaks['area'][rng.random(n_peaks) < 0.2] *= -1
+    peaks['area'][rng.random(n_peaks) < 0.01] = np.nan
+    peaks['type'] = rng.integers(0, 3, n_peaks)
+    peaks['tight_coincidence'] = rng.integers(0, 5, n_peaks)
+    for field in ('n_channels', 'n_competing', 'max_pmt'):
+        peaks[field] = rng.integers(0, 100, n_peaks)
+    for field in ['max_pmt_area', 'range_50p_area', 'range_90p_area',
+                  'rise_time', 'area_fraction_top'] + [
+                      name for name, _ in _PeakPositions.dtype[2:]]:
+        peaks[field] = rng.normal(size=n_peaks)
+
+    # Up to 16 peaks per event, so np.argsort in the reference is stable
+    breaks = np.unique(np.cumsum(rng.integers(1, 17, n_peaks)))
+    breaks = np.concatenate([[0], breaks[breaks < n_peaks], [n_peaks]])
+    events = np.zeros(len(breaks) - 1, dtype=strax.to_numpy_dtype(straxen.Events.dtype))
+    events['time'] = peaks['time'][breaks[:-1]]
+    events['endtime'] = peaks['endtime'][breaks[1:] - 1]
+    # Some peaks are not in an event
+    events = events[rng.random(len(events)) < 0.8]
+    return events, peaks
+
+
+@pytest.mark.parametrize('allow_posts2_s1s', [False, True])
+@pytest.mark.parametrize('force_main_before_alt', [False, True])
+def test_event_basics(allow_posts2_s1s, force_main_before_alt):
+    """The compiled event basics should be the same as the previous
+    per-event implementation"""
+    config = dict(allow_posts2_s1s=allow_posts2_s1s,
+                  force_main_before_alt=force_main_before_alt,
+                  event_s1_min_coincidence=2)
+    events, peaks = _fake_events(seed=0)
+    result = _event_basics(straxen.EventBasics, config).compute(events, peaks)
+    expected = _event_basics(_EventBasicsReference, config).compute(events, peaks)
+    assert result.dtype == expected.dtype
+    assert np.any(result['alt_s2_index'] != -1)
+    assert np.any(result['alt_s1_index'] != -1)
+    assert np.any(result['large_s2_before_main_s2'] < 0)
+    for field in result.dtype.names:
+        np.testing.assert_array_equal(result[field], expected[field], err_msg=field)
+
+
+def test_event_basics_no_peaks():
+    config = dict(allow_posts2_s1s=False,
+                  force_main_before_alt=False,
+                  event_s1_min_coincidence=2)
+    events, peaks = _fake_events(seed=1)
+    events[0]['time'] = events[0]['endtime'] - 1
+    with pytest.raises(ValueError):
+        _event_basics(straxen.EventBasics, config).compute(events, peaks)
@@ -0,0 +1,244 @@
+import numpy as np
+import pytest
+import strax
+import straxen
+from straxen.plugins.event_patternfit import (
+    binom_cdf, binom_pmf, binom_sf, binom_test, neg2llh_modpoisson)
+
+N_TPC_PMTS, N_TOP_PMTS = 494, 253
+
+
+def _event_pattern_fit(plugin_class, store_per_channel, seed=0):
+    """EventPatternFit with random maps and dead PMTs"""
+    rng = np.random.default_rng(seed)
+    plugin = plugin_class()
+    plugin.config = dict(n_tpc_pmts=N_TPC_PMTS,
+                         n_top_pmts=N_TOP_PMTS,
+                         mean_pe_per_photon=1.2,
+                         s1_min_area_pattern_fit=3,
+                         s2_min_area_pattern_fit=10,
+                         store_per_channel=store_per_channel,
+                         max_r_pattern_fit=straxen.tpc_r)
+    plugin.dtype = strax.to_numpy_dtype(plugin.infer_dtype())
+    plugin.mean_pe_photon = plugin.config['mean_pe_per_photon']
+
+    xyz = [['x', [-70, 70, 8]], ['y', [-70, 70, 8]], ['z', [-150, 0, 5]]]
+    plugin.s1_pattern_map = straxen.InterpolatingMap(dict(
+        coordinate_system=xyz, map=rng.uniform(0, 1, (8, 8, 5, N_TPC_PMTS)).tolist()))
+    plugin.s2_pattern_map = straxen.InterpolatingMap(dict(
+        coordinate_system=xyz[:2], map=rng.uniform(0, 1, (8, 8, N_TPC_PMTS)).tolist()))
+    plugin.s1_aft_map = straxen.InterpolatingMap(dict(
+        coordinate_system=xyz, map=rng.uniform(0.1, 0.6, 8 * 8 * 5).tolist()))
+
+    plugin.pmtbool = rng.random(N_TPC_PMTS) > 0.05
+    plugin.pmtbool_top = plugin.pmtbool[:N_TOP_PMTS]
+    plugin.pmtbool_bottom = plugin.pmtbool[N_TOP_PMTS:]
+    return plugin
+
+
+def _fake_events(seed, n_events=1000):
+    rng = np.random.default_rng(seed)
+    events = np.zeros(n_events, dtype=_event_dtype())
+    events['time'] = np.arange(n_events) * 100
+    events['endtime'] = events['time'] + 10
+    r = 70 * np.sqrt(rng.random(n_events))
+    phi = rng.uniform(0, 2 * np.pi, n_events)
+    for prefix in ('', 's2_', 'alt_s2_'):
+        events[prefix + 'x'] = r * np.cos(phi) + (rng.normal(0, 3, n_events) if prefix else 0)
+        events[prefix + 'y'] = r * np.sin(phi) + (rng.normal(0, 3, n_events) if prefix else 0)
+    events['z'] = rng.uniform(-150, 0, n_events)
+    events['x'][rng.random(n_events) < 0.02] = np.nan
+
+    for s_i, max_log_area in (('s1', 3), ('alt_s1', 2), ('s2', 5), ('alt_s2', 3)):
+        events[f'{s_i}_index'] = np.where(rng.random(n_events) < 0.9, 1, -1)
+        events[f'{s_i}_area'] = 10 ** rng.uniform(0, max_log_area, n_events)
+        events[f'{s_i}_area_fraction_top'] = rng.uniform(-0.05, 0.8, n_events)
+        for field in (f'{s_i}_area', f'{s_i}_area_fraction_top'):
+            events[field][rng.random(n_events) < 0.02] = np.nan
+        if s_i in ('s1', 's2', 'alt_s2'):
+            # Some channels without area and some with negative area
+            area_per_channel = (rng.uniform(-0.1, 1, (n_events, N_TPC_PMTS))
+                                * events[f'{s_i}_area'][:, None] / N_TPC_PMTS * 2)
+            area_per_channel[rng.random(area_per_channel.shape) < 0.3] = 0
+            events[f'{s_i}_area_per_channel'] = area_per_channel
+    return events
+
+
+def _event_dtype():
+    """Fields of the events that EventPatternFit uses"""
+    dtype = strax.time_fields + [(f, np.float32) for f in ('x', 'y', 'z')]
+    for s_i in ('s1', 'alt_s1', 's2', 'alt_s2'):
+        dtype += [(f'{s_i}_index', np.int32),
+                  (f'{s_i}_area', np.float32),
+                  (f'{s_i}_area_fraction_top', np.float32),
+                  (f'{s_i}_area_per_channel', np.float32, (N_TPC_PMTS,))]
+    for s_i in ('s2', 'alt_s2'):
+        dtype += [(f'{s_i}_x', np.float32), (f'{s_i}_y', np.float32)]
+    return np.dtype(dtype)
+
+
+def _pattern_neg2llh_reference(map_effs, area_per_channel, area, live, mean_pe_photon):
+    """-2LLH per live channel as computed before, in double precision"""
+    map_effs = map_effs[:, live]
+    area_per_channel = area_per_channel[:, live].astype(np.float64)
+    pattern = area.astype(np.float64)[:, None] * map_effs / np.sum(map_effs, axis=1)[:, None]
+    neg2llh = (neg2llh_modpoisson(pattern / mean_pe_photon, area_per_channel, mean_pe_photon)
+               - neg2llh_modpoisson(area_per_channel / mean_pe_photon, area_per_channel,
+                                    mean_pe_photon))
+    return neg2llh, pattern
+
+
+def _binom_test_reference(k, n, p):
+    """Previous (scalar) implementation of binom_test"""
+    d = binom_pmf(k, n, p)
+    rerr = 1 + 1e-7
+    d = d * rerr
+    if n > 0:
+        n_iter = int(max(np.round(np.log10(n)) + 1, 2))
+    else:
+        n_iter = 2
+
+    if k < n * p:
+        if binom_pmf(n, n, p) > d:
+            for n_ in np.arange(n, 2*n, 1):
+                if binom_pmf(n_, n, p) < d:
+                    j_min, j_max = k, n_
+                    do_test = True
+                    break
+                do_test = False
+        else:
+            j_min, j_max = k, n
+            do_test = True
+        def _check_(d, y0, y1):
+            return (d>y1) and (d<=y0)
+    else:
+        if binom_pmf(0, n, p) > d:
+            n_iter, j_min, j_max = 0, 0, 0
+        else:
+            j_min, j_max = 0, k
+        do_test = True
+        def _check_(d, y0, y1):
+            return (d>=y0) and (d<y1)
+
+    if (d==0)|(not do_test):
+        pval = 0.0
+    else:
+        for i in range(n_iter):
+            n_pts = int(j_max - j_min)
+            if (i<2) and (n_pts < 50):
+                n_pts = 50
+            j_range = np.linspace(j_min, j_max, n_pts, endpoint=True)
+            y = binom_pmf(j_range, n, p)
+            for i in range(len(j_range) - 1):
+                if _check_(d, y[i], y[i + 1]):
+                    j_min, j_max = j_range[i], j_range[i + 1]
+                    break
+        j = max(min((j_min + j_max) / 2, n), 0)
+
+        if k * j == 0:
+            pval = binom_sf(max(k, j), n, p)
+        else:
+            pval = binom_cdf(min(k, j), n, p) + binom_sf(max(k, j), n, p)
+        pval = min(1.0, pval)
+
+    return pval
+
+
+def test_binom_test():
+    """The binomial test of arrays should be the same as the previous
+    implementation for each element"""
+    rng = np.random.default_rng(0)
+    n = (10 ** rng.uniform(0, 4, 1000)).astype(np.float32).astype(np.float64)
+    p = rng.uniform(0.01, 0.99, 1000)
+    k = n * np.clip(p + rng.normal(0, 0.1, 1000), 0, 1)
+    k[:10], k[10:20], p[20:30] = 0, n[10:20], 1e-3
+    result = binom_test(k, n, p)
+    expected = [_binom_test_reference(*args) for args in zip(k, n, p)]
+    np.testing.assert_array_equal(result, expected)
+    assert np.sum((result > 0) & (result < 1)) > 100
+    assert binom_test(k[0], n[0], p[0]) == expected[0]
+
+
+def test_pattern_neg2llh():
+    rng = np.random.default_rng(0)
+    n_events, n_channels, mean_pe_photon = 100, 50, 1.2
+    map_effs = rng.uniform(0, 1, (n_events, n_channels))
+    area_per_channel = rng.uniform(-0.1, 10, (n_events, n_channels)).astype(np.float32)
+    area_per_channel[rng.random(area_per_channel.shape) < 0.3] = 0
+    areas = rng.uniform(1, 500, (n_events, 2)).astype(np.float32)
+    live = rng.random((2, n_channels)) > 0.1
+    live[1, :25] = False
+
+    neg2llh = np.zeros(areas.shape)
+    pattern = np.zeros(map_effs.shape, dtype=np.float32)
+    neg2llh_per_channel = np.zeros(map_effs.shape, dtype=np.float32)
+    straxen.pattern_neg2llh(map_effs, area_per_channel, areas, live, mean_pe_photon,
+                            neg2llh, pattern, neg2llh_per_channel)
+    for pattern_i in range(2):
+        expected, expected_pattern = _pattern_neg2llh_reference(
+            map_effs, area_per_channel, areas[:, pattern_i], live[pattern_i], mean_pe_photon)
+        np.testing.assert_allclose(neg2llh[:, pattern_i], expected.sum(axis=1), rtol=1e-10)
+
+    # The pattern and -2LLH per channel of the first pattern
+    expected, expected_pattern = _pattern_neg2llh_reference(
+        map_effs, area_per_channel, areas[:, 0], live[0], mean_pe_photon)
+    np.testing.assert_array_equal(pattern[:, ~live[0]], 0)
+    np.testing.assert_array_equal(neg2llh_per_channel[:, ~live[0]], 0)
+    np.testing.assert_allclose(pattern[:, live[0]], expected_pattern.astype(np.float32),
+                               rtol=1e-6)
+    np.testing.assert_allclose(neg2llh_per_channel[:, live[0]], expected.astype(np.float32),
+                               rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('store_per_channel', [False, True])
+def test_event_pattern_fit(store_per_channel):
+    plugin = _event_pattern_fit(straxen.EventPatternFit, store_per_channel)
+    events = _fake_events(seed=1)
+    result = plugin.compute(events)
+    config = plugin.config
+
+    # Main S1, for the total array
+    sel = (events['s1_area'] > config['s1_min_area_pattern_fit']) & (events['s1_index'] != -1)
+    sel &= (events['s1_area_fraction_top'] >= 0) & np.isfinite(events['x'])
+    sel &= events['x'] ** 2 + events['y'] ** 2 < config['max_r_pattern_fit'] ** 2
+    assert 0 < np.sum(sel) < len(events)
+    np.testing.assert_array_equal(np.isnan(result['s1_2llh']), ~sel)
+    xyz = np.stack([events['x'], events['y'], events['z']], axis=1)[sel]
+    expected, expected_pattern = _pattern_neg2llh_reference(
+        plugin.s1_pattern_map(xyz), events['s1_area_per_channel'][sel],
+        events['s1_area'][sel], plugin.pmtbool, plugin.mean_pe_photon)
+    np.testing.assert_allclose(result['s1_2llh'][sel], expected.sum(axis=1), rtol=1e-6)
+    assert np.all(np.isfinite(result['s1_top_2llh'][sel]))
+    assert np.all(np.isfinite(result['s1_bottom_2llh'][sel]))
+    if store_per_channel:
+        np.testing.assert_allclose(result['s1_pattern'][sel][:, plugin.pmtbool],
+                                   expected_pattern, rtol=1e-6)
+
+    # Main S2, for the top array
+    sel = (events['s2_area'] > config['s2_min_area_pattern_fit']) & (events['s2_index'] != -1)
+    sel &= events['s2_area_fraction_top'] > 0
+    sel &= events['s2_x'] ** 2 + events['s2_y'] ** 2 < config['max_r_pattern_fit'] ** 2
+    np.testing.assert_array_equal(np.isnan(result['s2_2llh']), ~sel)
+    xy = np.stack([events['s2_x'], events['s2_y']], axis=1)[sel]
+    expected, _ = _pattern_neg2llh_reference(
+        plugin.s2_pattern_map(xy)[:, :N_TOP_PMTS],
+        events['s2_area_per_channel'][sel, :N_TOP_PMTS],
+        (events['s2_area_fraction_top'] * events['s2_area'])[sel],
+        plugin.pmtbool_top, plugin.mean_pe_photon)
+    np.testing.assert_allclose(result['s2_2llh'][sel], expected.sum(axis=1), rtol=1e-6)
+
+    # S1 area fraction top probabilities
+    aft_prob = plugin.s1_aft_map(np.stack([events['x'], events['y'], events['z']], axis=1))
+    for s1 in ('s1', 'alt_s1'):
+        area, aft = events[f'{s1}_area'], events[f'{s1}_area_fraction_top']
+        for mode in ('continuous', 'discrete'):
+            expected = np.full(len(events), np.nan)
+            for i in np.where(~np.isnan(aft_prob) & ~np.isnan(area) & ~np.isnan(aft))[0]:
+                area_top = float(area[i]) * float(aft[i])
+                if (0 <= area_top <= area[i]) and (0 <= aft_prob[i] <= 1):
+                    args = (area_top, float(area[i]), aft_prob[i])
+                    expected[i] = (binom_pmf(*args) if mode == 'discrete'
+                                   else _binom_test_reference(*args))
+            np.testing.assert_array_equal(
+                result[f'{s1}_area_fraction_top_{mode}_probability'],
+                expected.astype(np.float32))
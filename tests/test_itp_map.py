@@ -0,0 +1,248 @@
+import gzip
+import json
+import os
+import numpy as np
+import pytest
+import straxen
+
+
+def _grid_map(grid_spec, array_size=None, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = tuple(n for _, (_, _, n) in grid_spec)
+    if array_size is not None:
+        shape += (array_size,)
+    return {'coordinate_system': grid_spec,
+            'map': rng.normal(size=shape).tolist(),
+            'name': 'test map'}
+
+
+def _positions(grid_spec, n=1000, seed=1):
+    """Positions in and beyond the edges of the grid"""
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.uniform(left - (right - left) / 4, right + (right - left) / 4, n)
+                     for _, (left, right, _) in grid_spec], axis=1)
+
+
+GRID_SPECS = [
+    [['x', [-1, 1, 11]]],
+    [['x', [-70, 70, 41]], ['y', [-70, 70, 31]]],
+    [['x', [-70, 70, 11]], ['y', [-70, 70, 13]], ['z', [-150, 0, 7]]],
+    [['x', [-70, 70, 11]], ['y', [0, 0, 1]]],
+]
+
+
+@pytest.mark.parametrize('grid_spec', GRID_SPECS)
+@pytest.mark.parametrize('array_size', [None, 3])
+def test_multilinear_grid(grid_spec, array_size):
+    """MultilinearGrid should interpolate like RegularGridInterpolator,
+    and beyond the grid take the value at the edge, or extrapolate like
+    RegularGridInterpolator"""
+    data = _grid_map(grid_spec, array_size)
+    positions = _positions(grid_spec)
+    itp_map = straxen.InterpolatingMap(data, method='MultilinearGrid')
+    result = itp_map(positions)
+    if all(n > 1 for _, (_, _, n) in grid_spec):
+        rgi = straxen.InterpolatingMap(data, method='RegularGridInterpolator')
+        clamped = np.stack([np.clip(positions[:, dim], left, right)
+                            for dim, (_, (left, right, _)) in enumerate(grid_spec)], axis=1)
+        np.testing.assert_allclose(result, rgi(clamped), rtol=1e-9, atol=1e-12)
+        linear = straxen.InterpolatingMap(data, method='MultilinearGrid',
+                                          extrapolation='linear')
+        np.testing.assert_allclose(linear(positions), rgi(positions),
+                                   rtol=1e-9, atol=1e-12)
+
+    # Nodes of the grid have the values of the map, as for the default method
+    nodes = itp_map.coordinate_system
+    map_values = np.reshape(data['map'], (len(nodes), -1) if array_size else -1)
+    np.testing.assert_allclose(itp_map(nodes), map_values, rtol=1e-12, atol=1e-12)
+
+    # The same map given as a (shuffled) list of points
+    order = np.random.default_rng(2).permutation(len(nodes))
+    point_data = dict(data,
+                      coordinate_system=nodes[order].tolist(),
+                      map=map_values[order].tolist())
+    if array_size is None or len(grid_spec) == 1:
+        default_map = straxen.InterpolatingMap(point_data)
+        np.testing.assert_allclose(itp_map(nodes), default_map(nodes), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(
+        straxen.InterpolatingMap(point_data, method='MultilinearGrid')(positions),
+        result, rtol=1e-12, atol=1e-12)
+
+    # Write into a buffer
+    out = np.zeros_like(result)
+    assert itp_map(positions, out=out) is out
+    np.testing.assert_array_equal(out, result)
+    with pytest.raises(ValueError):
+        itp_map(positions, out=np.zeros(len(positions) + 1))
+
+
+def test_multilinear_grid_linear_map():
+    """A linear map is reproduced exactly, also beyond the grid when
+    extrapolating linearly"""
+    grid_spec = [['x', [-1, 1, 5]], ['y', [0, 10, 11]]]
+    nodes = straxen.InterpolatingMap(_grid_map(grid_spec)).coordinate_system
+    data = _grid_map(grid_spec)
+    data['map'] = (2 * nodes[:, 0] - 0.5 * nodes[:, 1] + 1).reshape(5, 11).tolist()
+    positions = _positions(grid_spec)
+    np.testing.assert_allclose(
+        straxen.InterpolatingMap(data, method='MultilinearGrid',
+                                 extrapolation='linear')(positions),
+        2 * positions[:, 0] - 0.5 * positions[:, 1] + 1,
+        rtol=1e-12, atol=1e-12)
+    with pytest.raises(ValueError):
+        straxen.InterpolatingMap(data, method='MultilinearGrid', extrapolation='nearest')
+
+
+def test_multilinear_grid_outside():
+    """Beyond the grid, the map is about as constant as with the
+    default inverse-distance weighting (InterpolateAndExtrapolate)"""
+    grid_spec = [['x', [-70, 70, 71]], ['y', [-70, 70, 71]]]
+    nodes = straxen.InterpolatingMap(_grid_map(grid_spec)).coordinate_system
+    data = _grid_map(grid_spec)
+    slope = 0.01
+    data['map'] = (1 + slope * (nodes[:, 0] + 2 * nodes[:, 1])).tolist()
+    rng = np.random.default_rng(3)
+    angle = rng.uniform(0, 2 * np.pi, 1000)
+    radius = rng.uniform(110, 300, 1000)
+    positions = np.stack([radius * np.cos(angle), radius * np.sin(angle)], axis=1)
+
+    result = straxen.InterpolatingMap(data, method='MultilinearGrid')(positions)
+    expected = straxen.InterpolatingMap(data)(positions)
+    # Up to the gradient over about a grid spacing (2 cm)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=3 * slope * 2 * 2)
+    # Far beyond the grid, both stay within the range of the map
+    assert np.all(np.abs(result - 1) <= slope * 3 * 70 + 1e-12)
+
+
+def test_multilinear_grid_invalid():
+    grid_spec = [['x', [-1, 1, 5]], ['y', [0, 10, 11]]]
+    itp_map = straxen.InterpolatingMap(_grid_map(grid_spec), method='MultilinearGrid')
+    result = itp_map(np.array([[np.nan, 1], [0, np.inf], [0, 1]]))
+    assert np.all(np.isnan(result[:2]))
+    assert np.isfinite(result[2])
+
+    # Points that are not on a grid
+    data = {'coordinate_system': [[0, 0], [1, 0], [0, 1], [1, 2]],
+            'map': [1, 2, 3, 4]}
+    with pytest.raises(ValueError):
+        straxen.InterpolatingMap(data, method='MultilinearGrid')
+
+
+@pytest.mark.parametrize('method', ['WeightedNearestNeighbors', 'MultilinearGrid'])
+def test_map_cache(method, tmp_path):
+    """Maps opened from the on-disk cache should be the same as decoded
+    maps, also after scaling the coordinates of a cached map"""
+    data = _grid_map([['x', [-70, 70, 21]], ['y', [-70, 70, 11]]], array_size=3)
+    data['other_map'] = np.arange(21 * 11).tolist()
+    data = gzip.compress(json.dumps(data).encode())
+    positions = _positions([['x', [-70, 70, 21]], ['y', [-70, 70, 11]]])
+
+    expected = straxen.InterpolatingMap(data, method=method)
+    for _ in range(3):
+        itp_map = straxen.InterpolatingMap(data, method=method, cache_dir=str(tmp_path))
+        assert itp_map.map_names == expected.map_names
+        assert itp_map.data['name'] == expected.data['name']
+        for map_name in itp_map.map_names:
+            np.testing.assert_array_equal(itp_map(positions, map_name=map_name),
+                                          expected(positions, map_name=map_name))
+        itp_map.scale_coordinates([1, -2])
+    assert len(os.listdir(tmp_path)) == 1
+    # Only arrays and json are stored, nothing that is unpickled
+    assert all(f.endswith(('.npy', '.json'))
+               for f in os.listdir(tmp_path / os.listdir(tmp_path)[0]))
+
+    expected.scale_coordinates([1, -2])
+    np.testing.assert_array_equal(itp_map(positions), expected(positions))
+
+
+def test_map_cache_env(tmp_path, monkeypatch):
+    monkeypatch.setenv('STRAXEN_MAP_CACHE_DIR', str(tmp_path))
+    points = json.dumps({'coordinate_system': [[0], [1], [2]],
+                         'map': [1, 2, 3]})
+    placeholder = json.dumps({'coordinate_system': [], 'map': 42})
+    for _ in range(2):
+        np.testing.assert_allclose(
+            straxen.InterpolatingMap(points)([[0], [2]]), [1, 3], rtol=1e-5)
+        assert straxen.InterpolatingMap(placeholder)([[0, 0]]) == 42
+    assert len(os.listdir(tmp_path)) == 2
+    # Only (gzipped) json is cached
+    straxen.InterpolatingMap(json.loads(points))
+    assert len(os.listdir(tmp_path)) == 2
+
+
+class _InterpolateAndExtrapolateReference(straxen.InterpolateAndExtrapolate):
+    """Previous (numpy) implementation of InterpolateAndExtrapolate"""
+
+    def __call__(self, points):
+        distances, indices = self.kdtree.query(points, self.neighbours_to_use)
+
+        result = np.ones(len(points)) * float('nan')
+        if self.array_valued:
+            result = np.repeat(result.reshape(-1, 1), self.n_dim, axis=1)
+
+        valid = (distances < float('inf')).max(axis=-1)
+
+        values = self.values[indices[valid]]
+        weights = 1 / np.clip(distances[valid], 1e-6, float('inf'))
+        if self.array_valued:
+            weights = np.repeat(weights, self.n_dim).reshape(values.shape)
+
+        result[valid] = np.average(values, weights=weights,
+                                   axis=-2 if self.array_valued else -1)
+        return result
+
+
+@pytest.mark.parametrize('n_dims', [1, 2, 3])
+@pytest.mark.parametrize('array_size', [None, 5])
+def test_interpolate_and_extrapolate(n_dims, array_size):
+    """The compiled weighted average should be the same as the previous
+    numpy implementation"""
+    rng = np.random.default_rng(n_dims)
+    points = rng.uniform(-70, 70, (500, n_dims))
+    values = rng.normal(size=500 if array_size is None else (500, array_size))
+    positions = rng.uniform(-80, 80, (1000, n_dims))
+    positions[:10] = points[:10]
+
+    kwargs = dict(array_valued=array_size is not None)
+    expected = _InterpolateAndExtrapolateReference(points, values, **kwargs)(positions)
+    for workers in (1, 2):
+        itp = straxen.InterpolateAndExtrapolate(points, values, workers=workers, **kwargs)
+        np.testing.assert_array_equal(itp(positions), expected)
+    # A single position
+    np.testing.assert_array_equal(itp(positions[0]), expected[:1])
+
+    positions[-10:, 0] = np.nan
+    result = itp(positions)
+    assert np.all(np.isnan(result[-10:]))
+    np.testing.assert_array_equal(result[:-10], expected[:-10])
+
+    out = np.zeros(expected.shape, dtype=np.float32)
+    assert itp(positions, out=out) is out
+    np.testing.assert_array_equal(out, result.astype(np.float32))
+    with pytest.raises(ValueError):
+        itp(positions, out=np.zeros(len(positions) + 1))
+
+
+def test_scale_coordinates():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-70, 70, (200, 3))
+    values = rng.normal(size=200)
+    itp_map = straxen.InterpolatingMap(
+        dict(coordinate_system=points.tolist(), map=values.tolist()))
+    itp_map.scale_coordinates([1., 2., -0.5])
+    expected = straxen.InterpolatingMap(
+        dict(coordinate_system=(points * [1., 2., -0.5]).tolist(), map=values.tolist()))
+    positions = rng.uniform(-80, 80, (1000, 3))
+    np.testing.assert_array_equal(itp_map(positions), expected(positions))
+
+
+def test_interpolate_and_extrapolate_grid_values():
+    """Values given on a nested grid are matched to the points in order"""
+    grid_spec = [['x', [-70, 70, 11]], ['y', [-70, 70, 13]]]
+    data = _grid_map(grid_spec)
+    positions = _positions(grid_spec)
+    flat = dict(data, map=np.ravel(data['map']).tolist())
+    np.testing.assert_array_equal(straxen.InterpolatingMap(data)(positions),
+                                  straxen.InterpolatingMap(flat)(positions))
+    with pytest.raises(ValueError):
+        straxen.InterpolateAndExtrapolate(np.zeros((10, 2)), np.zeros(9))
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import tempfile
+import time
+import gridfs
+import mongomock
+import mongomock.gridfs
+import pytest
+import straxen
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+def _downloader(collection, store_files_at, index_ttl=600):
+    """MongoDownloader on a mongomock collection (bypassing the check
+    for a pymongo collection)"""
+    downloader = straxen.MongoDownloader.__new__(straxen.MongoDownloader)
+    downloader.collection = collection
+    downloader.config_identifier = 'config_name'
+    downloader.grid_fs = gridfs.GridFS(collection.database)
+    downloader.index_ttl = index_ttl
+    downloader.storage_options = (store_files_at,)
+    return downloader
+
+
+def _upload(collection, config, content):
+    md5 = hashlib.md5(content).hexdigest()
+    gridfs.GridFS(collection.database).put(content, config_name=config, md5=md5)
+    return md5
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = mongomock.MongoClient().files['fs.files']
+    collection.n_finds = 0
+    find = collection.find
+
+    def counting_find(*args, **kwargs):
+        collection.n_finds += 1
+        return find(*args, **kwargs)
+
+    monkeypatch.setattr(collection, 'find', counting_find)
+    yield collection
+    straxen.mongo_storage._file_indexes.clear()
+
+
+def test_file_index(collection):
+    md5s = {f'file_{i}': _upload(collection, f'file_{i}', f'content {i}'.encode())
+            for i in range(10)}
+    # A new version of file_0
+    md5s['file_0'] = _upload(collection, 'file_0', b'new content')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        downloader = _downloader(collection, temp_dir)
+        paths = [downloader.download_single(config) for config in md5s]
+        assert [os.path.basename(path) for path in paths] == list(md5s.values())
+        with open(paths[0], 'rb') as f:
+            assert f.read() == b'new content'
+
+        # Files in the local cache only cost one listing of the files
+        downloader.clear_file_index()
+        collection.n_finds = 0
+        assert [downloader.download_single(config) for config in md5s] == paths
+        assert collection.n_finds == 1
+
+        # The index is shared with other downloaders on this collection
+        other = _downloader(collection, temp_dir)
+        assert sorted(other.list_files()) == sorted(md5s)
+        assert [other.download_single(config) for config in md5s] == paths
+        assert collection.n_finds == 1
+
+        # Files uploaded after the listing are found by refreshing
+        _upload(collection, 'file_new', b'even newer content')
+        assert os.path.exists(downloader.download_single('file_new'))
+        with pytest.raises(ValueError):
+            downloader.download_single('file_missing')
+
+        # The index is listed again once it has expired
+        downloader = _downloader(collection, temp_dir, index_ttl=-1)
+        n_finds = collection.n_finds
+        downloader.list_files()
+        assert collection.n_finds == n_finds + 1
+
+
+def test_upload_after_listing(collection):
+    """A config that is uploaded again after the index was listed is
+    stored under the md5 of the downloaded file"""
+    _upload(collection, 'file', b'content')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        downloader = _downloader(collection, temp_dir)
+        downloader.list_files()
+        # Not through the downloader, so the index is not cleared. The
+        # last version is the one with the latest uploadDate (in ms).
+        time.sleep(0.01)
+        md5 = _upload(collection, 'file', b'new content')
+
+        path = downloader.download_single('file')
+        assert os.path.basename(path) == md5
+        with open(path, 'rb') as f:
+            assert f.read() == b'new content'
+        assert downloader.file_index()['file']['md5'] == md5
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+import straxen
+
+
+def _mlp_layers(rng, sizes=(253, 32, 16, 2), activation='relu'):
+    layers = [('InputLayer', dict(batch_input_shape=[None, sizes[0]]), [])]
+    for i, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+        layers.append(('Dense',
+                       dict(activation=activation if i < len(sizes) - 2 else 'linear'),
+                       [rng.normal(0, 0.3, (n_in, n_out)), rng.normal(0, 0.1, n_out)]))
+        layers.append(('Dropout', dict(rate=0.2), []))
+    return layers
+
+
+def _conv2d_reference(x, kernel, bias, strides, padding):
+    """Direct (slow) channels_last convolution"""
+    kh, kw, _, n_out = kernel.shape
+    if padding == 'same':
+        pads = []
+        for size, k, s in zip(x.shape[1:3], (kh, kw), strides):
+            pad = max((-(-size // s) - 1) * s + k - size, 0)
+            pads.append((pad // 2, pad - pad // 2))
+        x = np.pad(x, [(0, 0)] + pads + [(0, 0)])
+    out_h = (x.shape[1] - kh) // strides[0] + 1
+    out_w = (x.shape[2] - kw) // strides[1] + 1
+    result = np.zeros((len(x), out_h, out_w, n_out))
+    for i in range(out_h):
+        for j in range(out_w):
+            patch = x[:, i * strides[0]:i * strides[0] + kh, j * strides[1]:j * strides[1] + kw]
+            result[:, i, j] = np.tensordot(patch, kernel, axes=3) + bias
+    return result
+
+
+def test_dense():
+    rng = np.random.default_rng(0)
+    layers = _mlp_layers(rng, activation='elu')
+    x = rng.random((1000, 253))
+    expected = x
+    for class_name, config, weights in layers:
+        if class_name == 'Dense':
+            expected = expected @ weights[0] + weights[1]
+            if config['activation'] == 'elu':
+                expected = np.where(expected > 0, expected, np.expm1(expected))
+    model = straxen.NumpyModel(layers)
+    result = model.predict(x, batch_size=300)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('padding', ['valid', 'same'])
+@pytest.mark.parametrize('strides', [(1, 1), (2, 1)])
+def test_conv2d(padding, strides):
+    rng = np.random.default_rng(1)
+    kernel, bias = rng.normal(size=(3, 2, 4, 5)), rng.normal(size=5)
+    gamma, beta, mean, variance = rng.random((4, 5)) + 0.5
+    layers = [('Reshape', dict(target_shape=[9, 7, 4]), []),
+              ('Conv2D', dict(kernel_size=[3, 2], strides=list(strides), padding=padding,
+                              activation='linear'), [kernel, bias]),
+              ('BatchNormalization', dict(axis=3, epsilon=1e-3), [gamma, beta, mean, variance]),
+              ('MaxPooling2D', dict(pool_size=[2, 2], strides=[2, 2], padding='valid'), []),
+              ('Flatten', dict(), [])]
+    x = rng.random((50, 9 * 7 * 4))
+
+    expected = _conv2d_reference(x.reshape(-1, 9, 7, 4), kernel, bias, strides, padding)
+    expected = (expected - mean) / np.sqrt(variance + 1e-3) * gamma + beta
+    h, w = expected.shape[1] // 2, expected.shape[2] // 2
+    expected = expected[:, :2 * h, :2 * w].reshape(-1, h, 2, w, 2, 5).max(axis=(2, 4))
+    result = straxen.NumpyModel(layers)(x)
+    np.testing.assert_allclose(result, expected.reshape(len(x), -1), rtol=1e-4, atol=1e-5)
+
+
+def test_save_load():
+    rng = np.random.default_rng(2)
+    model = straxen.NumpyModel(_mlp_layers(rng))
+    x = rng.random((10, 253))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'model.npz')
+        model.save(file_name)
+        assert os.listdir(temp_dir) == ['model.npz']
+        assert os.stat(file_name).st_mode & 0o777 == straxen.common._apply_umask(0o666)
+        np.testing.assert_array_equal(straxen.NumpyModel.load(file_name)(x), model(x))
+
+
+def test_unsupported():
+    with pytest.raises(NotImplementedError):
+        straxen.NumpyModel([('LSTM', dict(), [])])
+    with pytest.raises(NotImplementedError):
+        straxen.NumpyModel([('Dense', dict(activation='gelu'), [np.ones((2, 2))])])
+
+
+def _keras_model(tf):
+    """The model of numpy_model_reference.npz, which is written by
+    _write_keras_reference with tensorflow 2.21"""
+    layers = tf.keras.layers
+    return tf.keras.Sequential([
+        layers.InputLayer(input_shape=(8 * 6,)),
+        layers.Reshape((8, 6, 1)),
+        layers.Conv2D(4, (3, 3), padding='same', activation='relu'),
+        layers.MaxPooling2D((2, 2)),
+        layers.BatchNormalization(),
+        layers.Reshape((12, 4)),
+        layers.Conv1D(3, 3, strides=2, padding='same', activation='selu'),
+        layers.LeakyReLU(0.1),
+        layers.AveragePooling1D(2),
+        layers.Flatten(),
+        layers.Dense(16, activation='tanh'),
+        layers.Dropout(0.2),
+        layers.Dense(2)])
+
+
+def _write_keras_reference(tf, file_name):
+    """Store the keras model, with random (non-trivial) weights, its
+    inputs and its outputs in the format of NumpyModel.save"""
+    tf.keras.utils.set_random_seed(4)
+    keras_model = _keras_model(tf)
+    rng = np.random.default_rng(5)
+    for layer in keras_model.layers:
+        weights = layer.get_weights()
+        if layer.__class__.__name__ == 'BatchNormalization':
+            weights = [rng.random(4) + 0.5, rng.normal(0, 0.3, 4),
+                       rng.normal(0, 0.3, 4), rng.random(4) + 0.5]
+        elif weights:
+            weights[1] = rng.normal(0, 0.2, weights[1].shape)
+        layer.set_weights(weights)
+    x = rng.random((100, 8 * 6)).astype(np.float32)
+    straxen.NumpyModel.from_keras(keras_model).save(file_name)
+    with np.load(file_name) as f:
+        arrays = dict(f)
+    np.savez_compressed(file_name, x=x, expected=keras_model.predict(x), **arrays)
+
+
+def test_keras_reference():
+    """The numpy model should give the output that tensorflow gave"""
+    file_name = os.path.join(os.path.dirname(__file__), 'numpy_model_reference.npz')
+    with np.load(file_name) as f:
+        x, expected = f['x'], f['expected']
+    np.testing.assert_allclose(straxen.NumpyModel.load(file_name)(x),
+                               expected, rtol=1e-4, atol=1e-5)
+
+
+def test_keras_model():
+    """The numpy model should give the same output as tensorflow"""
+    tf = pytest.importorskip('tensorflow')
+    keras_model = _keras_model(tf)
+    x = np.random.default_rng(3).random((100, 8 * 6)).astype(np.float32)
+    np.testing.assert_allclose(straxen.NumpyModel.from_keras(keras_model)(x),
+                               keras_model.predict(x), rtol=1e-4, atol=1e-5)
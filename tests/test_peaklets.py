@@ -0,0 +1,152 @@
+import os
+import tempfile
+import hypothesis
+import hypothesis.strategies
+import numba
+import numpy as np
+import strax
+import straxen
+from straxen.plugins.peaklet_processing import _filter_s1_starts, merge_s2_threshold
+
+
+def test_peaklet_threads():
+    """Finding peaklets in segments of a chunk should give the same
+    result as processing the chunk at once"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        daq_config = straxen.write_synthetic_daq_data(
+            os.path.join(temp_dir, 'live_data'),
+            duration=int(1e8),
+            chunk_duration=int(4e7),
+            overlap_duration=int(1e7),
+            s2_rate=200,
+            saturation_fraction=0.2,
+            pretrigger=50)
+        daq_config.pop('raw_bytes')
+        config = dict(straxen.contexts.xnt_common_config,
+                      gain_model=('to_pe_placeholder', True),
+                      hit_min_amplitude=15,
+                      **daq_config)
+        st = strax.Context(
+            storage=[strax.DataDirectory(os.path.join(temp_dir, 'strax_data'))],
+            register=[straxen.DAQReader,
+                      straxen.PulseProcessing,
+                      straxen.Hits,
+                      straxen.Peaklets],
+            config=config,
+            free_options=tuple(config.keys()),
+            allow_multiprocess=False)
+        run_id = '000000'
+        records = st.get_array(run_id, 'records')
+        hits = st.get_array(run_id, 'hits')
+
+    plugin = st.get_single_plugin(run_id, 'peaklets')
+    min_gap = (plugin.config['peaklet_gap_threshold']
+               + plugin.config['peak_left_extension']
+               + plugin.config['peak_right_extension'])
+    breaks = straxen.plugins.peaklet_processing.segment_breaks(
+        records, min_gap, n_segments=16)
+    assert len(breaks) > 1
+    for b in breaks:
+        assert strax.endtime(records[:b]).max() + min_gap < records[b]['time']
+
+    start, end = 0, int(1e9)
+    for plugin_class in (straxen.Peaklets, straxen.PeakletsFromHits):
+        st.register(plugin_class)
+        inputs = dict(records=records)
+        if plugin_class is straxen.PeakletsFromHits:
+            inputs['hits'] = hits
+        results = []
+        for n_threads in (1, 4):
+            st.set_config(dict(peaklet_threads=n_threads))
+            plugin = st.get_single_plugin(run_id, 'peaklets')
+            # The saturation correction may change the records
+            results.append(plugin.compute(
+                **{k: v.copy() for k, v in inputs.items()},
+                start=start, end=end))
+        assert len(results[0]['peaklets'])
+        for d in ('peaklets', 'lone_hits'):
+            assert results[0][d].tobytes() == results[1][d].tobytes()
+
+
+@numba.njit(cache=True, nogil=True)
+def _get_merge_instructions_reference(
+        peaklet_starts, peaklet_ends, areas, types,
+        gap_thresholds, max_duration, max_gap, max_area):
+    """Previous O(n * k) implementation of get_merge_instructions"""
+    peaklet_gaps = peaklet_starts[1:] - peaklet_ends[:-1]
+    peaklet_start_index = np.arange(len(peaklet_starts))
+    peaklet_end_index = np.arange(len(peaklet_starts))
+
+    for gap_i in np.argsort(peaklet_gaps):
+        start_idx = peaklet_start_index[gap_i]
+        inclusive_end_idx = peaklet_end_index[gap_i + 1]
+        sum_area = np.sum(areas[start_idx:inclusive_end_idx + 1])
+        this_gap = peaklet_gaps[gap_i]
+
+        if this_gap > max_gap:
+            break
+        if sum_area > max_area:
+            continue
+        if (sum_area > 0) and (
+                this_gap > merge_s2_threshold(np.log10(sum_area),
+                                              gap_thresholds)):
+            continue
+
+        peak_duration = (peaklet_ends[inclusive_end_idx] - peaklet_starts[start_idx])
+        if peak_duration >= max_duration:
+            continue
+
+        peaklet_start_index[start_idx:inclusive_end_idx + 1] = peaklet_start_index[start_idx]
+        peaklet_end_index[start_idx:inclusive_end_idx + 1] = peaklet_end_index[inclusive_end_idx]
+
+    start_merge_at = np.unique(peaklet_start_index)
+    end_merge_at = np.unique(peaklet_end_index)
+    return _filter_s1_starts(start_merge_at, types, end_merge_at)
+
+
+def _fake_peaklets(seed, n, gap_scale, area_scale):
+    rng = np.random.default_rng(seed)
+    duration = rng.integers(10, 5_000, n)
+    starts = np.cumsum(duration + rng.exponential(gap_scale, n).astype(np.int64))
+    ends = starts + duration
+    areas = (10 ** rng.uniform(-1, area_scale, n)).astype(np.float32)
+    areas[rng.random(n) < 0.05] *= -0.01
+    types = rng.integers(0, 3, n).astype(np.int8)
+    return starts, ends, areas, types
+
+
+@hypothesis.settings(deadline=None, max_examples=500)
+@hypothesis.given(hypothesis.strategies.integers(0, 2 ** 32 - 1),
+                  hypothesis.strategies.integers(2, 300),
+                  hypothesis.strategies.floats(10, 1e5),
+                  hypothesis.strategies.floats(0, 6),
+                  hypothesis.strategies.integers(1_000, 100_000))
+def test_get_merge_instructions(seed, n, gap_scale, area_scale, max_duration):
+    """The merge instructions should be identical to the previous
+    implementation"""
+    starts, ends, areas, types = _fake_peaklets(seed, n, gap_scale, area_scale)
+    gap_thresholds = straxen.MergedS2s.takes_config['s2_merge_gap_thresholds'].default
+    args = (starts, ends, areas, types, gap_thresholds, max_duration,
+            gap_thresholds[0][1], 10 ** gap_thresholds[-1][0])
+    result = straxen.MergedS2s.get_merge_instructions(*args)
+    expected = _get_merge_instructions_reference(*args)
+    for r, e in zip(result, expected):
+        np.testing.assert_array_equal(r, e)
+
+
+def test_get_merge_instructions_rounding():
+    """Merged areas close to the maximum area should be treated as in the
+    float32 sum of the peaklet areas"""
+    n = 1000
+    starts = np.arange(n) * 1000
+    ends = starts + 900
+    types = np.full(n, 2, dtype=np.int8)
+    gap_thresholds = ((1.7, 2.65e4), (4.0, 2.6e3), (5.0, 0.))
+    for area in (99.99, 100, 100.01):
+        areas = np.full(n, area, dtype=np.float32)
+        args = (starts, ends, areas, types, gap_thresholds, int(1e7),
+                gap_thresholds[0][1], 1e5)
+        result = straxen.MergedS2s.get_merge_instructions(*args)
+        expected = _get_merge_instructions_reference(*args)
+        for r, e in zip(result, expected):
+            np.testing.assert_array_equal(r, e)
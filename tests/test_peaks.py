@@ -1,11 +1,12 @@
 import strax
 import straxen
 
+import numba
 import numpy as np
 
 import unittest
 from strax.testutils import run_id
-from hypothesis import strategies, given, settings
+from hypothesis import strategies, given, settings, example
 
 TEST_DATA_LENGTH = 3
 R_TOL_DEFAULT = 1e-5
@@ -72,3 +73,103 @@ class TestComputePeakBasics(unittest.TestCase):
         test_data['dt'] = 1
         test_data['length'] = length
         return test_data
+
+
+def _peak_basics_reference(p, n_top):
+    """Column-wise numpy computation of the peak basics"""
+    r = np.zeros(len(p), straxen.PeakBasics.dtype)
+    for q in 'time length dt area type tight_coincidence'.split():
+        r[q] = p[q]
+    r['endtime'] = p['time'] + p['dt'] * p['length']
+    r['n_channels'] = (p['area_per_channel'] > 0).sum(axis=1)
+    r['range_50p_area'] = p['width'][:, 5]
+    r['range_90p_area'] = p['width'][:, 9]
+    r['max_pmt'] = np.argmax(p['area_per_channel'], axis=1)
+    r['max_pmt_area'] = np.max(p['area_per_channel'], axis=1)
+    area_top = p['area_per_channel'][:, :n_top].sum(axis=1)
+    area_total = p['area_per_channel'].sum(axis=1)
+    m = p['area'] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r['area_fraction_top'][m] = area_top[m] / area_total[m]
+    r['area_fraction_top'][~m] = float('nan')
+    r['rise_time'] = -p['area_decile_from_midpoint'][:, 1]
+    r['center_time'] = p['time']
+    r['center_time'][m] += straxen.PeakBasics.compute_center_times(p[m])
+    return r, area_total
+
+
+@settings(deadline=None, max_examples=20)
+@given(strategies.integers(0, 2 ** 32 - 1),
+       strategies.sampled_from([2, 7, 8, 127, 248, 494]),
+       strategies.integers(0, 500))
+def test_compute_peak_basics(seed, n_channels, n_top):
+    """The single pass kernel should give the numpy results"""
+    rng = np.random.default_rng(seed)
+    n = 200
+    peaks = np.zeros(n, dtype=strax.peak_dtype(n_channels=n_channels))
+    peaks['time'] = np.cumsum(rng.integers(1000, 10_000, n))
+    peaks['dt'] = rng.integers(1, 100, n)
+    peaks['length'] = rng.integers(1, 201, n)
+    area_per_channel = rng.exponential(1, (n, n_channels)) * (rng.random((n, n_channels)) < 0.3)
+    area_per_channel *= 10 ** rng.uniform(-1, 5, (n, 1))
+    area_per_channel[rng.random(n) < 0.1] *= -1
+    area_per_channel[rng.random((n, n_channels)) < 0.01] = np.nan
+    peaks['area_per_channel'] = area_per_channel
+    peaks['area'] = peaks['area_per_channel'].sum(axis=1)
+    peaks['area'][rng.random(n) < 0.1] = 1
+    peaks['data'] = rng.random((n, 200)) * peaks['area'][:, None] / 100
+    peaks['width'] = rng.random((n, 11))
+    peaks['area_decile_from_midpoint'] = rng.random((n, 11))
+    peaks['tight_coincidence'] = rng.integers(0, 50, n)
+    peaks['type'] = rng.integers(0, 3, n)
+
+    expected, expected_area_total = _peak_basics_reference(peaks, n_top)
+    result = np.zeros(n, dtype=straxen.PeakBasics.dtype)
+    area_total = straxen.compute_peak_basics(peaks, n_top, result)
+    # The sums are only rounded differently than those of numpy
+    np.testing.assert_allclose(area_total, expected_area_total, rtol=1e-5)
+    for field in result.dtype.names:
+        if field == 'area_fraction_top':
+            np.testing.assert_allclose(result[field], expected[field],
+                                       rtol=1e-5, atol=1e-6, err_msg=field)
+        else:
+            np.testing.assert_array_equal(result[field], expected[field], err_msg=field)
+
+
+@numba.njit(cache=True, nogil=True)
+def _find_n_competing_reference(peaks, windows, fraction):
+    """Previous O(n * w) implementation of find_n_competing"""
+    n_left = np.zeros(len(peaks), dtype=np.int32)
+    n_tot = n_left.copy()
+    areas = peaks['area']
+    for i, peak in enumerate(peaks):
+        left_i, right_i = windows[i]
+        threshold = areas[i] * fraction
+        n_left[i] = np.sum(areas[left_i:i] > threshold)
+        n_tot[i] = n_left[i] + np.sum(areas[i + 1:right_i] > threshold)
+    return n_left, n_tot
+
+
+@settings(deadline=None, max_examples=50)
+@given(strategies.integers(0, 2 ** 32 - 1),
+       strategies.integers(1, 2000),
+       strategies.floats(1e2, 1e7),
+       strategies.floats(0, 2))
+# Dense enough for the Fenwick tree
+@example(seed=0, n=2000, rate=1e6, fraction=0.5)
+def test_find_n_competing(seed, n, rate, fraction):
+    """Counting competing peaks with a Fenwick tree for dense windows
+    should give the same as counting them directly"""
+    rng = np.random.default_rng(seed)
+    peaks = np.zeros(n, dtype=straxen.PeakBasics.dtype)
+    peaks['time'] = np.cumsum(rng.exponential(1e9 / rate, n).astype(np.int64) + 100)
+    peaks['endtime'] = peaks['time'] + 50
+    # Include ties and NaNs
+    peaks['area'] = np.round(10 ** rng.uniform(-1, 3, n), rng.integers(0, 2))
+    peaks['area'][rng.random(n) < 0.05] = np.nan
+    windows = strax.touching_windows(peaks, peaks, window=int(1e7))
+
+    result = straxen.PeakProximity.find_n_competing(peaks, windows, fraction)
+    expected = _find_n_competing_reference(peaks, windows, fraction)
+    for r, e in zip(result, expected):
+        np.testing.assert_array_equal(r, e)
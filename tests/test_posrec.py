@@ -0,0 +1,200 @@
+import importlib.util
+import io
+import os
+import tarfile
+import tempfile
+import numpy as np
+import pytest
+import strax
+import straxen
+
+
+def _mlp_plugin(model_file, cache_dir):
+    plugin = straxen.PeakPositionsMLP()
+    plugin.config = dict(mlp_model=model_file,
+                         posrec_backend='numpy',
+                         posrec_model_cache_dir=cache_dir,
+                         min_reconstruction_area=10,
+                         n_top_pmts=straxen.n_top_pmts)
+    plugin.dtype = strax.to_numpy_dtype(plugin.infer_dtype())
+    return plugin
+
+
+def test_numpy_backend():
+    rng = np.random.default_rng(4)
+    model = straxen.NumpyModel([
+        ('Dense', dict(activation='relu'),
+         [rng.normal(size=(straxen.n_top_pmts, 16)), rng.normal(size=16)]),
+        ('Dense', dict(activation='linear'), [rng.normal(size=(16, 2)), np.zeros(2)])])
+    peaks = np.zeros(100, dtype=strax.peak_dtype(n_channels=straxen.n_tpc_pmts))
+    peaks['area_per_channel'] = rng.random(peaks['area_per_channel'].shape)
+    peaks['area'] = np.linspace(0, 100, len(peaks))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'mlp_model.npz')
+        model.save(file_name)
+        plugin = _mlp_plugin(file_name, temp_dir)
+        plugin.setup()
+        result = plugin.compute(peaks)
+
+    large = peaks['area'] > 10
+    assert np.all(np.isnan(result['x_mlp'][~large]))
+    area_per_channel = peaks['area_per_channel'][large, :straxen.n_top_pmts]
+    expected = model(area_per_channel / area_per_channel.max(axis=1, keepdims=True))
+    np.testing.assert_array_equal(result['x_mlp'][large], expected[:, 0])
+    np.testing.assert_array_equal(result['y_mlp'][large], expected[:, 1])
+
+
+def test_loaded_models():
+    """Plugins share the models loaded before, by the md5 of the file"""
+    rng = np.random.default_rng(0)
+    layers = [('Dense', dict(activation='linear'),
+               [rng.normal(size=(straxen.n_top_pmts, 2)), np.zeros(2)])]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        models = []
+        for name in ('a.npz', 'b.npz', 'a.npz'):
+            file_name = os.path.join(temp_dir, name)
+            if not os.path.exists(file_name):
+                straxen.NumpyModel(layers).save(file_name)
+            plugin = _mlp_plugin(file_name, temp_dir)
+            plugin.setup()
+            models.append(plugin.model)
+        # Same content, so the same md5
+        assert models[0] is models[1] is models[2]
+
+        # A different model
+        layers[0][2][1][:] = 1
+        straxen.NumpyModel(layers).save(os.path.join(temp_dir, 'a.npz'))
+        plugin = _mlp_plugin(os.path.join(temp_dir, 'a.npz'), temp_dir)
+        plugin.setup()
+        assert plugin.model is not models[0]
+    assert len(straxen.PeakPositionsBaseNT._loaded_models) <= \
+           straxen.PeakPositionsBaseNT._max_loaded_models
+
+
+def test_extract_model():
+    """Models are extracted once to the cache"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_file = os.path.join(temp_dir, 'model.tar.gz')
+        with tarfile.open(model_file, mode='w:gz') as tar:
+            content = b'model'
+            info = tarfile.TarInfo('saved_model.pb')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        cache_dir = os.path.join(temp_dir, 'cache')
+        md5 = straxen.PeakPositionsBaseNT._md5(model_file)
+
+        model_dir = straxen.PeakPositionsBaseNT._extract_model(model_file, md5, cache_dir)
+        assert model_dir == os.path.join(cache_dir, md5)
+        # Usable by other users, as far as the umask allows
+        assert os.stat(model_dir).st_mode & 0o777 == straxen.common._apply_umask(0o777)
+        with open(os.path.join(model_dir, 'saved_model.pb'), mode='rb') as f:
+            assert f.read() == b'model'
+
+        # Not extracted again
+        os.remove(os.path.join(model_dir, 'saved_model.pb'))
+        assert straxen.PeakPositionsBaseNT._extract_model(
+            model_file, md5, cache_dir) == model_dir
+        assert os.listdir(cache_dir) == [md5]
+        assert os.listdir(model_dir) == []
+
+
+def test_unreadable_model_cache(monkeypatch):
+    """Models in the cache that we cannot read (e.g. of another user)
+    are not used"""
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.mkdir(os.path.join(temp_dir, 'md5'))
+        monkeypatch.setattr(os, 'access', lambda path, mode: False)
+        with pytest.raises(PermissionError):
+            straxen.PeakPositionsBaseNT._extract_model('model.tar.gz', 'md5', temp_dir)
+
+        # The converted model cannot be loaded, so it is converted again
+        model = straxen.NumpyModel([('Dense', dict(), [rng.normal(size=(2, 2))])])
+        model.save(os.path.join(temp_dir, 'md5.npz'))
+
+        def load(file_name):
+            raise PermissionError(file_name)
+
+        monkeypatch.setattr(straxen.NumpyModel, 'load', load)
+        monkeypatch.setattr(straxen.PeakPositionsBaseNT, '_load_tensorflow_model',
+                            classmethod(lambda *args: model))
+        monkeypatch.setattr(straxen.NumpyModel, 'from_keras', lambda keras_model: keras_model)
+        with pytest.warns(UserWarning, match='Cannot load the converted model'):
+            assert straxen.PeakPositionsBaseNT._load_numpy_model(
+                'model.tar.gz', 'md5', temp_dir) is model
+
+
+def test_numpy_backend_gcn():
+    """The GCN model is rejected before it is loaded"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_file = os.path.join(temp_dir, 'gcn_model.tar.gz')
+        open(model_file, mode='wb').close()
+        plugin = straxen.PeakPositionsGCN()
+        plugin.config = dict(gcn_model=model_file, posrec_backend='numpy')
+        with pytest.raises(ValueError, match='gcn'):
+            plugin.setup()
+
+
+@pytest.mark.skipif(importlib.util.find_spec('tensorflow') is not None,
+                    reason='tensorflow is installed')
+def test_numpy_backend_without_tensorflow():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_file = os.path.join(temp_dir, 'mlp_model.tar.gz')
+        with tarfile.open(model_file, mode='w:gz'):
+            pass
+        with pytest.raises(RuntimeError, match='needs tensorflow'):
+            _mlp_plugin(model_file, temp_dir).setup()
+
+
+def test_combined_posrec():
+    """The combined plugin should give the same positions as the
+    separate plugins"""
+    rng = np.random.default_rng(5)
+    peaks = np.zeros(200, dtype=strax.peak_dtype(n_channels=straxen.n_tpc_pmts))
+    peaks['area_per_channel'] = rng.random(peaks['area_per_channel'].shape)
+    peaks['area'] = np.linspace(0, 100, len(peaks))
+    peaks['time'] = np.arange(len(peaks)) * 100
+    peaks['length'], peaks['dt'] = 10, 1
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = dict(posrec_backend='numpy',
+                      posrec_model_cache_dir=temp_dir,
+                      min_reconstruction_area=10,
+                      n_top_pmts=straxen.n_top_pmts,
+                      gcn_model=None)
+        for algorithm in ('mlp', 'cnn'):
+            model_file = os.path.join(temp_dir, f'{algorithm}_model.npz')
+            straxen.NumpyModel([
+                ('Dense', dict(activation='tanh'),
+                 [rng.normal(size=(straxen.n_top_pmts, 2)), rng.normal(size=2)])
+            ]).save(model_file)
+            config[f'{algorithm}_model'] = model_file
+
+        plugin = straxen.PeakPositionsCombinedNT()
+        plugin.config = config
+        plugin.dtype = {data_type: strax.to_numpy_dtype(dtype)
+                        for data_type, dtype in plugin.infer_dtype().items()}
+        plugin.setup()
+        result = plugin.compute(peaks)
+        assert set(result) == set(plugin.provides)
+
+        for plugin_class in (straxen.PeakPositionsMLP,
+                             straxen.PeakPositionsCNN,
+                             straxen.PeakPositionsGCN):
+            separate_plugin = plugin_class()
+            separate_plugin.config = config
+            separate_plugin.dtype = strax.to_numpy_dtype(separate_plugin.infer_dtype())
+            separate_plugin.setup()
+            expected = separate_plugin.compute(peaks)
+            data_type = f'peak_positions_{separate_plugin.algorithm}'
+            assert result[data_type].dtype == expected.dtype
+            for field in expected.dtype.names:
+                np.testing.assert_array_equal(result[data_type][field], expected[field])
+    assert np.all(np.isnan(result['peak_positions_gcn']['x_gcn']))
+    assert np.any(np.isfinite(result['peak_positions_cnn']['x_cnn']))
+
+    st = straxen.contexts.xenonnt_online(_database_init=False)
+    st.register(straxen.PeakPositionsCombinedNT)
+    assert st.data_info('peak_positions')['Field name'].tolist() == \
+           straxen.contexts.xenonnt_online(_database_init=False).data_info(
+               'peak_positions')['Field name'].tolist()
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+import strax
+import straxen
+from straxen.plugins.pulse_processing import count_pulses
+
+
+def _standard_pulse_processing(raw_records, n_channels, **kwargs):
+    r = strax.raw_to_records(raw_records)
+    strax.zero_out_of_bounds(r)
+    strax.baseline(r, flip=True, **kwargs)
+    strax.integrate(r)
+    return r, count_pulses(r, n_channels)
+
+
+def _assert_identical(raw_records, n_channels, **kwargs):
+    r, counts = _standard_pulse_processing(raw_records, n_channels, **kwargs)
+    r_fused, counts_fused = straxen.fused_pulse_processing(
+        raw_records, n_channels, **kwargs)
+    assert r.dtype == r_fused.dtype
+    assert counts.dtype == counts_fused.dtype
+    # Compare the bytes, nan baseline_rms values do not compare equal
+    assert r.tobytes() == r_fused.tobytes()
+    assert counts.tobytes() == counts_fused.tobytes()
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_fused_pulse_processing(seed):
+    """Fused pulse processing should give the same bytes as the chain"""
+    raw_records = straxen.synthetic_raw_records(
+        0, int(2e6), n_channels=50,
+        s2_n_channels=(5, 50),
+        channel_rate=5e3,
+        saturation_fraction=0.1,
+        seed=seed)
+    assert len(raw_records)
+    _assert_identical(raw_records, 50)
+    _assert_identical(raw_records, 50, baseline_samples=10)
+
+
+def test_fused_pulse_processing_sloppy_chunking():
+    raw_records = straxen.synthetic_raw_records(
+        0, int(2e6), n_channels=20, s2_n_channels=(5, 20),
+        pulse_length=(300, 0.3), seed=3)
+    # Start in the middle of a pulse, as if the chunking was sloppy
+    t_cut = raw_records['time'][raw_records['record_i'] == 1][0]
+    raw_records = raw_records[raw_records['time'] >= t_cut]
+    assert raw_records[0]['record_i'] == 1
+
+    _assert_identical(raw_records, 20, allow_sloppy_chunking=True)
+    with pytest.raises(RuntimeError):
+        straxen.fused_pulse_processing(raw_records, 20)
+
+
+def test_fused_pulse_processing_empty():
+    raw_records = np.zeros(0, dtype=strax.raw_record_dtype(110))
+    _assert_identical(raw_records, 10)
+
+
+@pytest.mark.parametrize('pmt_pulse_filter',
+                         [None, straxen.contexts.x1t_common_config['pmt_pulse_filter']])
+def test_peaklets_from_hits(pmt_pulse_filter):
+    """PeakletsFromHits should give the same as Peaklets"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        daq_config = straxen.write_synthetic_daq_data(
+            os.path.join(temp_dir, 'live_data'),
+            duration=int(1e8),
+            chunk_duration=int(4e7),
+            overlap_duration=int(1e7),
+            s2_rate=200,
+            s2_n_photons=(1e3, 1e6),
+            saturation_fraction=0.2,
+            # Baseline before the saturated pulses
+            pretrigger=50)
+        daq_config.pop('raw_bytes')
+        config = dict(straxen.contexts.xnt_common_config,
+                      gain_model=('to_pe_placeholder', True),
+                      hit_min_amplitude=15,
+                      pmt_pulse_filter=pmt_pulse_filter,
+                      **daq_config)
+        st = strax.Context(
+            storage=[strax.DataDirectory(os.path.join(temp_dir, 'strax_data'))],
+            register=[straxen.DAQReader,
+                      straxen.PulseProcessing,
+                      straxen.Hits,
+                      straxen.Peaklets],
+            config=config,
+            free_options=tuple(config.keys()),
+            allow_multiprocess=False)
+        run_id = '000000'
+        st.make(run_id, 'records')
+        st.make(run_id, 'hits')
+        peaklets = st.get_array(run_id, 'peaklets')
+        assert len(peaklets)
+        assert np.any(peaklets['n_saturated_channels'] > 0)
+        lone_hits = st.get_array(run_id, 'lone_hits')
+        hits = st.get_array(run_id, 'hits')
+        assert np.all(np.diff(hits['time']) >= 0)
+
+        st_hits = st.new_context()
+        st_hits.register(straxen.PeakletsFromHits)
+        assert not st_hits.is_stored(run_id, 'peaklets')
+        assert peaklets.tobytes() == st_hits.get_array(run_id, 'peaklets').tobytes()
+        assert lone_hits.tobytes() == st_hits.get_array(run_id, 'lone_hits').tobytes()
+
+        # The saturation correction changes records in memory
+        records = st.get_array(run_id, 'records')
+        start, end = 0, int(1e9)
+        result = st.get_single_plugin(run_id, 'peaklets').compute(
+            records.copy(), start, end)
+        result_hits = st_hits.get_single_plugin(run_id, 'peaklets').compute(
+            records.copy(), hits, start, end)
+        for d in ('peaklets', 'lone_hits'):
+            assert result[d].tobytes() == result_hits[d].tobytes()
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+import straxen
+
+
+@pytest.fixture
+def resource_cache():
+    cache = straxen.common._resource_cache
+    max_bytes, mmap_npy_min_bytes = cache.max_bytes, straxen.common._mmap_npy_min_bytes
+    straxen.clear_resource_cache()
+    yield cache
+    straxen.configure_resource_cache(max_bytes=max_bytes,
+                                     mmap_npy_min_bytes=mmap_npy_min_bytes)
+    straxen.clear_resource_cache()
+
+
+def test_resource_nbytes():
+    x = np.zeros(1000)
+    assert straxen.resource_nbytes(x) == 8000
+    assert straxen.resource_nbytes({'a': x, 'b': x}) > 16000
+    assert straxen.resource_nbytes(b'1' * 1000) >= 1000
+    df = pd.DataFrame({'a': x})
+    assert straxen.resource_nbytes(df) >= 8000
+
+
+def test_lru(resource_cache):
+    straxen.configure_resource_cache(max_bytes=25_000)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_names = []
+        for i in range(4):
+            file_names.append(os.path.join(temp_dir, f'{i}.npy'))
+            np.save(file_names[-1], np.full(1000, i, dtype=np.float64))
+
+        for file_name in file_names[:3]:
+            straxen.get_resource(file_name, fmt='npy')
+        assert len(resource_cache) == 3
+        # Use the first file, so the second one is evicted next
+        assert straxen.get_resource(file_names[0], fmt='npy')[0] == 0
+        straxen.get_resource(file_names[3], fmt='npy')
+        info = straxen.resource_cache_info()
+        assert info['size'] == 3 and info['evictions'] == 1
+        assert info['hits'] == 1 and info['nbytes'] == 24_000
+        assert (file_names[0], 'npy') in resource_cache
+        assert (file_names[1], 'npy') not in resource_cache
+
+        # Same file in another format is cached separately
+        assert isinstance(straxen.get_resource(file_names[3], fmt='binary'), bytes)
+        assert (file_names[3], 'npy') in resource_cache
+
+        # Resources larger than the budget are not cached
+        straxen.configure_resource_cache(max_bytes=5000)
+        assert len(resource_cache) == 0
+        straxen.get_resource(file_names[0], fmt='npy')
+        assert len(resource_cache) == 0
+        assert straxen.resource_cache_info()['too_large'] == 1
+
+
+def test_mmap(resource_cache):
+    straxen.configure_resource_cache(mmap_npy_min_bytes=10_000)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        small, large = os.path.join(temp_dir, 'small.npy'), os.path.join(temp_dir, 'large.npy')
+        np.save(small, np.arange(10))
+        np.save(large, np.arange(10_000))
+
+        assert not isinstance(straxen.get_resource(small, fmt='npy'), np.memmap)
+        result = straxen.get_resource(large, fmt='npy')
+        assert isinstance(result, np.memmap)
+        assert not result.flags.writeable
+        np.testing.assert_array_equal(result, np.arange(10_000))
+        assert straxen.resource_cache_info()['nbytes'] == 80
+        del result
+        straxen.clear_resource_cache()
+
+
+def test_pre_apply_function(resource_cache, tmp_path, monkeypatch):
+    """Functions are loaded once, from the local file when testing"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(straxen.common, '_pre_apply_functions', {})
+    (tmp_path / 'test_function.py').write_text(
+        'def test_function(data, run_id, targets):\n'
+        '    return data * 2, run_id, targets\n')
+    data = np.arange(3)
+    result, run_id, targets = straxen.pre_apply_function(data, '012345', 'event_info',
+                                                         function_name='test_function')
+    np.testing.assert_array_equal(result, data * 2)
+    assert (run_id, targets) == ('012345', ('event_info',))
+    assert 'test_function' in straxen.common._pre_apply_functions
+
+    # Not read again
+    (tmp_path / 'test_function.py').unlink()
+    straxen.pre_apply_function(data, '012345', 'event_info', function_name='test_function')